@@ -1,57 +1,251 @@
-from fastapi import APIRouter, UploadFile, HTTPException, File, Body
+from fastapi import APIRouter, UploadFile, HTTPException, File, Body, Form, Query, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from app.services.ocr_service import PDFService
 from app.services.structure_data_service import StructureDataService
-from typing import Dict, Any, List
+from app.services.cache_service import result_cache, single_flight
+from app.services.llm_registry import llm_registry
+from app.services.llm_scheduler import llm_scheduler
+from app.services.job_service import JobService
+from app.services.template_store import template_store
+from app.services.ingestion import IngestionRoute, SpooledUpload, close_uploads, ingest_uploads, ingested_uploads
+from app.schemas.job import JobCreated, JobStatus
+from app.core.config import settings
+from typing import Dict, Any, List, AsyncIterator, Optional
+import json
+import time
 
-router = APIRouter()
+router = APIRouter(route_class=IngestionRoute)
 pdf_service = PDFService()
-structure_service = StructureDataService()
+structure_service = StructureDataService(pdf_service)
+job_service = JobService(pdf_service, structure_service, workers=settings.JOB_WORKERS)
+
+ALLOWED_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.tiff', '.bmp')
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+ENGINE_PATTERN = "^(llm|tesseract|auto)$"
+
+def _validate_uploads(files: List[UploadFile]) -> None:
+    for file in files:
+        if not file.filename.lower().endswith(ALLOWED_EXTENSIONS):
+            raise HTTPException(
+                status_code=400, 
+                detail=f"All files must be PDF or images ({', '.join(ALLOWED_EXTENSIONS)})"
+            )
+
+def _request_deadline() -> Optional[float]:
+    """Istante (time.monotonic) oltre il quale si restituiscono le sole pagine completate."""
+    if settings.REQUEST_DEADLINE_SECONDS <= 0:
+        return None
+    return time.monotonic() + settings.REQUEST_DEADLINE_SECONDS
+
+def _stream_response(
+    records: AsyncIterator[Dict[str, Any]],
+    uploads: List[SpooledUpload],
+    format: str,
+) -> StreamingResponse:
+    """Serializza i record come NDJSON (una riga JSON per record) o Server-Sent Events."""
+    async def encode() -> AsyncIterator[str]:
+        try:
+            async for record in records:
+                yield _encode_record(record, format)
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            yield _encode_record({"type": "error", "detail": detail}, format)
+        finally:
+            close_uploads(uploads)
+
+    # Gli upload acquisiti sopravvivono alla chiusura dei file del form da parte di FastAPI
+    # e vengono rilasciati a stream terminato. Il task in background li rilascia anche se
+    # lo stream non parte (client disconnesso prima del primo chunk)
+    return StreamingResponse(
+        encode(),
+        media_type=STREAM_MEDIA_TYPES[format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(close_uploads, uploads),
+    )
+
+def _encode_record(record: Dict[str, Any], format: str) -> str:
+    data = json.dumps(record, ensure_ascii=False)
+    if format == "sse":
+        return f"event: {record['type']}\ndata: {data}\n\n"
+    return f"{data}\n"
 
 @router.post("/extract-tables")
-async def extract_tables(files: List[UploadFile] = File(...)) -> Dict[str, Any]:
+async def extract_tables(
+    files: List[UploadFile] = File(...),
+    engine: Optional[str] = Query(None, pattern=ENGINE_PATTERN, description="'llm', 'tesseract' o 'auto' (default EXTRACTION_ENGINE)"),
+) -> Dict[str, Any]:
     """
     Estrae le tabelle da uno o più file (PDF o immagini).
     
     Args:
         files: Lista di file da processare (PDF o immagini)
+        engine: Motore per le pagine renderizzate: modello vision, OCR locale o OCR locale
+            con inoltro al modello delle pagine a bassa confidenza
         
     Returns:
-        Dict contenente le tabelle estratte da tutti i file
+        Dict contenente le tabelle estratte da tutti i file; se la richiesta supera
+        REQUEST_DEADLINE_SECONDS, le pagine non completate sono in metadata.missing_pages
         
     Raises:
-        HTTPException: Se i file non sono nei formati supportati
+        HTTPException: Se i file non sono nei formati supportati o superano i limiti di dimensione
     """
-    allowed_extensions = ('.pdf', '.png', '.jpg', '.jpeg', '.tiff', '.bmp')
-    for file in files:
-        if not file.filename.lower().endswith(allowed_extensions):
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Tutti i file devono essere PDF o immagini ({', '.join(allowed_extensions)})"
-            )
-    return await pdf_service.extract_tables_data(files)
+    _validate_uploads(files)
+    deadline = _request_deadline()
+    async with ingested_uploads(files) as uploads:
+        return await pdf_service.extract_tables_data(uploads, deadline, engine)
 
 @router.post("/extract-medical-data", response_model=List[Dict[str, Any]])
-async def extract_tables(files: List[UploadFile] = File(...)) -> List[Dict[str, Any]]:
+async def extract_tables(
+    response: Response,
+    files: List[UploadFile] = File(...),
+    engine: Optional[str] = Query(None, pattern=ENGINE_PATTERN, description="'llm', 'tesseract' or 'auto' (default EXTRACTION_ENGINE)"),
+) -> List[Dict[str, Any]]:
     """
     Extract and structure data from medical files (PDF or images).
     
     Args:
         files: List of files to process (PDF or images)
+        engine: Table extraction engine for rendered pages: vision model, local OCR, or
+            local OCR with low-confidence pages escalated to the model
         
     Returns:
-        List of dictionaries containing structured medical data
+        List of dictionaries containing structured medical data. If the request exceeds
+        REQUEST_DEADLINE_SECONDS, only the finished pages are included and the response
+        carries `X-Partial-Result: true` and `X-Missing-Pages` (JSON list of file/page)
         
     Raises:
-        HTTPException: If files are not in supported formats
+        HTTPException: If files are not in supported formats or exceed the size limits
     """
-    allowed_extensions = ('.pdf', '.png', '.jpg', '.jpeg', '.tiff', '.bmp')
-    for file in files:
-        if not file.filename.lower().endswith(allowed_extensions):
-            raise HTTPException(
-                status_code=400, 
-                detail=f"All files must be PDF or images ({', '.join(allowed_extensions)})"
-            )
-    return await structure_service.process_medical_files(files)
+    _validate_uploads(files)
+    deadline = _request_deadline()
+    async with ingested_uploads(files) as uploads:
+        medical_fields, missing_pages = await structure_service.extract_medical_data(uploads, deadline, engine)
+    if missing_pages:
+        response.headers["X-Partial-Result"] = "true"
+        response.headers["X-Missing-Pages"] = json.dumps(missing_pages)
+    return medical_fields
+
+@router.post("/extract-medical-data/batch")
+async def extract_medical_data_batch(
+    files: List[UploadFile] = File(...),
+    ids: List[str] = Form(..., description="Report id of each file, in the same order; files sharing an id form one report"),
+    engine: Optional[str] = Query(None, pattern=ENGINE_PATTERN, description="'llm', 'tesseract' or 'auto' (default EXTRACTION_ENGINE)"),
+) -> Dict[str, Any]:
+    """
+    Extract and structure many reports in one request, for throughput rather than latency
+    (e.g. backfills): pages of different reports are packed into the same vision calls and
+    rows are structured in large blocks, then the results are split back per report.
+    
+    Args:
+        files: Files of all the reports (PDF or images)
+        ids: Caller-supplied report id of each file, in the same order as `files`
+        engine: Table extraction engine for rendered pages (as in /extract-medical-data)
+        
+    Returns:
+        {"reports": [...], "summary": {...}} with one entry per report id, in order of first
+        appearance: {"id", "status": "ok", "medical_fields", "failed_pages"} or
+        {"id", "status": "error", "error", "failed_pages"}. A failing report does not
+        fail the request. No overall deadline applies
+        
+    Raises:
+        HTTPException: If files are not in supported formats, `ids` does not match `files`
+            or the uploads exceed the size limits
+    """
+    _validate_uploads(files)
+    if len(ids) != len(files):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Expected one report id per file: got {len(ids)} ids for {len(files)} files"
+        )
+    if any(not report_id.strip() for report_id in ids):
+        raise HTTPException(status_code=400, detail="Report ids must not be empty")
+    started = time.perf_counter()
+    async with ingested_uploads(files) as uploads:
+        report_files: Dict[str, List[SpooledUpload]] = {}
+        for report_id, upload in zip(ids, uploads):
+            report_files.setdefault(report_id, []).append(upload)
+        reports = await structure_service.extract_medical_batch(list(report_files.items()), engine)
+    return {
+        "reports": reports,
+        "summary": {
+            "reports": len(reports),
+            "ok": sum(report["status"] == "ok" for report in reports),
+            "failed": sum(report["status"] == "error" for report in reports),
+            "medical_fields": sum(len(report.get("medical_fields", [])) for report in reports),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000),
+        },
+    }
+
+@router.post("/extract-tables/stream")
+async def extract_tables_stream(
+    files: List[UploadFile] = File(...),
+    format: str = Query("ndjson", pattern="^(ndjson|sse)$", description="'ndjson' o 'sse'"),
+    engine: Optional[str] = Query(None, pattern=ENGINE_PATTERN, description="'llm', 'tesseract' o 'auto' (default EXTRACTION_ENGINE)"),
+    rows: bool = Query(False, description="Emette anche ogni riga appena il modello la scrive (record 'row' provvisori)"),
+) -> StreamingResponse:
+    """
+    Variante in streaming di /extract-tables: emette le tabelle di ogni pagina appena pronte.
+    
+    Args:
+        files: Lista di file da processare (PDF o immagini)
+        format: Formato dello stream, NDJSON o Server-Sent Events
+        engine: Motore per le pagine renderizzate (come in /extract-tables)
+        rows: Se vero, emette anche le righe lette dal modello durante la risposta
+        
+    Returns:
+        Stream di record {"type": "page", "file", "page", "tables", ...} seguiti da un
+        record {"type": "summary"}; in caso di errore un record {"type": "error"}. Con
+        `rows` anche record provvisori {"type": "row", "file", "page", "table", "headers",
+        "row"}: il record della pagina resta quello definitivo
+        
+    Raises:
+        HTTPException: Se i file non sono nei formati supportati o superano i limiti di dimensione
+    """
+    _validate_uploads(files)
+    deadline = _request_deadline()
+    uploads = await ingest_uploads(files)
+    try:
+        return _stream_response(pdf_service.stream_tables(uploads, deadline, engine, rows), uploads, format)
+    except BaseException:
+        close_uploads(uploads)
+        raise
+
+@router.post("/extract-medical-data/stream")
+async def extract_medical_data_stream(
+    files: List[UploadFile] = File(...),
+    format: str = Query("ndjson", pattern="^(ndjson|sse)$", description="'ndjson' or 'sse'"),
+    engine: Optional[str] = Query(None, pattern=ENGINE_PATTERN, description="'llm', 'tesseract' or 'auto' (default EXTRACTION_ENGINE)"),
+    rows: bool = Query(False, description="Also emit each row as soon as the model writes it (provisional 'row' records)"),
+) -> StreamingResponse:
+    """
+    Streaming variant of /extract-medical-data: emits the structured fields of each page
+    as soon as they are ready.
+    
+    Args:
+        files: List of files to process (PDF or images)
+        format: Stream format, NDJSON or Server-Sent Events
+        engine: Table extraction engine for rendered pages (as in /extract-medical-data)
+        rows: If true, also emit rows structured while the model is still answering
+        
+    Returns:
+        Stream of {"type": "page", "file", "page", "medical_fields", ...} records followed
+        by a {"type": "summary"} record; on failure an {"type": "error"} record. With
+        `rows`, also provisional {"type": "row", "file", "page", "table", "medical_fields"}
+        records for rows the rule-based normalizer resolves; the page record stays
+        authoritative
+        
+    Raises:
+        HTTPException: If files are not in supported formats or exceed the size limits
+    """
+    _validate_uploads(files)
+    deadline = _request_deadline()
+    uploads = await ingest_uploads(files)
+    try:
+        return _stream_response(structure_service.stream_medical_data(uploads, deadline, engine, rows), uploads, format)
+    except BaseException:
+        close_uploads(uploads)
+        raise
 
 @router.post("/structure-clinical-data")
 async def structure_clinical_data(data: Dict[str, Any] = Body(...)) -> List[Dict[str, Any]]:
@@ -74,24 +268,124 @@ async def structure_clinical_data(data: Dict[str, Any] = Body(...)) -> List[Dict
         Lista di dizionari con i dati strutturati nel formato:
         [
             {
-                "field name": str,
-                "field value": str,
-                "field unit of measure": str,
+                "field_name": str,
+                "field_value": str,
+                "field_unit_of_measure": str,
                 "LOINC_value": str,
                 "belonging_panel_LOINC_value": str,
                 "reference_range_low": str,
                 "reference_range_high": str
             }
         ]
+        Le righe sono normalizzate come in /extract-medical-data (quelle non interpretabili
+        con certezza passano dal modello) e i codici LOINC vengono dall'indice locale.
         
     Raises:
         HTTPException: Se i dati di input non sono nel formato corretto
     """
     try:
-        return await structure_service.clean_table_data_json(data)
+        return await structure_service.structure_tables(data)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Errore durante la strutturazione dei dati: {str(e)}"
         )
 
+
+@router.post("/jobs", response_model=JobCreated, status_code=202)
+async def create_job(
+    files: List[UploadFile] = File(...),
+    kind: str = Query("medical", description="'medical' (extract-medical-data) o 'tables' (extract-tables)"),
+) -> JobCreated:
+    """
+    Accoda l'elaborazione di uno o più file e restituisce subito l'id del job.
+    
+    Args:
+        files: Lista di file da processare (PDF o immagini)
+        kind: Tipo di elaborazione da eseguire
+        
+    Returns:
+        Id e stato iniziale del job
+        
+    Raises:
+        HTTPException: Se i file non sono nei formati supportati o superano i limiti di dimensione
+    """
+    _validate_uploads(files)
+    job_id = await job_service.submit(kind, files)
+    return JobCreated(job_id=job_id, status="queued")
+
+@router.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job(job_id: str) -> JobStatus:
+    """
+    Restituisce stato e, se completato, risultato di un job.
+    
+    Args:
+        job_id: Id restituito da POST /jobs
+        
+    Returns:
+        Stato del job con il risultato persistito
+        
+    Raises:
+        HTTPException: Se il job non esiste
+    """
+    job = await job_service.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+@router.get("/cache/stats")
+async def cache_stats() -> Dict[str, Any]:
+    """
+    Restituisce i contatori della cache dei risultati (hit in memoria e su disco, miss)
+    e della coalescenza delle richieste identiche in corso.
+    
+    Returns:
+        Dict con lo stato della cache del worker corrente e, in "single_flight",
+        esecuzioni avviate (leaders) e richieste agganciate (followers)
+    """
+    return {**result_cache.stats(), "single_flight": single_flight.stats()}
+
+@router.get("/llm/stats")
+async def llm_stats() -> Dict[str, Any]:
+    """
+    Restituisce lo stato del pool di connessioni condiviso verso il provider LLM
+    e dello scheduler delle chiamate.
+    
+    Returns:
+        Dict con richieste inviate, connessioni aperte, configurazione del pool e,
+        in "scheduler", chiamate in corso, in coda, ripetute e rifiutate
+    """
+    return {**llm_registry.stats(), "scheduler": llm_scheduler.stats()}
+
+@router.get("/layout-templates")
+async def list_layout_templates() -> Dict[str, Any]:
+    """
+    Restituisce i template di layout appresi dalle pagine lette dal modello.
+    
+    Returns:
+        Dict con i template ("id", intestazioni delle tabelle, campioni e "active" se
+        applicati alle nuove pagine)
+    """
+    await template_store.refresh(force=True)
+    return {"templates": template_store.summary()}
+
+@router.delete("/layout-templates/{template_id}")
+async def delete_layout_template(template_id: str) -> Dict[str, Any]:
+    """
+    Elimina un template di layout (es. se legge male un formato): le pagine di quel
+    formato tornano al modello, che può farlo riapprendere.
+    
+    Args:
+        template_id: Id restituito da GET /layout-templates
+        
+    Returns:
+        Dict con l'id del template eliminato
+        
+    Raises:
+        HTTPException: Se il template non esiste
+    """
+    if not await template_store.remove(template_id):
+        raise HTTPException(status_code=404, detail=f"Layout template {template_id} not found")
+    return {"deleted": template_id}
@@ -0,0 +1,254 @@
+"""
+Server finto compatibile con le chat completions di OpenAI, per i test di carico.
+
+Risponde alle chiamate vision con le tabelle associate allo SHA-256 di ogni immagine
+(di default quelle del referto scansionato sintetico di `pipeline`, lo stesso caricato
+da `load_test`) e alle chiamate di strutturazione con i campi della ground truth.
+Latenza, errori 5xx, 429 casuali, un limite di richieste al minuto e il troncamento
+delle risposte vision (--max-tokens, finish_reason "length") sono configurabili. Uso:
+
+    python -m app.benchmarks.fake_openai --port 8100 --vision-latency lognormal:2,0.4 \\
+        --structure-latency uniform:0.5,1.5 --error-rate 0.01 --rate-limit-rate 0.02 --rpm 500
+
+    OPENAI_BASE_URL=http://localhost:8100/v1 OPENAI_API_KEY=fake uvicorn app.main:app
+
+Le latenze sono "fixed:s", "uniform:min,max", "lognormal:mediana,sigma" o "exp:media"
+(secondi). Con --answers si passa un JSON {sha256 del data URL: [tabelle]} che
+si aggiunge all'indice generato. L'indice dipende dal rendering: il server va avviato
+con le stesse impostazioni IMAGE_*, RENDER_* e TABLE_DETECTION_* di Morfeo.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.benchmarks.fixtures import build_scanned_report_pdf
+from app.benchmarks.llm_backend import STREAM_CHUNK_CHARS, LLMBackend, image_key, image_urls, transcribed_tables
+from app.benchmarks.pipeline import fields_by_row, oracle_images
+
+# Stima grossolana dei token di un'immagine e dei caratteri per token, per `usage`
+IMAGE_TOKENS = 765
+CHARS_PER_TOKEN = 4
+
+
+class Latency:
+    """Distribuzione di latenza letta da una stringa "tipo:parametri"."""
+
+    def __init__(self, spec: str):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(value) for value in params.split(",") if value]
+        expected = {"fixed": 1, "uniform": 2, "lognormal": 2, "exp": 1}
+        if expected.get(kind) != len(self.params):
+            raise ValueError(f"Invalid latency spec: {spec}")
+        self.spec = spec
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return random.uniform(*self.params)
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        return random.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+
+
+class FakeOpenAI:
+    """Stato del server: oracolo, iniezione dei guasti e contatori."""
+
+    def __init__(
+        self,
+        backend: LLMBackend,
+        vision_latency: Latency,
+        structure_latency: Latency,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        rpm: int = 0,
+        retry_after: float = 1.0,
+        max_tokens: Optional[int] = None,
+    ):
+        self.backend = backend
+        self.vision_latency = vision_latency
+        self.structure_latency = structure_latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rpm = rpm
+        self.retry_after = retry_after
+        self.max_tokens = max_tokens
+        self._window: Deque[float] = deque()
+        self._ids = itertools.count(1)
+        self.stats = {"requests": 0, "vision": 0, "structure": 0, "errors": 0, "rate_limited": 0, "unknown_images": 0, "truncated": 0}
+
+    def _rate_limited(self) -> Optional[float]:
+        """Secondi da attendere se la richiesta supera il limite, altrimenti None."""
+        if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+            return self.retry_after
+        if self.rpm:
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= 60:
+                self._window.popleft()
+            if len(self._window) >= self.rpm:
+                return 60 - (now - self._window[0])
+            self._window.append(now)
+        return None
+
+    async def complete(self, body: Dict[str, Any]):
+        self.stats["requests"] += 1
+        wait = self._rate_limited()
+        if wait is not None:
+            self.stats["rate_limited"] += 1
+            return _error(429, "rate_limit_exceeded", "Rate limit reached", {"retry-after": f"{wait:.2f}"})
+
+        messages = body.get("messages", [])
+        urls = image_urls(messages)
+        structured = bool(body.get("tools") or body.get("functions"))
+        latency = self.vision_latency if urls else self.structure_latency
+        await asyncio.sleep(latency.sample())
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return _error(500, "server_error", "Injected failure")
+
+        if urls:
+            self.stats["vision"] += 1
+            self.stats["unknown_images"] += sum(
+                1 for url in urls if image_key(url) not in self.backend.images
+            )
+            content = json.dumps(self.backend.vision_oracle(urls, transcribed_tables(messages)), ensure_ascii=False)
+        else:
+            self.stats["structure"] += 1
+            prompt = "\n".join(str(message.get("content", "")) for message in messages)
+            content = json.dumps({"medical_fields": self.backend.structure_oracle(prompt)}, ensure_ascii=False)
+
+        finish_reason = "stop"
+        # Limite di token della risposta: il contenuto viene troncato come farebbe il provider
+        max_tokens = min(filter(None, [body.get("max_tokens"), self.max_tokens]), default=None)
+        if max_tokens and not structured and len(content) > max_tokens * CHARS_PER_TOKEN:
+            self.stats["truncated"] += 1
+            content = content[:max_tokens * CHARS_PER_TOKEN]
+            finish_reason = "length"
+        message: Dict[str, Any] = {"role": "assistant", "content": content}
+        if structured:
+            message["content"] = None
+            if body.get("tools"):
+                name = body["tools"][0]["function"]["name"]
+                message["tool_calls"] = [{
+                    "id": f"call_{next(self._ids)}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": content},
+                }]
+                finish_reason = "tool_calls"
+            else:
+                message["function_call"] = {"name": body["functions"][0]["name"], "arguments": content}
+                finish_reason = "function_call"
+
+        completion = {
+            "id": f"chatcmpl-fake-{next(self._ids)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": _usage(messages, len(urls), content),
+        }
+        if body.get("stream") and not structured:
+            return StreamingResponse(_stream(completion), media_type="text/event-stream")
+        return JSONResponse(completion)
+
+
+def _usage(messages: List[Dict[str, Any]], images: int, content: str) -> Dict[str, int]:
+    text = sum(
+        len(part.get("text", "")) if isinstance(part, dict) else len(str(part))
+        for message in messages
+        for part in (message.get("content") if isinstance(message.get("content"), list) else [message.get("content") or ""])
+    )
+    prompt_tokens = text // CHARS_PER_TOKEN + images * IMAGE_TOKENS
+    completion_tokens = len(content) // CHARS_PER_TOKEN
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+async def _stream(completion: Dict[str, Any]):
+    content = completion["choices"][0]["message"]["content"]
+    base = {key: completion[key] for key in ("id", "created", "model")}
+    base["object"] = "chat.completion.chunk"
+    for start in range(0, len(content), STREAM_CHUNK_CHARS):
+        chunk = {**base, "choices": [{"index": 0, "delta": {"content": content[start:start + STREAM_CHUNK_CHARS]}, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        await asyncio.sleep(0)
+    final = {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": completion["choices"][0]["finish_reason"]}]}
+    yield f"data: {json.dumps(final)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def _error(status: int, code: str, message: str, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+    body = {"error": {"message": message, "type": code, "param": None, "code": code}}
+    return JSONResponse(body, status_code=status, headers=headers)
+
+
+def create_app(fake: FakeOpenAI) -> FastAPI:
+    app = FastAPI(title="Fake OpenAI")
+
+    @app.post("/v1/chat/completions")
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        return await fake.complete(await request.json())
+
+    @app.get("/stats")
+    async def stats():
+        return fake.stats
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--vision-latency", type=Latency, default=Latency("lognormal:2,0.4"))
+    parser.add_argument("--structure-latency", type=Latency, default=Latency("lognormal:1,0.4"))
+    parser.add_argument("--error-rate", type=float, default=0.0, help="quota di risposte 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="quota di 429 casuali")
+    parser.add_argument("--rpm", type=int, default=0, help="richieste al minuto oltre le quali rispondere 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After dei 429 casuali (s)")
+    parser.add_argument("--max-tokens", type=int, help="token massimi delle risposte vision, oltre cui si tronca")
+    parser.add_argument("--pages", type=int, default=4, help="pagine del referto sintetico indicizzato")
+    parser.add_argument("--rows-per-page", type=int, default=20)
+    parser.add_argument("--answers", help="JSON {sha256 del data URL: [tabelle]}")
+    args = parser.parse_args()
+
+    images = oracle_images(build_scanned_report_pdf(args.pages, args.rows_per_page), args.rows_per_page)
+    if args.answers:
+        with open(args.answers, encoding="utf-8") as handle:
+            images.update({key: (0, tables) for key, tables in json.load(handle).items()})
+    logging.info(f"Fake OpenAI: {len(images)} immagini indicizzate")
+
+    fake = FakeOpenAI(
+        LLMBackend("oracle", images=images, fields=fields_by_row()),
+        args.vision_latency,
+        args.structure_latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        rpm=args.rpm,
+        retry_after=args.retry_after,
+        max_tokens=args.max_tokens,
+    )
+
+    import uvicorn
+    uvicorn.run(create_app(fake), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Generazione di referti sintetici per i benchmark, a partire dalla ground truth."""
+from typing import List
+
+import fitz
+
+from app.tests.ground_truth import SAMPLE_GROUND_TRUTH
+
+REPORT_HEADERS = ["Descrizione Esame", "Esiti", "Unita Di Misura", "Valori Normali"]
+COLUMN_X = [50, 260, 340, 440]
+
+
+def ground_truth_rows() -> List[List[str]]:
+    """Righe di tabella come appaiono sul referto (virgola decimale, range "low - high")."""
+    rows = []
+    for field in SAMPLE_GROUND_TRUTH["groundTruth"]:
+        low = field["reference_range_low"].replace(".", ",")
+        high = field["reference_range_high"].replace(".", ",")
+        if low and high:
+            reference_range = f"{low} - {high}"
+        elif low:
+            reference_range = f"> {low}"
+        elif high:
+            reference_range = f"< {high}"
+        else:
+            reference_range = ""
+        rows.append([
+            field["field name"],
+            field["field value"].replace(".", ","),
+            field["field unit of measure"],
+            reference_range,
+        ])
+    return rows
+
+
+def report_page_rows(page_number: int, rows_per_page: int) -> List[List[str]]:
+    """
+    Righe stampate sulla pagina `page_number` (1-based) di `build_lab_report_pdf`.
+    A ogni giro completo della ground truth l'ordine scorre di una riga, così nei
+    referti lunghi nessuna pagina ripete il contenuto di un'altra.
+    """
+    rows = ground_truth_rows()
+    start = (page_number - 1) * rows_per_page
+    return [
+        rows[(index + index // len(rows)) % len(rows)]
+        for index in range(start, start + rows_per_page)
+    ]
+
+
+def build_lab_report_pdf(pages: int = 4, rows_per_page: int = 20) -> bytes:
+    """Crea un PDF nativo (con text layer) che simula un referto di laboratorio multipagina."""
+    doc = fitz.open()
+    for page_number in range(1, pages + 1):
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((50, 50), "LABORATORIO ANALISI CLINICHE", fontsize=14)
+        page.insert_text((50, 70), f"Referto n. 2024/{page_number:04d} - Pagina {page_number}", fontsize=9)
+        y = 110
+        for x, header in zip(COLUMN_X, REPORT_HEADERS):
+            page.insert_text((x, y), header, fontsize=9)
+        page.draw_line((45, y + 5), (550, y + 5))
+        for row in report_page_rows(page_number, rows_per_page):
+            y += 16
+            for x, cell in zip(COLUMN_X, row):
+                page.insert_text((x, y), cell, fontsize=9)
+        page.insert_text((50, 800), "Firma del responsabile di laboratorio", fontsize=8)
+    content = doc.tobytes()
+    doc.close()
+    return content
+
+
+def build_scanned_report_pdf(pages: int = 4, rows_per_page: int = 20, dpi: int = 150) -> bytes:
+    """Come `build_lab_report_pdf`, ma ogni pagina è solo un'immagine (nessun text layer)."""
+    with fitz.open(stream=build_lab_report_pdf(pages, rows_per_page), filetype="pdf") as native:
+        scanned = fitz.open()
+        for page in native:
+            pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+            target = scanned.new_page(width=page.rect.width, height=page.rect.height)
+            target.insert_image(target.rect, stream=pixmap.tobytes("png"))
+        content = scanned.tobytes()
+        scanned.close()
+    return content
+
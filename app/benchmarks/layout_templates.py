@@ -0,0 +1,181 @@
+"""
+Benchmark dei template di layout su referti sintetici di più laboratori.
+
+Ogni laboratorio ha intestazioni, posizioni delle colonne e corpo del testo propri. Per
+ogni laboratorio si apprende il template da `--samples` pagine (le tabelle attese fanno
+le veci della lettura del modello), poi si leggono `--pages` pagine nuove, con righe e
+numero di righe diversi, oltre alle pagine di `--unknown-labs` laboratori mai visti.
+Le parole vengono dal text layer, con `--jitter` pt di rumore sulle coordinate per
+simulare l'OCR. Si misurano i millisecondi per pagina (lettura con i template e
+ricostruzione euristica a confronto), la quota di pagine riconosciute, le celle esatte
+e le pagine attribuite al template sbagliato. Uso:
+
+    python -m app.benchmarks.layout_templates [--labs 20] [--pages 50] [--jitter 1.0]
+"""
+import argparse
+import itertools
+import json
+import random
+import statistics
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+import fitz
+
+from app.benchmarks.fixtures import ground_truth_rows
+from app.core.config import settings
+from app.services import layout_templates, text_layer
+
+# Varianti delle intestazioni per colonna: ogni laboratorio ne usa una combinazione diversa
+HEADER_VARIANTS = [
+    ["Descrizione Esame", "Esame", "Analisi", "Prestazione", "Test"],
+    ["Esiti", "Risultato", "Valore", "Esito", "Risultati"],
+    ["Unita Di Misura", "Unità", "U.M.", "UdM", "Unità di misura"],
+    ["Valori Normali", "Intervallo di riferimento", "Valori di riferimento", "Range", "Valori attesi"],
+]
+
+
+def make_labs(count: int, rng: random.Random) -> List[Dict[str, Any]]:
+    combinations = list(itertools.product(*HEADER_VARIANTS))
+    rng.shuffle(combinations)
+    labs = []
+    for headers in combinations[:count]:
+        x = rng.uniform(30, 70)
+        columns = []
+        for width in (rng.uniform(170, 230), rng.uniform(60, 90), rng.uniform(70, 100), 0):
+            columns.append(x)
+            x += width
+        labs.append({"headers": list(headers), "columns": columns, "fontsize": rng.choice([8, 9, 10])})
+    return labs
+
+
+def lab_page(lab: Dict[str, Any], rows: List[List[str]], jitter: float, rng: random.Random) -> List[Tuple]:
+    """Parole di una pagina del laboratorio (text layer, coordinate con rumore)."""
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    size = lab["fontsize"]
+    page.insert_text((lab["columns"][0], 50), "LABORATORIO ANALISI CLINICHE", fontsize=size + 4)
+    page.insert_text((lab["columns"][0], 70), f"Referto n. {rng.randint(1, 9999):04d}", fontsize=size)
+    y = 110
+    for x, header in zip(lab["columns"], lab["headers"]):
+        page.insert_text((x, y), header, fontsize=size)
+    for row in rows:
+        y += size * 1.8
+        for x, cell in zip(lab["columns"], row):
+            page.insert_text((x, y), cell, fontsize=size)
+    page.insert_text((lab["columns"][0], 800), "Firma del responsabile di laboratorio", fontsize=size - 1)
+    words = [
+        (x0 + rng.uniform(-jitter, jitter), y0 + rng.uniform(-jitter, jitter),
+         x1 + rng.uniform(-jitter, jitter), y1 + rng.uniform(-jitter, jitter), text)
+        for x0, y0, x1, y1, text in (w[:5] for w in page.get_text("words"))
+    ]
+    doc.close()
+    return words
+
+
+def page_rows(rng: random.Random) -> List[List[str]]:
+    rows = ground_truth_rows()
+    return rng.sample(rows, rng.randint(6, min(30, len(rows))))
+
+
+def learn(labs: List[Dict[str, Any]], samples: int, jitter: float, rng: random.Random) -> Dict[str, Any]:
+    """Campioni compatibili accumulati per template, come in `TemplateStore`."""
+    store: Dict[str, Dict[str, Any]] = {}
+    failed = 0
+    for lab in labs:
+        for _ in range(samples):
+            rows = page_rows(rng)
+            layout = layout_templates.learn_layout(
+                lab_page(lab, rows, jitter, rng),
+                [{"headers": lab["headers"], "data": rows}],
+                [" ".join(lab["headers"])],
+                settings.LAYOUT_TEMPLATE_MIN_AGREEMENT,
+            )
+            if layout is None:
+                failed += 1
+                continue
+            record = store.get(layout["id"])
+            if record is not None and layout_templates.compatible(record["layout"], layout):
+                record["layout"] = layout_templates.merge(record["layout"], layout)
+                record["samples"] += 1
+            else:
+                store[layout["id"]] = {"layout": layout, "samples": 1}
+    return {"store": store, "failed_samples": failed}
+
+
+def evaluate(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    labs = make_labs(args.labs + args.unknown_labs, rng)
+    known, unknown = labs[:args.labs], labs[args.labs:]
+    learned = learn(known, args.samples, args.jitter, rng)
+    templates = [
+        record["layout"] for record in learned["store"].values()
+        if record["samples"] >= settings.LAYOUT_TEMPLATE_MIN_SAMPLES
+    ]
+
+    template_ms, heuristic_ms = [], []
+    matched = wrong = cells = exact = unknown_matched = 0
+    for lab in known + unknown:
+        expected_id = layout_templates.template_id([layout_templates.normalize_text(" ".join(lab["headers"]))])
+        for _ in range(args.pages):
+            rows = page_rows(rng)
+            words = lab_page(lab, rows, args.jitter, rng)
+            start = time.perf_counter()
+            match = layout_templates.match_page(words, templates)
+            template_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            text_layer.tables_from_words(words, 595)
+            heuristic_ms.append((time.perf_counter() - start) * 1000)
+            if match is None:
+                continue
+            if lab in unknown:
+                unknown_matched += 1
+                continue
+            if match[0] != expected_id:
+                wrong += 1
+                continue
+            matched += 1
+            data = match[1][0]["data"]
+            cells += max(len(rows), len(data)) * len(lab["headers"])
+            exact += sum(a == b for row, read in zip(rows, data) for a, b in zip(row, read))
+
+    def summary(values: List[float]) -> Dict[str, float]:
+        ordered = sorted(values)
+        return {
+            "mean": round(statistics.mean(ordered), 3),
+            "p50": round(ordered[len(ordered) // 2], 3),
+            "p95": round(ordered[int(len(ordered) * 0.95)], 3),
+        }
+
+    return {
+        "labs": args.labs,
+        "unknown_labs": args.unknown_labs,
+        "templates": len(templates),
+        "failed_samples": learned["failed_samples"],
+        "pages": args.labs * args.pages,
+        "matched_pages": matched,
+        "match_rate": round(matched / max(1, args.labs * args.pages), 4),
+        "cell_accuracy": round(exact / cells, 4) if cells else None,
+        "wrong_template_pages": wrong,
+        "unknown_lab_pages_matched": unknown_matched,
+        "template_ms": summary(template_ms),
+        "heuristic_ms": summary(heuristic_ms),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--labs", type=int, default=20)
+    parser.add_argument("--unknown-labs", type=int, default=5)
+    parser.add_argument("--samples", type=int, default=6, help="pagine lette dal modello per laboratorio")
+    parser.add_argument("--pages", type=int, default=50, help="pagine nuove lette per laboratorio")
+    parser.add_argument("--jitter", type=float, default=1.0, help="rumore sulle coordinate delle parole (pt)")
+    parser.add_argument("--seed", type=int, default=7)
+    report = evaluate(parser.parse_args())
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    sys.exit(1 if report["wrong_template_pages"] or report["unknown_lab_pages_matched"] else 0)
+
+
+if __name__ == "__main__":
+    main()
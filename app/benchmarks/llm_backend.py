@@ -0,0 +1,176 @@
+"""
+Backend LLM per i benchmark senza rete.
+
+Sostituisce `llm_registry.chat` con modelli che rispondono in uno di tre modi:
+
+- "oracle": risposte costruite dalla ground truth dei fixture (nessun file richiesto);
+- "replay": risposte lette da una cassetta JSON registrata in precedenza;
+- "record": chiamate reali al provider, salvate nella cassetta per i replay successivi.
+
+Le richieste sono identificate dallo SHA-256 del modello e dei messaggi, quindi una
+cassetta resta valida finché prompt, rendering e preprocessing non cambiano.
+"""
+import hashlib
+import json
+import os
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.runnables import RunnableLambda
+
+from app.services.llm_registry import llm_registry
+
+# Risposta vision per immagine: (posizione dell'immagine nella sua pagina, tabelle della pagina)
+ImageAnswer = Tuple[int, List[Dict[str, Any]]]
+# Caratteri per chunk nelle risposte in streaming
+STREAM_CHUNK_CHARS = 64
+
+
+def request_key(model: str, payload: Any) -> str:
+    serialized = json.dumps([model, payload], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def image_key(data_url: str) -> str:
+    return hashlib.sha256(data_url.encode("ascii")).hexdigest()
+
+
+def transcribed_tables(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Tabelle già trascritte in una richiesta di continuazione (ultimo messaggio assistant)."""
+    for message in reversed(messages):
+        if message.get("role") == "assistant" and message.get("content"):
+            try:
+                return json.loads(message["content"]).get("tables", [])
+            except (TypeError, ValueError, AttributeError):
+                return []
+    return []
+
+
+def image_urls(messages: List[Dict[str, Any]]) -> List[str]:
+    urls = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            urls.extend(part["image_url"]["url"] for part in content if part.get("type") == "image_url")
+    return urls
+
+
+class LLMBackend:
+    """Modelli finti da installare al posto di quelli del registry durante un benchmark."""
+
+    def __init__(
+        self,
+        mode: str,
+        cassette_path: Optional[str] = None,
+        images: Optional[Dict[str, ImageAnswer]] = None,
+        fields: Optional[Dict[Tuple[str, ...], Dict[str, str]]] = None,
+    ):
+        if mode not in ("oracle", "replay", "record"):
+            raise ValueError(f"Unsupported LLM backend: {mode}")
+        if mode != "oracle" and not cassette_path:
+            raise ValueError(f"LLM backend '{mode}' requires a cassette path")
+        self.mode = mode
+        self.cassette_path = cassette_path
+        self.images = images or {}
+        self.fields = fields or {}
+        self.cassette: Dict[str, Any] = {}
+        if mode == "replay" or (mode == "record" and cassette_path and os.path.exists(cassette_path)):
+            with open(cassette_path, encoding="utf-8") as handle:
+                self.cassette = json.load(handle)
+        self.calls = {"vision": 0, "structure": 0}
+        self._real_chat: Optional[Callable[..., Any]] = None
+
+    def install(self) -> None:
+        self._real_chat = llm_registry.chat
+        llm_registry.chat = self.chat
+
+    def uninstall(self) -> None:
+        if self._real_chat is not None:
+            llm_registry.chat = self._real_chat
+            self._real_chat = None
+
+    def save(self) -> None:
+        if self.mode == "record":
+            with open(self.cassette_path, "w", encoding="utf-8") as handle:
+                json.dump(self.cassette, handle, ensure_ascii=False, indent=1, sort_keys=True)
+
+    def chat(self, model: str, **kwargs: Any) -> "_BackendModel":
+        return _BackendModel(self, model, kwargs)
+
+    async def vision(self, model: str, kwargs: Dict[str, Any], messages: List[Dict[str, Any]]) -> str:
+        self.calls["vision"] += 1
+        key = request_key(model, messages)
+        if self.mode == "oracle":
+            return json.dumps(self.vision_oracle(image_urls(messages), transcribed_tables(messages)), ensure_ascii=False)
+        if self.mode == "replay":
+            return self._replayed(key)
+        response = await self._real_chat(model, **kwargs).ainvoke(messages)
+        self.cassette[key] = response.content
+        return response.content
+
+    async def structure(self, model: str, kwargs: Dict[str, Any], schema: Any, prompt_value: Any) -> Any:
+        self.calls["structure"] += 1
+        key = request_key(model, prompt_value.to_string())
+        if self.mode == "oracle":
+            return schema(medical_fields=self.structure_oracle(prompt_value.to_string()))
+        if self.mode == "replay":
+            return schema.model_validate(self._replayed(key))
+        chain = self._real_chat(model, **kwargs).with_structured_output(schema)
+        result = await chain.ainvoke(prompt_value)
+        self.cassette[key] = result.model_dump()
+        return result
+
+    def _replayed(self, key: str) -> Any:
+        if key not in self.cassette:
+            raise KeyError(f"Request {key[:12]} not found in cassette {self.cassette_path}")
+        return self.cassette[key]
+
+    def vision_oracle(
+        self, urls: List[str], transcribed: Optional[List[Dict[str, Any]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Risposta vision costruita dall'indice delle immagini (usata anche da `fake_openai`).
+        In una continuazione si omettono le righe già `transcribed`.
+        """
+        tables = []
+        for number, url in enumerate(urls, start=1):
+            position, page_tables = self.images.get(image_key(url), (1, []))
+            # Le tabelle della pagina vengono attribuite al suo primo ritaglio
+            if position == 0:
+                tables.extend({**table, "page": number} for table in page_tables)
+        skip = sum(len(table.get("data", [])) for table in transcribed or [])
+        remaining = []
+        for table in tables:
+            rows = table["data"][skip:]
+            skip = max(0, skip - len(table["data"]))
+            if rows:
+                remaining.append({**table, "data": rows})
+        return {"tables": remaining}
+
+    def structure_oracle(self, prompt: str) -> List[Dict[str, str]]:
+        """Campi della ground truth per le righe presenti nel prompt di strutturazione."""
+        _, _, data = prompt.rpartition("format: ")
+        rows = json.loads(data) if data else []
+        # Le righe arrivano con le celle nell'ordine delle colonne del referto
+        return [self.fields[key] for key in (tuple(row.values()) for row in rows) if key in self.fields]
+
+
+class _BackendModel:
+    def __init__(self, backend: LLMBackend, model: str, kwargs: Dict[str, Any]):
+        self.backend = backend
+        self.model = model
+        self.kwargs = kwargs
+
+    async def ainvoke(self, messages: List[Dict[str, Any]], **_: Any) -> AIMessage:
+        return AIMessage(content=await self.backend.vision(self.model, self.kwargs, messages))
+
+    async def astream(self, messages: List[Dict[str, Any]], **_: Any) -> AsyncIterator[AIMessageChunk]:
+        content = await self.backend.vision(self.model, self.kwargs, messages)
+        for start in range(0, len(content), STREAM_CHUNK_CHARS):
+            yield AIMessageChunk(content=content[start:start + STREAM_CHUNK_CHARS])
+
+    def with_structured_output(self, schema: Any) -> RunnableLambda:
+        async def structure(prompt_value: Any) -> Any:
+            return await self.backend.structure(self.model, self.kwargs, schema, prompt_value)
+
+        return RunnableLambda(structure)
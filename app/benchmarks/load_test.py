@@ -0,0 +1,219 @@
+"""
+Test di carico: N upload concorrenti verso un'istanza di Morfeo in esecuzione.
+
+Pensato per girare contro `fake_openai` (nessun costo API, nessuna rete), ma funziona
+con qualunque backend. Ogni upload ha un contenuto diverso (un commento in coda al
+PDF), così la cache dei risultati non falsa le misure; --same-content disattiva la
+variazione. Riporta percentili di latenza, throughput, stato delle risposte, tempo
+medio per fase (dall'header Server-Timing) e ritardo del loop asyncio del server
+(da /metrics) e del driver stesso. Uso:
+
+    python -m app.benchmarks.load_test --url http://localhost:8000 --concurrency 16 \\
+        --requests 200 [--endpoints extract-tables extract-medical-data] [report.pdf ...]
+
+Con l'endpoint extract-medical-data/batch ogni richiesta porta --batch-size referti
+(ciascuno con un id diverso): il throughput in pagine al secondo è confrontabile con
+quello delle richieste per singolo referto.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+from app.benchmarks.fixtures import build_scanned_report_pdf
+
+LAG_METRIC = "morfeo_event_loop_lag_seconds"
+BATCH_ENDPOINT = "extract-medical-data/batch"
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Percentile per rango più vicino (q in 0-100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[index], 4)
+
+
+def latency_summary(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": round(max(values), 4) if values else None,
+    }
+
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    timings = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "dur":
+                timings[name] = float(value) / 1000
+    return timings
+
+
+async def scrape_lag(client: httpx.AsyncClient, url: str) -> Optional[Dict[str, float]]:
+    """Buckets cumulativi, somma e conteggio dell'istogramma del ritardo del loop del server."""
+    try:
+        response = await client.get(f"{url}/metrics")
+        response.raise_for_status()
+    except httpx.HTTPError:
+        return None
+    snapshot: Dict[str, float] = {}
+    for family in text_string_to_metric_families(response.text):
+        if family.name != LAG_METRIC:
+            continue
+        for sample in family.samples:
+            if sample.name.endswith("_bucket"):
+                key = f"le={sample.labels['le']}"
+                snapshot[key] = snapshot.get(key, 0.0) + sample.value
+            elif sample.name.endswith(("_sum", "_count")):
+                key = sample.name.rsplit("_", 1)[1]
+                snapshot[key] = snapshot.get(key, 0.0) + sample.value
+    return snapshot or None
+
+
+def lag_delta(before: Optional[Dict[str, float]], after: Optional[Dict[str, float]]) -> Optional[Dict[str, Any]]:
+    """Media e quantili approssimati (estremo superiore del bucket) durante il test."""
+    if not before or not after:
+        return None
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return None
+    buckets = sorted(
+        (float(key[3:]), after[key] - before.get(key, 0.0)) for key in after if key.startswith("le=")
+    )
+    result: Dict[str, Any] = {"samples": int(count), "mean": round((after["sum"] - before["sum"]) / count, 4)}
+    for q in (0.5, 0.99):
+        bound = next((le for le, cumulative in buckets if cumulative >= q * count), None)
+        result[f"p{int(q * 100)}_le"] = bound
+    result["max_le"] = next((le for le, cumulative in buckets if cumulative >= count), None)
+    return result
+
+
+async def monitor_lag(samples: List[float], interval: float = 0.1) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+async def run_load(args: argparse.Namespace, documents: Dict[str, bytes]) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results: List[Dict[str, Any]] = []
+    schedule = itertools.cycle(itertools.product(args.endpoints, documents.items()))
+    issued = itertools.count()
+    client_lag: List[float] = []
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        lag_before = await scrape_lag(client, args.url)
+
+        async def worker() -> None:
+            while next(issued) < args.requests:
+                endpoint, (filename, content) = next(schedule)
+                if not args.same_content:
+                    content = content + f"\n% load-test {uuid.uuid4()}\n".encode("ascii")
+                reports = args.batch_size if endpoint == BATCH_ENDPOINT else 1
+                uploads = [content]
+                if endpoint == BATCH_ENDPOINT and not args.same_content:
+                    uploads += [content + f"\n% load-test {uuid.uuid4()}\n".encode("ascii") for _ in range(reports - 1)]
+                elif endpoint == BATCH_ENDPOINT:
+                    uploads *= reports
+                started = time.perf_counter()
+                record = {"endpoint": endpoint, "pages": args.pages * reports}
+                try:
+                    response = await client.post(
+                        f"{args.url}/morfeo/{endpoint}",
+                        files=[("files", (filename, upload, "application/pdf")) for upload in uploads],
+                        data={"ids": [f"report-{n}" for n in range(reports)]} if endpoint == BATCH_ENDPOINT else None,
+                    )
+                    record["status"] = response.status_code
+                    if endpoint == BATCH_ENDPOINT and response.status_code == 200:
+                        record["failed_reports"] = response.json()["summary"]["failed"]
+                    record["timings"] = parse_server_timing(response.headers.get("server-timing", ""))
+                except httpx.HTTPError as e:
+                    record["status"] = type(e).__name__
+                record["seconds"] = time.perf_counter() - started
+                results.append(record)
+
+        lag_task = asyncio.create_task(monitor_lag(client_lag))
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+
+        lag_after = await scrape_lag(client, args.url)
+
+    return {
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "requests": len(results),
+        "elapsed_seconds": round(elapsed, 3),
+        "overall": summarize(results, elapsed),
+        "endpoints": {
+            endpoint: summarize([r for r in results if r["endpoint"] == endpoint], elapsed)
+            for endpoint in args.endpoints
+        },
+        "server_event_loop_lag": lag_delta(lag_before, lag_after),
+        "client_event_loop_lag": latency_summary(client_lag),
+    }
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    ok = [r for r in results if r["status"] == 200]
+    stages: Dict[str, List[float]] = defaultdict(list)
+    for record in ok:
+        for stage, seconds in record.get("timings", {}).items():
+            stages[stage].append(seconds)
+    return {
+        "status": dict(Counter(str(r["status"]) for r in results)),
+        "latency_seconds": latency_summary([r["seconds"] for r in ok]),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else None,
+        "pages_per_second": round(sum(r["pages"] for r in ok) / elapsed, 3) if elapsed else None,
+        "failed_reports": sum(r.get("failed_reports", 0) for r in ok),
+        "stage_mean_seconds": {stage: round(sum(values) / len(values), 4) for stage, values in sorted(stages.items())},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="PDF da caricare; se assente viene generato un referto scansionato")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--endpoints", nargs="+", default=["extract-tables", "extract-medical-data"],
+                        choices=["extract-tables", "extract-medical-data", BATCH_ENDPOINT])
+    parser.add_argument("--batch-size", type=int, default=16, help=f"referti per richiesta di {BATCH_ENDPOINT}")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=64, help="richieste totali")
+    parser.add_argument("--pages", type=int, default=4, help="pagine del referto sintetico")
+    parser.add_argument("--rows-per-page", type=int, default=20)
+    parser.add_argument("--same-content", action="store_true", help="non variare il contenuto degli upload")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--output", help="scrive qui il risultato JSON oltre a stamparlo")
+    args = parser.parse_args()
+
+    documents = {path: open(path, "rb").read() for path in args.files}
+    if not documents:
+        documents = {f"scanned-{args.pages}p.pdf": build_scanned_report_pdf(args.pages, args.rows_per_page)}
+
+    report = asyncio.run(run_load(args, documents))
+    serialized = json.dumps(report, indent=2)
+    print(serialized)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(serialized)
+
+
+if __name__ == "__main__":
+    main()
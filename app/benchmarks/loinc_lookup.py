@@ -0,0 +1,221 @@
+"""
+Benchmark dell'indice LOINC locale su una tabella sintetica nel formato di `Loinc.csv`.
+
+La tabella contiene gli esami di `SAMPLE_GROUND_TRUTH` (con codici fittizi, varianti
+per sistema, proprietà e tempo come nei dati reali) più `--codes` codici di
+riempimento, una variante linguistica italiana e un file dei pannelli. Si misurano
+compilazione dell'indice, lettura del file JSON, righe al millisecondo con nomi esatti e
+con nomi rovinati dall'OCR (ricerca per trigrammi), a memoizzazione fredda e calda, e
+la quota di righe mappate sul codice atteso. Uso:
+
+    python -m app.benchmarks.loinc_lookup [--codes 100000] [--rows 20000]
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from app.services.loinc_index import LoincIndex, _sources_signature, build_index, read_index, write_index
+from app.tests.ground_truth import SAMPLE_GROUND_TRUTH
+
+LOINC_COLUMNS = [
+    "LOINC_NUM", "COMPONENT", "PROPERTY", "TIME_ASPCT", "SYSTEM", "SCALE_TYP",
+    "METHOD_TYP", "CLASS", "CLASSTYPE", "STATUS", "COMMON_TEST_RANK",
+]
+
+# Esame della ground truth → (COMPONENT, PROPERTY, SYSTEM, nome della variante italiana)
+ANALYTES = {
+    ("FOLATI", "ng/mL"): ("Folate", "MCnc", "Ser/Plas", "Folato"),
+    ("VITAMINA B 12 (COBALAMINA)", "pg/mL"): ("Cobalamins", "MCnc", "Ser/Plas", "Cobalamine"),
+    ("OMOCISTEINA", "mmol/L"): ("Homocysteine", "SCnc", "Ser/Plas", "Omocisteina"),
+    ("FT3", "pg/mL"): ("Triiodothyronine.free", "MCnc", "Ser/Plas", "Triiodotironina libera"),
+    ("FT4 (TIROXINA LIB.)", "ng/dL"): ("Thyroxine.free", "MCnc", "Ser/Plas", "Tiroxina libera"),
+    ("TSH", "mcU/mL"): ("Thyrotropin", "ACnc", "Ser/Plas", "Tireotropina"),
+    ("GLOBULI BIANCHI", "10^3/mm^3"): ("Leukocytes", "NCnc", "Bld", "Leucociti"),
+    ("NEUTROFILI", "%"): ("Neutrophils/100 leukocytes", "NFr", "Bld", "Neutrofili/100 leucociti"),
+    ("LINFOCITI", "%"): ("Lymphocytes/100 leukocytes", "NFr", "Bld", "Linfociti/100 leucociti"),
+    ("MONOCITI", "%"): ("Monocytes/100 leukocytes", "NFr", "Bld", "Monociti/100 leucociti"),
+    ("EOSINOFILI", "%"): ("Eosinophils/100 leukocytes", "NFr", "Bld", "Eosinofili/100 leucociti"),
+    ("BASOFILI", "%"): ("Basophils/100 leukocytes", "NFr", "Bld", "Basofili/100 leucociti"),
+    ("NEUTROFILI", "10^3/mm^3"): ("Neutrophils", "NCnc", "Bld", "Neutrofili"),
+    ("LINFOCITI", "10^3/mm^3"): ("Lymphocytes", "NCnc", "Bld", "Linfociti"),
+    ("MONOCITI", "10^3/mm^3"): ("Monocytes", "NCnc", "Bld", "Monociti"),
+    ("EOSINOFILI", "10^3/mm^3"): ("Eosinophils", "NCnc", "Bld", "Eosinofili"),
+    ("BASOFILI", "10^3/mm^3"): ("Basophils", "NCnc", "Bld", "Basofili"),
+    ("GLOBULI ROSSI", "10^6/mm^3"): ("Erythrocytes", "NCnc", "Bld", "Eritrociti"),
+    ("EMOGLOBINA", "g/dL"): ("Hemoglobin", "MCnc", "Bld", "Emoglobina"),
+    ("EMATOCRITO", "%"): ("Hematocrit", "VFr", "Bld", "Ematocrito"),
+    ("MCV", "um^3"): ("Erythrocyte mean corpuscular volume", "EntVol", "RBC", "Volume corpuscolare medio"),
+    ("MCH", "pg"): ("Erythrocyte mean corpuscular hemoglobin", "EntMass", "RBC", "Emoglobina corpuscolare media"),
+    ("MCHC", "g/dL"): (
+        "Erythrocyte mean corpuscular hemoglobin concentration", "MCnc", "RBC",
+        "Concentrazione emoglobinica corpuscolare media",
+    ),
+    ("RDW-CV", "%"): ("Erythrocyte distribution width", "Ratio", "RBC", "Ampiezza di distribuzione eritrocitaria"),
+    ("RDW-SD", "%"): ("Erythrocyte distribution width", "Ratio", "RBC", "Ampiezza di distribuzione eritrocitaria"),
+    ("PIASTRINE", "10^3/mm^3"): ("Platelets", "NCnc", "Bld", "Piastrine"),
+    ("MPV", "um^3"): ("Platelet mean volume", "EntVol", "Bld", "Volume piastrinico medio"),
+    ("PDW", "10GSD"): ("Platelet distribution width", "Ratio", "Bld", "Ampiezza di distribuzione piastrinica"),
+    ("PCT", "%"): ("Plateletcrit", "VFr", "Bld", "Piastrinocrito"),
+    ("COLESTEROLO HDL", "mg/dl"): ("Cholesterol.in HDL", "MCnc", "Ser/Plas", "Colesterolo HDL"),
+    ("COLESTEROLO TOTALE", "mg/dl"): ("Cholesterol", "MCnc", "Ser/Plas", "Colesterolo"),
+    ("TRIGLICERIDI", "mg/dl"): ("Triglyceride", "MCnc", "Ser/Plas", "Trigliceridi"),
+    ("SIDEREMIA", "mcg/dl"): ("Iron", "MCnc", "Ser/Plas", "Ferro"),
+    ("GOT/AST TRANSAMINASI", "U/l"): ("Aspartate aminotransferase", "CCnc", "Ser/Plas", "Aspartato aminotransferasi"),
+    ("GPT/ALT TRANSAMINASI", "U/l"): ("Alanine aminotransferase", "CCnc", "Ser/Plas", "Alanina aminotransferasi"),
+    ("POTASSIEMIA", "mmol/L"): ("Potassium", "SCnc", "Ser/Plas", "Potassio"),
+    ("SODIEMIA", "mmol/L"): ("Sodium", "SCnc", "Ser/Plas", "Sodio"),
+    ("GLICEMIA", "mg/dl"): ("Glucose", "MCnc", "Ser/Plas", "Glucosio"),
+    ("INSULINA", "mU/ml"): ("Insulin", "ACnc", "Ser/Plas", "Insulina"),
+    ("HCV", "S/CO"): ("Hepatitis C virus Ab", "ACnc", "Ser", "Virus epatite C Ab"),
+}
+# Pannelli sintetici: codice → COMPONENT dei membri
+PANELS = {
+    "90001-1": ["Leukocytes", "Erythrocytes", "Hemoglobin", "Hematocrit", "Platelets", "Neutrophils"],
+    "90002-2": ["Cholesterol", "Cholesterol.in HDL", "Triglyceride"],
+    "90003-3": ["Thyrotropin", "Thyroxine.free", "Triiodothyronine.free"],
+}
+# Varianti dello stesso esame che non devono essere scelte: (PROPERTY, SYSTEM, TIME_ASPCT,
+# SCALE_TYP), None = come l'esame atteso
+DISTRACTORS = [("SCnc", "Urine", "Pt", "Qn"), ("MCnc", "Urine", "24H", "Qn"), ("MCnc", "CSF", "Pt", "Qn"), (None, None, "Pt", "Ord")]
+# Sillabe dei nomi di riempimento (consonante + vocale, con coda facoltativa)
+SYLLABLES = [c + v + t for c in "bcdfghlmnprstvxz" for v in "aeiouy" for t in ("", "n", "r", "s", "l")]
+
+
+def write_sources(directory: str, filler_codes: int, seed: int = 0) -> Tuple[Dict[str, str], Dict[Tuple[str, str], str]]:
+    """Scrive i CSV sintetici; restituisce le sorgenti e il codice atteso per ogni esame."""
+    rng = random.Random(seed)
+    rows: List[Dict[str, Any]] = []
+    variants: List[Dict[str, str]] = []
+    expected: Dict[Tuple[str, str], str] = {}
+    by_identity: Dict[Tuple[str, str, str], str] = {}
+
+    def add(component: str, prop: str, system: str, time_aspect: str = "Pt", scale: str = "Qn", rank: int = 0) -> str:
+        code = f"{10000 + len(rows)}-{len(rows) % 10}"
+        rows.append({
+            "LOINC_NUM": code, "COMPONENT": component, "PROPERTY": prop, "TIME_ASPCT": time_aspect,
+            "SYSTEM": system, "SCALE_TYP": scale, "METHOD_TYP": "", "CLASS": "CHEM", "CLASSTYPE": "1",
+            "STATUS": "ACTIVE", "COMMON_TEST_RANK": rank,
+        })
+        return code
+
+    for key, (component, prop, system, italian) in ANALYTES.items():
+        identity = (component, prop, system)
+        if identity not in by_identity:
+            for distractor_prop, distractor_system, time_aspect, scale in DISTRACTORS:
+                add(component, distractor_prop or prop, distractor_system or system, time_aspect, scale, len(rows) + 1000)
+            by_identity[identity] = add(component, prop, system, rank=len(rows) + 1)
+            variants.append({"LOINC_NUM": by_identity[identity], "COMPONENT": italian})
+        expected[key] = by_identity[identity]
+
+    for _ in range(filler_codes):
+        words = [
+            "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+            for _ in range(rng.randint(1, 3))
+        ]
+        add(" ".join(words).capitalize(), rng.choice(["MCnc", "SCnc", "NCnc", "ACnc"]), rng.choice(["Ser/Plas", "Urine", "Bld"]))
+
+    panel_rows = []
+    codes_by_component = {component: code for (component, _, _), code in by_identity.items()}
+    for panel, components in PANELS.items():
+        rows.append({**rows[0], "LOINC_NUM": panel, "COMPONENT": "Panel", "CLASS": "PANEL.HEM/BC"})
+        panel_rows += [{"ParentLoinc": panel, "Loinc": codes_by_component[c]} for c in components]
+
+    sources = {
+        "table": _write_csv(os.path.join(directory, "Loinc.csv"), LOINC_COLUMNS, rows),
+        "linguistic_variant": _write_csv(
+            os.path.join(directory, "itIT18LinguisticVariant.csv"), ["LOINC_NUM", "COMPONENT"], variants
+        ),
+        "panels": _write_csv(os.path.join(directory, "PanelsAndForms.csv"), ["ParentLoinc", "Loinc"], panel_rows),
+    }
+    return sources, expected
+
+
+def ocr_noise(name: str, rng: random.Random) -> str:
+    """Nome con un carattere perso, come nelle letture OCR imperfette."""
+    if len(name) < 6:
+        return name
+    position = rng.randrange(1, len(name) - 1)
+    return name[:position] + name[position + 1:]
+
+
+def rows_per_ms(index: LoincIndex, fields: List[Dict[str, str]], cold: bool) -> float:
+    batch = len(SAMPLE_GROUND_TRUTH["groundTruth"])
+    if not cold:
+        index.annotate([dict(field) for field in fields[:batch * 10]])
+    start = time.perf_counter()
+    for offset in range(0, len(fields), batch):
+        if cold:
+            index._memo.clear()
+        index.annotate(fields[offset:offset + batch])
+    return round(len(fields) / ((time.perf_counter() - start) * 1000), 1)
+
+
+def hit_rate(index: LoincIndex, expected: Dict[Tuple[str, str], str], name: Callable[[str], str]) -> float:
+    hits = sum(index.lookup(name(test), unit) == code for (test, unit), code in expected.items())
+    return round(hits / len(expected), 3)
+
+
+def benchmark(filler_codes: int, rows: int) -> Dict[str, Any]:
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as directory:
+        sources, expected = write_sources(directory, filler_codes)
+        start = time.perf_counter()
+        data = build_index(sources, _sources_signature(sources))
+        build_seconds = time.perf_counter() - start
+
+        index_path = os.path.join(directory, "loinc-index.json")
+        write_index(data, index_path)
+        start = time.perf_counter()
+        index = LoincIndex(read_index(index_path))
+        load_seconds = time.perf_counter() - start
+        index_bytes = os.path.getsize(index_path)
+
+    tests = [(field["field name"], field["field unit of measure"]) for field in SAMPLE_GROUND_TRUTH["groundTruth"]]
+    exact = [
+        {"field_name": test, "field_unit_of_measure": unit}
+        for test, unit in (tests * (rows // len(tests) + 1))[:rows]
+    ]
+    noisy = [{**field, "field_name": ocr_noise(field["field_name"], rng)} for field in exact]
+    noisy_names = {test: ocr_noise(test, random.Random(test)) for test, _ in tests}
+
+    annotated = index.annotate([dict(field) for field in exact[:len(tests)]])
+    return {
+        "codes": index.size,
+        "names": len(index.keys),
+        "build_seconds": round(build_seconds, 3),
+        "index_load_seconds": round(load_seconds, 3),
+        "index_mb": round(index_bytes / 1024 / 1024, 1),
+        "rows": rows,
+        "exact_rows_per_ms_cold": rows_per_ms(index, exact, cold=True),
+        "exact_rows_per_ms_warm": rows_per_ms(index, exact, cold=False),
+        "ocr_noise_rows_per_ms_cold": rows_per_ms(index, noisy, cold=True),
+        "ocr_noise_rows_per_ms_warm": rows_per_ms(index, noisy, cold=False),
+        "hit_rate": hit_rate(index, expected, lambda test: test),
+        "ocr_noise_hit_rate": hit_rate(index, expected, noisy_names.get),
+        "with_panel": sum(field["belonging_panel_LOINC_value"] != "N/A" for field in annotated),
+    }
+
+
+def _write_csv(path: str, columns: List[str], rows: List[Dict[str, Any]]) -> str:
+    with open(path, "w", newline="", encoding="utf-8") as handle:
+        writer = csv.DictWriter(handle, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codes", type=int, default=100_000, help="codici di riempimento della tabella sintetica")
+    parser.add_argument("--rows", type=int, default=20_000, help="righe da mappare per ogni misura")
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.codes, args.rows), indent=2))
+
+
+if __name__ == "__main__":
+    main()
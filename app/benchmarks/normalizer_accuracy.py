@@ -0,0 +1,60 @@
+"""
+Verifica il normalizzatore a regole contro `SAMPLE_GROUND_TRUTH`.
+
+Le righe della ground truth vengono riportate nel formato del referto (virgola
+decimale, range "low - high", "< x", "> x") e passate nella forma prodotta da
+`clean_table_data_json`. Uso:
+
+    python -m app.benchmarks.normalizer_accuracy
+"""
+import json
+import sys
+from typing import Any, Dict
+
+from app.benchmarks.fixtures import REPORT_HEADERS, ground_truth_rows
+from app.services.medical_normalizer import MedicalRowNormalizer
+from app.tests.ground_truth import SAMPLE_GROUND_TRUTH
+
+GROUND_TRUTH_KEYS = {
+    "field name": "field_name",
+    "field value": "field_value",
+    "field unit of measure": "field_unit_of_measure",
+    "reference_range_low": "reference_range_low",
+    "reference_range_high": "reference_range_high",
+}
+
+
+def camel_case(header: str) -> str:
+    words = header.lower().split()
+    return words[0] + "".join(word.capitalize() for word in words[1:])
+
+
+def evaluate() -> Dict[str, Any]:
+    keys = [camel_case(header) for header in REPORT_HEADERS]
+    rows = [dict(zip(keys, row)) for row in ground_truth_rows()]
+    fields, unresolved = MedicalRowNormalizer().normalize(rows)
+
+    mismatches = []
+    for field, expected in zip(fields, SAMPLE_GROUND_TRUTH["groundTruth"]):
+        expected = {GROUND_TRUTH_KEYS[k]: v for k, v in expected.items()}
+        if field is not None and field != expected:
+            mismatches.append({"expected": expected, "actual": field})
+
+    resolved = len(rows) - len(unresolved)
+    return {
+        "rows": len(rows),
+        "resolved": resolved,
+        "unresolved": len(unresolved),
+        "exact_match": resolved - len(mismatches),
+        "mismatches": mismatches,
+    }
+
+
+def main() -> None:
+    report = evaluate()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    sys.exit(1 if report["mismatches"] or report["unresolved"] else 0)
+
+
+if __name__ == "__main__":
+    main()
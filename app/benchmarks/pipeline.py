@@ -0,0 +1,269 @@
+"""
+Benchmark end-to-end della pipeline senza rete, con accuratezza rispetto alla ground truth.
+
+Due referti sintetici costruiti da `SAMPLE_GROUND_TRUTH`: uno nativo (percorso text
+layer) e uno scansionato (solo immagini, percorso vision). Il modello è sostituito da
+`LLMBackend`: "oracle" risponde con le righe attese, "record" chiama il provider e
+salva le risposte in una cassetta, "replay" rilegge la cassetta. Per ogni referto si
+misurano tempo totale e per fase, pagine al secondo, chiamate al modello e
+precisione/richiamo sui campi (nome, attributo, valore); alla fine il picco di RSS del
+processo principale e dei processi del CPU executor. Con --engine si confrontano i
+motori di estrazione (es. "tesseract" contro "llm" sul referto scansionato). Uso:
+
+    python -m app.benchmarks.pipeline [--pages 8] [--repeat 3] [--llm oracle|replay|record]
+        [--engine llm|tesseract|auto] [--cassette cassette.json] [--output results.json]
+        [--baseline previous.json]
+
+Con --baseline stampa le differenze rispetto a un risultato precedente (es. di un
+altro commit) ed esce con codice 1 se precisione o richiamo peggiorano.
+"""
+import argparse
+import asyncio
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import UploadFile
+
+from app.benchmarks.fixtures import (
+    REPORT_HEADERS,
+    build_lab_report_pdf,
+    build_scanned_report_pdf,
+    ground_truth_rows,
+    report_page_rows,
+)
+from app.benchmarks.llm_backend import LLMBackend, image_key
+from app.benchmarks.normalizer_accuracy import GROUND_TRUTH_KEYS
+from app.core.config import settings
+from app.services import render_worker
+from app.services.cache_service import result_cache
+from app.services.cpu_executor import cpu_executor
+from app.services.extraction_engines import ENGINE_MODES
+from app.services.ingestion import close_uploads, ingest_uploads
+from app.services.metrics import collect_timings
+from app.services.structure_data_service import StructureDataService
+from app.tests.ground_truth import SAMPLE_GROUND_TRUTH
+
+def fields_by_row() -> Dict[Tuple[str, ...], Dict[str, str]]:
+    """Campo della ground truth (formato di `MedicalFieldInfo`) per ogni riga stampata."""
+    return {
+        tuple(row): {GROUND_TRUTH_KEYS[key]: value for key, value in field.items()}
+        for row, field in zip(ground_truth_rows(), SAMPLE_GROUND_TRUTH["groundTruth"])
+    }
+
+
+def expected_fields(pages: int, rows_per_page: int) -> List[Dict[str, str]]:
+    """Campi attesi, nell'ordine del referto sintetico."""
+    by_row = fields_by_row()
+    return [
+        by_row[tuple(row)]
+        for page_number in range(1, pages + 1)
+        for row in report_page_rows(page_number, rows_per_page)
+    ]
+
+
+def field_facts(fields: List[Dict[str, str]]) -> Counter:
+    """
+    Multiinsieme di (nome, attributo, valore): lo stesso esame può comparire più volte.
+    Si confrontano solo gli attributi della ground truth (non i codici LOINC).
+    """
+    attributes = set(GROUND_TRUTH_KEYS.values()) - {"field_name"}
+    return Counter(
+        (field["field_name"].strip().upper(), attribute, str(field.get(attribute, "")).strip())
+        for field in fields
+        for attribute in attributes
+    )
+
+
+def accuracy(actual: List[Dict[str, str]], expected: List[Dict[str, str]]) -> Dict[str, Any]:
+    actual_facts, expected_facts = field_facts(actual), field_facts(expected)
+    correct = sum((actual_facts & expected_facts).values())
+    return {
+        "fields": len(actual),
+        "expected_fields": len(expected),
+        "precision": round(correct / sum(actual_facts.values()), 4) if actual_facts else 0.0,
+        "recall": round(correct / sum(expected_facts.values()), 4) if expected_facts else 0.0,
+        "missing": sorted((expected_facts - actual_facts).elements())[:20],
+        "unexpected": sorted((actual_facts - expected_facts).elements())[:20],
+    }
+
+
+def oracle_images(content: bytes, rows_per_page: int) -> Dict[str, Tuple[int, List[Dict[str, Any]]]]:
+    """
+    Indice delle immagini che la pipeline invierà al modello: ogni pagina viene
+    renderizzata come farebbe il CPU executor e i suoi ritagli associati alle sue righe.
+    """
+    policy = StructureDataService().ocr_service.render_policy
+    images = {}
+    for page_number, size in enumerate(render_worker.pdf_page_sizes(content), start=1):
+        dpi = policy.plan_pdf_page(*size)["dpi"]
+        rendered = render_worker.render_pdf_page(content, page_number, dpi, policy.engine, policy)
+        tables = [{"headers": REPORT_HEADERS, "data": report_page_rows(page_number, rows_per_page)}]
+        crops = rendered.get("regions") or ([rendered] if rendered.get("data_url") else [])
+        for position, crop in enumerate(crops):
+            images[image_key(crop["data_url"])] = (position, tables)
+    return images
+
+
+async def run_fixture(
+    service: StructureDataService,
+    name: str,
+    content: bytes,
+    expected: List[Dict[str, str]],
+    backend: LLMBackend,
+    repeat: int,
+    engine: Optional[str] = None,
+) -> Dict[str, Any]:
+    async def process() -> List[Dict[str, str]]:
+        uploads = await ingest_uploads([UploadFile(BytesIO(content), filename=name)])
+        try:
+            return (await service.extract_medical_data(uploads, engine=engine))[0]
+        finally:
+            close_uploads(uploads)
+
+    # Giro di riscaldamento escluso dalle misure (avvio dei processi, import nei worker)
+    await process()
+    runs = []
+    fields: List[Dict[str, str]] = []
+    for _ in range(repeat):
+        calls_before = dict(backend.calls)
+        started = time.perf_counter()
+        with collect_timings() as timings:
+            fields = await process()
+        runs.append({
+            "seconds": time.perf_counter() - started,
+            "stages": timings,
+            "llm_calls": {kind: backend.calls[kind] - calls_before[kind] for kind in backend.calls},
+        })
+
+    pages = len(render_worker.pdf_page_sizes(content))
+    seconds = [run["seconds"] for run in runs]
+    median = statistics.median(seconds)
+    stages = sorted({stage for run in runs for stage in run["stages"]})
+    return {
+        "fixture": name,
+        "pages": pages,
+        "bytes": len(content),
+        "seconds": {"best": round(min(seconds), 4), "median": round(median, 4), "runs": [round(s, 4) for s in seconds]},
+        "pages_per_second": round(pages / median, 2) if median else None,
+        "stages": {
+            stage: round(statistics.median(run["stages"].get(stage, 0.0) for run in runs), 4)
+            for stage in stages
+        },
+        "llm_calls": runs[-1]["llm_calls"],
+        "accuracy": accuracy(fields, expected),
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    fixtures = {
+        f"native-{args.pages}p.pdf": build_lab_report_pdf(args.pages, args.rows_per_page),
+        f"scanned-{args.pages}p.pdf": build_scanned_report_pdf(args.pages, args.rows_per_page),
+    }
+    expected = expected_fields(args.pages, args.rows_per_page)
+
+    images: Dict[str, Tuple[int, List[Dict[str, Any]]]] = {}
+    if args.llm == "oracle":
+        for content in fixtures.values():
+            images.update(oracle_images(content, args.rows_per_page))
+    backend = LLMBackend(args.llm, args.cassette, images=images, fields=fields_by_row())
+
+    # Ogni ripetizione deve eseguire davvero la pipeline
+    result_cache.enabled = False
+    service = StructureDataService()
+    cpu_executor.start()
+    backend.install()
+    try:
+        results = [
+            await run_fixture(service, name, content, expected, backend, args.repeat, args.engine)
+            for name, content in fixtures.items()
+        ]
+    finally:
+        backend.uninstall()
+        backend.save()
+        cpu_executor.shutdown()
+
+    return {
+        "commit": _git_commit(),
+        "llm": args.llm,
+        "engine": args.engine or settings.EXTRACTION_ENGINE,
+        "settings": {
+            key: getattr(settings, key)
+            for key in (
+                "CPU_WORKERS", "LLM_PAGES_PER_CALL", "TEXT_LAYER_ENABLED", "NORMALIZER_ENABLED",
+                "RENDER_ENGINE", "IMAGE_FORMAT", "TABLE_DETECTION_ENABLED", "PAGE_FILTER_ENABLED",
+            )
+            if hasattr(settings, key)
+        },
+        "results": results,
+        "peak_rss_mb": {
+            "main": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "workers": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        },
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> bool:
+    """Stampa le differenze per referto; False se l'accuratezza è peggiorata."""
+    previous = {result["fixture"]: result for result in baseline.get("results", [])}
+    ok = True
+    for result in report["results"]:
+        old = previous.get(result["fixture"])
+        if old is None:
+            continue
+        old_seconds, new_seconds = old["seconds"]["median"], result["seconds"]["median"]
+        change = (new_seconds - old_seconds) / old_seconds * 100 if old_seconds else 0.0
+        print(
+            f"{result['fixture']}: {old_seconds:.3f}s -> {new_seconds:.3f}s ({change:+.1f}%), "
+            f"precision {old['accuracy']['precision']} -> {result['accuracy']['precision']}, "
+            f"recall {old['accuracy']['recall']} -> {result['accuracy']['recall']}",
+            file=sys.stderr,
+        )
+        for metric in ("precision", "recall"):
+            if result["accuracy"][metric] < old["accuracy"][metric]:
+                ok = False
+    return ok
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=8, help="pagine dei referti sintetici")
+    parser.add_argument("--rows-per-page", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--llm", choices=["oracle", "replay", "record"], default="oracle")
+    parser.add_argument("--engine", choices=ENGINE_MODES, help="motore di estrazione (default EXTRACTION_ENGINE)")
+    parser.add_argument("--cassette", help="file JSON delle risposte registrate (replay/record)")
+    parser.add_argument("--output", help="scrive qui il risultato JSON oltre a stamparlo")
+    parser.add_argument("--baseline", help="risultato JSON precedente da confrontare")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(args))
+    serialized = json.dumps(report, indent=2, ensure_ascii=False)
+    print(serialized)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(serialized)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as handle:
+            if not compare(report, json.load(handle)):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
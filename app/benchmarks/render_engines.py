@@ -0,0 +1,90 @@
+"""
+Confronto tra i motori di rendering PyMuPDF e pdf2image su referti multipagina.
+
+Le pagine passano dallo stesso percorso del servizio: `PDFService.iter_pdf_pages`,
+che invia `render_pdf_page` ai processi del CPU executor con la policy configurata.
+Ogni motore gira in un processo separato con il proprio pool, così il picco di RSS
+misurato (quello dei processi di rendering) riguarda solo quel motore. Uso:
+
+    python -m app.benchmarks.render_engines [report.pdf ...] [--pages 12] [--repeat 3]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List
+
+from app.benchmarks.fixtures import build_lab_report_pdf
+from app.services import render_worker
+from app.services.cpu_executor import cpu_executor
+from app.services.ocr_service import PDFService
+from app.services.render_policy import RenderPolicy
+
+
+async def _render_all(service: PDFService, file_content: bytes, repeat: int) -> Dict[str, Any]:
+    timings = []
+    pages = total_bytes = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pages = total_bytes = 0
+        async for page in service.iter_pdf_pages("benchmark.pdf", file_content):
+            pages += 1
+            total_bytes += page.get("bytes", 0)
+        timings.append(time.perf_counter() - start)
+    return {"pages": pages, "timings": timings, "encoded_bytes": total_bytes}
+
+
+def _run_engine(engine: str, file_content: bytes, repeat: int) -> Dict[str, Any]:
+    policy = RenderPolicy.from_settings().model_copy(update={"engine": engine})
+    service = PDFService(render_policy=policy)
+    try:
+        result = asyncio.run(_render_all(service, file_content, repeat))
+    finally:
+        # Attende l'uscita dei processi del pool: solo dopo RUSAGE_CHILDREN li include
+        cpu_executor.shutdown(wait=True)
+
+    best = min(result["timings"])
+    return {
+        "engine": engine,
+        "pages": result["pages"],
+        "cpu_workers": cpu_executor.max_workers,
+        "best_seconds": round(best, 4),
+        "pages_per_second": round(result["pages"] / best, 2) if best else None,
+        "encoded_bytes": result["encoded_bytes"],
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def benchmark(file_content: bytes, engines: List[str], repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for engine in engines:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            try:
+                results.append(pool.submit(_run_engine, engine, file_content, repeat).result())
+            except Exception as e:
+                results.append({"engine": engine, "error": str(e)})
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="PDF da usare; se assente viene generato un referto sintetico")
+    parser.add_argument("--pages", type=int, default=12, help="pagine del referto sintetico")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--engines", nargs="+", default=list(render_worker.RENDER_ENGINES))
+    args = parser.parse_args()
+
+    inputs = {path: open(path, "rb").read() for path in args.files}
+    if not inputs:
+        inputs = {f"synthetic-{args.pages}p.pdf": build_lab_report_pdf(pages=args.pages)}
+
+    for name, content in inputs.items():
+        print(json.dumps({"file": name, "results": benchmark(content, args.engines, args.repeat)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
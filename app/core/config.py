@@ -13,6 +13,139 @@ class Settings(BaseSettings):
     HUGGINGFACE_API_KEY: Optional[str] = None
     UNSTRUCTURED_API_KEY: Optional[str] = None
     HUGGING_FACE_HUB_TOKEN: Optional[str] = None
+    OPENAI_BASE_URL: Optional[str] = None
+
+    # Pool di connessioni HTTP condiviso verso il provider LLM
+    LLM_MAX_CONNECTIONS: int = 100
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    LLM_KEEPALIVE_EXPIRY: float = 30.0
+    LLM_HTTP2: bool = True
+
+    # Pool di processi per rasterizzazione ed encoding delle pagine
+    CPU_WORKERS: Optional[int] = None
+    CPU_QUEUE_SIZE: int = 64
+
+    # Modello vision e policy di rendering delle pagine
+    VISION_MODEL: str = "gpt-4o"
+    STRUCTURE_MODEL: str = "gpt-4o"
+    RENDER_ENGINE: str = "pymupdf"
+    RENDER_TARGET_LONG_EDGE: int = 2048
+    RENDER_MIN_DPI: int = 72
+    RENDER_MAX_DPI: int = 300
+    RENDER_IMAGE_DETAIL: str = "auto"
+
+    # Preprocessing delle pagine e formato delle immagini ("png", "jpeg", "webp")
+    IMAGE_GRAYSCALE: bool = True
+    IMAGE_DESKEW: bool = True
+    IMAGE_AUTOCROP: bool = True
+    IMAGE_CONTRAST: bool = True
+    IMAGE_FORMAT: str = "png"
+    IMAGE_QUALITY: int = 85
+
+    # Ritaglio delle regioni tabellari: le pagine senza tabelle non vengono inviate al modello
+    TABLE_DETECTION_ENABLED: bool = True
+
+    # Pagine bianche e duplicate: distanza di Hamming massima tra dHash a 256 bit (< 0
+    # disattiva la deduplicazione) e quota massima di inchiostro non coincidente
+    PAGE_FILTER_ENABLED: bool = True
+    PAGE_BLANK_MAX_INK: float = 0.001
+    PAGE_DEDUP_MAX_DISTANCE: int = 32
+    PAGE_DEDUP_MAX_MISMATCH: float = 0.005
+
+    # Chiamate vision: "per_page" (concorrenti, a gruppi di pagine) o "single" (un'unica chiamata)
+    LLM_FANOUT_MODE: str = "per_page"
+    LLM_PAGES_PER_CALL: int = 1
+    LLM_MAX_CONCURRENCY: int = 16
+
+    # Motore di estrazione delle pagine renderizzate: "llm" (modello vision), "tesseract"
+    # (OCR locale) o "auto" (OCR locale, pagine sotto OCR_MIN_CONFIDENCE inoltrate al modello).
+    # Le pagine piccole vengono ingrandite fino a OCR_TARGET_LONG_EDGE px prima dell'OCR
+    EXTRACTION_ENGINE: str = "llm"
+    OCR_LANGUAGE: str = "ita+eng"
+    OCR_PSM: int = 6
+    OCR_MIN_CONFIDENCE: float = 0.8
+    OCR_TARGET_LONG_EDGE: int = 3000
+
+    # Scheduler delle chiamate al modello: budget al minuto (0 = nessun limite), coda
+    # massima di chiamate interattive in attesa (0 = illimitata) e nuovi tentativi
+    LLM_RPM_LIMIT: int = 0
+    LLM_TPM_LIMIT: int = 0
+    LLM_MAX_QUEUE: int = 200
+    LLM_MAX_RETRIES: int = 4
+    LLM_RETRY_BASE_DELAY: float = 1.0
+    LLM_RETRY_MAX_DELAY: float = 30.0
+
+    # Scadenze: timeout di ogni tentativo verso il modello, hedging oltre il percentile
+    # delle latenze recenti e scadenza complessiva delle richieste HTTP (0 = nessuna),
+    # allo scadere della quale si restituiscono le pagine completate
+    LLM_CALL_TIMEOUT: float = 180.0
+    LLM_HEDGE_ENABLED: bool = True
+    LLM_HEDGE_PERCENTILE: float = 95.0
+    LLM_HEDGE_MIN_SAMPLES: int = 20
+    REQUEST_DEADLINE_SECONDS: float = 120.0
+
+    # Risposte vision troncate dal limite di token: richieste di continuazione dall'ultima
+    # riga completa (0 = si tengono le righe lette fino all'interruzione)
+    LLM_MAX_CONTINUATIONS: int = 2
+
+    # Endpoint batch: pagine di referti diversi impacchettate fino a BATCH_PAGES_PER_CALL per
+    # chiamata vision (meno se le risposte osservate non starebbero nel limite di token) e
+    # righe da strutturare inviate al modello a blocchi di BATCH_STRUCTURE_ROWS
+    BATCH_PAGES_PER_CALL: int = 4
+    BATCH_STRUCTURE_ROWS: int = 100
+
+    # Template di layout per formato di referto, appresi dalle pagine lette dal modello
+    # (se la lettura locale con le colonne ricavate concorda su LAYOUT_TEMPLATE_MIN_AGREEMENT
+    # delle celle) e applicati dopo LAYOUT_TEMPLATE_MIN_SAMPLES campioni compatibili: le
+    # pagine di layout noto sono lette dal text layer o con Tesseract senza chiamare il modello.
+    # Disattivati di default: cambiano il motore che legge le pagine, vanno abilitati per scelta
+    LAYOUT_TEMPLATES_ENABLED: bool = False
+    LAYOUT_TEMPLATE_LEARNING: bool = False
+    LAYOUT_TEMPLATE_MIN_SAMPLES: int = 5
+    LAYOUT_TEMPLATE_MIN_AGREEMENT: float = 0.9
+    LAYOUT_TEMPLATE_REFRESH_SECONDS: float = 60.0
+
+    # Estrazione diretta dal text layer dei PDF nativi
+    TEXT_LAYER_ENABLED: bool = True
+    TEXT_LAYER_MIN_CHARS: int = 100
+
+    # Normalizzazione a regole delle righe (il modello riceve solo le righe ambigue)
+    NORMALIZER_ENABLED: bool = True
+
+    # Codici LOINC: tabella LOINC (Loinc.csv o LoincTableCore.csv), variante linguistica
+    # italiana, pannelli (PanelsAndForms.csv) e sinonimi del laboratorio (CSV name,loinc[,panel]).
+    # L'indice è compilato in LOINC_INDEX_PATH e ricompilato solo se le sorgenti cambiano
+    LOINC_ENABLED: bool = True
+    LOINC_TABLE_PATH: Optional[str] = None
+    LOINC_LINGUISTIC_VARIANT_PATH: Optional[str] = None
+    LOINC_PANELS_PATH: Optional[str] = None
+    LOINC_SYNONYMS_PATH: Optional[str] = None
+    LOINC_INDEX_PATH: str = ".cache/loinc-index.json"
+    LOINC_MIN_SIMILARITY: float = 0.6
+
+    # Database e job asincroni
+    DATABASE_URL: str = "sqlite:///./morfeo.db"
+    DB_AUTO_MIGRATE: bool = True
+    JOBS_DIR: str = ".jobs"
+    JOB_WORKERS: int = 2
+    JOB_POLL_INTERVAL: float = 2.0
+    JOB_LEASE_SECONDS: int = 900
+    JOB_MAX_ATTEMPTS: int = 3
+
+    # Cache dei risultati (LRU in memoria + SQLite su disco)
+    CACHE_ENABLED: bool = True
+    CACHE_PATH: str = ".cache/morfeo-results.sqlite3"
+    CACHE_MEMORY_ENTRIES: int = 256
+    CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    # Richieste identiche in corso nello stesso processo condividono un'unica esecuzione
+    SINGLE_FLIGHT_ENABLED: bool = True
+
+    # Acquisizione degli upload: soglia oltre cui si passa su disco e limiti (413)
+    INGEST_MEMORY_THRESHOLD: int = 1024 * 1024
+    INGEST_MAX_FILE_BYTES: int = 50 * 1024 * 1024
+    INGEST_MAX_REQUEST_BYTES: int = 200 * 1024 * 1024
+    INGEST_SPOOL_DIR: Optional[str] = None
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import JSON, Column, DateTime, ForeignKey, Integer, String, Text
+from sqlalchemy.orm import declarative_base, relationship
+
+Base = declarative_base()
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class PDFExtraction(Base):
+    """Risultato persistito di un'estrazione (vedi `app.schemas.pdf.PDFExtraction`)."""
+    __tablename__ = "pdf_extractions"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    filename = Column(String(1024), nullable=False)
+    extracted_data = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, default=utcnow)
+    updated_at = Column(DateTime(timezone=True), nullable=True, onupdate=utcnow)
+
+
+class ExtractionJob(Base):
+    """Job asincrono in coda: i file caricati restano su disco finché il job non termina."""
+    __tablename__ = "extraction_jobs"
+
+    id = Column(String(36), primary_key=True)
+    kind = Column(String(32), nullable=False)
+    status = Column(String(16), nullable=False, index=True)
+    files = Column(JSON, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    extraction_id = Column(Integer, ForeignKey("pdf_extractions.id"), nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, default=utcnow, index=True)
+    updated_at = Column(DateTime(timezone=True), nullable=True, onupdate=utcnow)
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    extraction = relationship(PDFExtraction, lazy="joined")
+
+
+class LayoutTemplate(Base):
+    """Template di layout appreso per un formato di referto (vedi `app.services.layout_templates`)."""
+    __tablename__ = "layout_templates"
+
+    id = Column(String(32), primary_key=True)
+    layout = Column(JSON, nullable=False)
+    samples = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime(timezone=True), nullable=False, default=utcnow)
+    updated_at = Column(DateTime(timezone=True), nullable=True, onupdate=utcnow)
@@ -0,0 +1,12 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.core.config import settings
+
+connect_args = {}
+if settings.DATABASE_URL.startswith("sqlite"):
+    # Le sessioni vengono usate dai thread del pool di asyncio.to_thread
+    connect_args = {"check_same_thread": False, "timeout": 30}
+
+engine = create_engine(settings.DATABASE_URL, connect_args=connect_args, pool_pre_ping=True)
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
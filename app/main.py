@@ -1,11 +1,37 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.endpoints import data_extraction
+from app.services.cpu_executor import cpu_executor
+from app.services.llm_registry import llm_registry
+from app.services.loinc_index import loinc_index
+from app.services.job_service import run_migrations
+from app.services.metrics import MetricsMiddleware, metrics_endpoint, monitor_event_loop
+from app.core.config import settings
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.DB_AUTO_MIGRATE:
+        await asyncio.to_thread(run_migrations)
+    await asyncio.to_thread(loinc_index.load)
+    cpu_executor.start()
+    llm_registry.start()
+    await data_extraction.job_service.start()
+    loop_monitor = asyncio.create_task(monitor_event_loop())
+    yield
+    loop_monitor.cancel()
+    await data_extraction.job_service.stop()
+    await llm_registry.aclose()
+    cpu_executor.shutdown()
+
 
 app = FastAPI(
     title="Morfeo API",
     description="API per l'estrazione di dati da documenti PDF",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -16,4 +42,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.include_router(data_extraction.router, prefix="/morfeo", tags=["pdf"]) 
\ No newline at end of file
+app.add_middleware(MetricsMiddleware)
+
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+
+app.include_router(data_extraction.router, prefix="/morfeo", tags=["pdf"])
\ No newline at end of file
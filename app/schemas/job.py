@@ -0,0 +1,20 @@
+from pydantic import BaseModel
+from typing import Optional, List
+from datetime import datetime
+from app.schemas.pdf import PDFExtraction
+
+class JobCreated(BaseModel):
+    job_id: str
+    status: str
+
+class JobStatus(BaseModel):
+    id: str
+    kind: str
+    status: str
+    filenames: List[str]
+    attempts: int
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    result: Optional[PDFExtraction] = None
\ No newline at end of file
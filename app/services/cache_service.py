@@ -0,0 +1,241 @@
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.services.ingestion import SpooledUpload
+from app.services.metrics import CACHE_LOOKUPS, SINGLE_FLIGHT
+
+
+class ResultCache:
+    """
+    Cache dei risultati indicizzata per contenuto (SHA-256 dei file caricati più i
+    parametri che influenzano il risultato: modello, versione del prompt, rendering).
+
+    Due livelli: un LRU in memoria per processo e un archivio SQLite su disco condiviso
+    tra i worker uvicorn (WAL + busy timeout). I valori sono serializzati in JSON,
+    quindi ogni lettura restituisce una copia indipendente.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        memory_entries: int = 256,
+        max_disk_bytes: int = 512 * 1024 * 1024,
+        ttl_seconds: int = 7 * 24 * 3600,
+        enabled: bool = True,
+    ):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._initialized = False
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+
+    @staticmethod
+    def make_key(namespace: str, digests: List[str], **params: Any) -> str:
+        payload = json.dumps(
+            {"namespace": namespace, "files": digests, "params": params},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def key_for_uploads(self, namespace: str, uploads: List[SpooledUpload], **params: Any) -> str:
+        """Chiave per upload già acquisiti: il digest è calcolato durante la copia."""
+        return self.make_key(namespace, [upload.sha256 for upload in uploads], **params)
+
+    async def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.time():
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                CACHE_LOOKUPS.labels("memory_hit").inc()
+                return json.loads(value)
+            del self._memory[key]
+
+        try:
+            row = await asyncio.to_thread(self._disk_get, key)
+        except sqlite3.Error as e:
+            logging.warning(f"Lettura cache fallita: {e}")
+            row = None
+        if row is None:
+            self.misses += 1
+            CACHE_LOOKUPS.labels("miss").inc()
+            return None
+
+        expires_at, value = row
+        self._remember(key, expires_at, value)
+        self.hits["disk"] += 1
+        CACHE_LOOKUPS.labels("disk_hit").inc()
+        return json.loads(value)
+
+    async def set(self, key: str, value: Any) -> None:
+        if not self.enabled:
+            return
+        serialized = json.dumps(value, ensure_ascii=False)
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, expires_at, serialized)
+        try:
+            await asyncio.to_thread(self._disk_set, key, serialized, expires_at)
+        except sqlite3.Error as e:
+            logging.warning(f"Scrittura cache fallita: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits["memory"] + self.hits["disk"] + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_ratio": round((lookups - self.misses) / lookups, 4) if lookups else None,
+            "memory_entries": len(self._memory),
+        }
+
+    def _remember(self, key: str, expires_at: float, value: str) -> None:
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)")
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    def _disk_get(self, key: str) -> Optional[Tuple[float, str]]:
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT expires_at, value FROM results WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def _disk_set(self, key: str, value: str, expires_at: float) -> None:
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), expires_at, now),
+            )
+            conn.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if total > self.max_disk_bytes:
+                # Rimuove le voci usate meno di recente fino a rientrare nel limite
+                conn.execute(
+                    "DELETE FROM results WHERE key IN ("
+                    " SELECT key FROM ("
+                    "  SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC) AS running"
+                    "  FROM results) WHERE running > ?)",
+                    (self.max_disk_bytes,),
+                )
+
+
+class SingleFlight:
+    """
+    Coalescenza delle richieste identiche in corso: chi arriva con una chiave già in
+    esecuzione attende il risultato della prima richiesta invece di rifare il lavoro
+    (i retry ravvicinati dei client non moltiplicano le chiamate al modello prima che
+    la cache sia popolata).
+
+    Il calcolo gira nella prima richiesta, con la sua scadenza e la sua priorità; chi si
+    aggancia riceve una copia del risultato o lo stesso errore. Se la prima richiesta
+    viene annullata, chi era in attesa riparte con i propri file. La coalescenza è per
+    processo: tra worker diversi vale solo la cache.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._flights: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def run(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        if not self.enabled:
+            return await compute()
+
+        while (flight := self._flights.get(key)) is not None:
+            self.followers += 1
+            SINGLE_FLIGHT.labels("follower").inc()
+            logging.info("Richiesta identica già in corso: in attesa del risultato condiviso")
+            try:
+                return copy.deepcopy(await asyncio.shield(flight))
+            except asyncio.CancelledError:
+                if flight.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+
+        return await self._lead(key, compute)
+
+    async def _lead(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        flight = asyncio.get_running_loop().create_future()
+        # Gli errori senza richieste agganciate non vanno segnalati come mai letti
+        flight.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._flights[key] = flight
+        self.leaders += 1
+        SINGLE_FLIGHT.labels("leader").inc()
+        try:
+            result = await compute()
+            flight.set_result(result)
+            return result
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            # Annullamento della richiesta: chi è in attesa riparte
+            if not flight.done():
+                flight.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+
+def _build_cache() -> ResultCache:
+    directory = os.path.dirname(settings.CACHE_PATH)
+    if settings.CACHE_ENABLED and directory:
+        os.makedirs(directory, exist_ok=True)
+    return ResultCache(
+        path=settings.CACHE_PATH,
+        memory_entries=settings.CACHE_MEMORY_ENTRIES,
+        max_disk_bytes=settings.CACHE_MAX_BYTES,
+        ttl_seconds=settings.CACHE_TTL_SECONDS,
+        enabled=settings.CACHE_ENABLED,
+    )
+
+
+result_cache = _build_cache()
+single_flight = SingleFlight(enabled=settings.SINGLE_FLIGHT_ENABLED)
@@ -0,0 +1,65 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+from app.core.config import settings
+from app.services.metrics import in_flight, stage_timer
+
+
+class CPUExecutor:
+    """
+    Pool di processi per il lavoro CPU-bound (rasterizzazione PDF, encoding PNG, base64).
+
+    Il pool viene creato alla prima richiesta (o in fase di startup) e condiviso da
+    tutte le richieste del worker uvicorn. Il numero di task in coda è limitato da un
+    semaforo: oltre `queue_size` task in attesa i chiamanti aspettano, invece di
+    accumulare pagine renderizzate in memoria.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, queue_size: int = 64):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def start(self) -> None:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            logging.info(f"CPU executor avviato con {self.max_workers} processi")
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+            self._pool = None
+            self._slots = None
+            logging.info("CPU executor arrestato")
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Esegue `fn(*args, **kwargs)` in un processo del pool e ne attende il risultato."""
+        self.start()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.queue_size)
+
+        with stage_timer("cpu_queue_wait"):
+            await self._slots.acquire()
+        try:
+            async with in_flight(fn.__name__):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._pool, functools.partial(fn, *args, **kwargs)
+                )
+        finally:
+            self._slots.release()
+
+
+cpu_executor = CPUExecutor(
+    max_workers=settings.CPU_WORKERS,
+    queue_size=settings.CPU_QUEUE_SIZE,
+)
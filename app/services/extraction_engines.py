@@ -0,0 +1,574 @@
+"""
+Motori di estrazione delle tabelle dalle pagine renderizzate.
+
+Ogni motore riceve un gruppo di pagine (immagine intera o ritagli delle regioni
+tabellari) e restituisce per ciascuna {"tables", "engine", "confidence"}:
+- "llm": il modello vision (VISION_MODEL), con le chiamate regolate da `llm_scheduler`;
+- "tesseract": OCR locale con ricostruzione della griglia nei processi del CPU
+  executor; nessun costo per pagina e nessuna dipendenza dal provider;
+- "template": pagine di un layout già noto, lette con Tesseract e le colonne del
+  template appreso dalle letture del modello (`layout_templates`).
+
+La scelta tra i motori, per richiesta o per policy (EXTRACTION_ENGINE), è in
+`PDFService`: in modalità "auto" le pagine lette in locale con confidenza sotto
+OCR_MIN_CONFIDENCE vengono inoltrate al modello. I template si provano prima del
+motore scelto, in ogni modalità.
+"""
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from app.core.config import settings
+from app.services import layout_templates, metrics, ocr_tables, text_layer
+from app.services.cpu_executor import cpu_executor
+from app.services.json_stream import TablesStreamParser, append_continuation
+from app.services.llm_registry import llm_registry
+from app.services.llm_scheduler import image_tokens, llm_scheduler, text_tokens
+from app.services.template_store import template_store
+from fastapi import HTTPException
+
+# Modalità selezionabili: un motore oppure OCR locale con inoltro al modello
+ENGINE_MODES = ("llm", "tesseract", "auto")
+# Altezza della fascia letta in cima a ogni tabella per riconoscerne l'intestazione
+# (frazione del lato lungo della pagina)
+HEADER_STRIP_RATIO = 0.05
+# Token massimi della risposta vision (conteggiati anche nel budget TPM)
+VISION_MAX_TOKENS = 4096
+# Quota di VISION_MAX_TOKENS che le risposte attese di un gruppo impacchettato possono
+# occupare: il margine evita che le pagine più dense portino a richieste di continuazione
+PACKED_OUTPUT_HEADROOM = 0.75
+# Peso delle ultime risposte nella media dei token di risposta per pagina
+PAGE_OUTPUT_SMOOTHING = 0.2
+CONTINUATION_PROMPT = (
+    "Your previous answer was cut off by the output limit after the last row shown above. "
+    "Continue the transcription: return, in the same JSON format, only the rows that come "
+    "after that row (same page and headers as its table) followed by all the remaining tables. "
+    "Do not repeat rows already transcribed."
+)
+
+# Riga letta dal modello, passata appena completa: (pagina, tabella della pagina, intestazioni, celle)
+RowCallback = Callable[[Dict[str, Any], int, List[str], List[str]], None]
+
+
+class ExtractionEngine(ABC):
+    """Interfaccia dei motori: tabelle di un gruppo di pagine dello stesso file."""
+
+    name = ""
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    def cache_params(self) -> Dict[str, Any]:
+        """Parametri del motore che influenzano il risultato, per la chiave di cache."""
+        return {}
+
+    def pages_per_call(self, max_pages: int) -> int:
+        """Pagine da riunire in un gruppo quando il gruppo può contenere più file."""
+        return max(1, max_pages)
+
+    @abstractmethod
+    async def extract(
+        self, group: List[Dict[str, Any]], on_row: Optional[RowCallback] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Una voce per pagina del gruppo, nello stesso ordine. None indica una pagina che il
+        motore non legge (es. nessun template corrispondente): resta agli altri motori.
+        I motori che leggono le righe man mano le passano a `on_row` prima della fine;
+        gli altri lo ignorano.
+        """
+
+
+class LLMEngine(ExtractionEngine):
+    """Estrazione con il modello vision: una chiamata per gruppo di pagine."""
+
+    name = "llm"
+
+    def __init__(self):
+        # Media mobile dei token di risposta per pagina, osservata sulle chiamate completate
+        self.page_output_tokens: Optional[float] = None
+
+    def cache_params(self) -> Dict[str, Any]:
+        return {"model": settings.VISION_MODEL, "max_continuations": settings.LLM_MAX_CONTINUATIONS}
+
+    def pages_per_call(self, max_pages: int) -> int:
+        """
+        Pagine da impacchettare in una chiamata: al massimo `max_pages`, e non più di quante
+        ne stanno, secondo le risposte osservate finora, nel limite di token della risposta.
+        """
+        if not self.page_output_tokens:
+            return max(1, max_pages)
+        fitting = int(VISION_MAX_TOKENS * PACKED_OUTPUT_HEADROOM // self.page_output_tokens)
+        return max(1, min(max_pages, fitting))
+
+    async def extract(
+        self, group: List[Dict[str, Any]], on_row: Optional[RowCallback] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Con `on_row` ogni riga viene passata appena il modello la completa, prima della
+        fine della chiamata: sono letture provvisorie, il risultato restituito resta
+        quello definitivo.
+        """
+        # Una pagina viene inviata intera oppure come ritagli delle sue regioni tabellari
+        images = [
+            (index, image)
+            for index, page in enumerate(group)
+            for image in page.get("regions") or [page]
+        ]
+
+        row_sink = None
+        if on_row is not None:
+            # Tabella della risposta → (pagina del gruppo, posizione tra le tabelle della pagina)
+            placements: Dict[int, Tuple[int, int]] = {}
+            page_table_counts = [0] * len(group)
+
+            def row_sink(table_index: int, table: Dict[str, Any], row: List[str]) -> None:
+                if table_index not in placements:
+                    index = images[self._image_position(table, len(images))][0]
+                    placements[table_index] = (index, page_table_counts[index])
+                    page_table_counts[index] += 1
+                index, page_table = placements[table_index]
+                headers = [str(h).strip() for h in table.get("headers", []) if h]
+                on_row(group[index], page_table, headers, row)
+
+        result = await self._parse_tables_from_images([image for _, image in images], row_sink)
+
+        # Il modello numera le immagini ricevute da 1: si riportano pagina reale e riquadro
+        page_tables = [[] for _ in group]
+        index = len(group) - 1
+        for table in result["tables"]:
+            index, image = images[self._image_position(table, len(images))]
+            table["page"] = group[index]["page"]
+            if "bbox" in image:
+                table["region"] = image["bbox"]
+            page_tables[index].append(table)
+        results = [{"tables": tables, "engine": self.name, "confidence": None} for tables in page_tables]
+        if result.get("truncated"):
+            # La risposta si è interrotta sull'ultima tabella letta
+            results[index]["truncated"] = True
+        else:
+            self._observe_output(result["tables"], len(group))
+        return results
+
+    def _observe_output(self, tables: List[Dict[str, Any]], pages: int) -> None:
+        tokens = text_tokens(json.dumps({"tables": tables}, ensure_ascii=False)) / pages
+        if self.page_output_tokens is None:
+            self.page_output_tokens = tokens
+        else:
+            self.page_output_tokens += PAGE_OUTPUT_SMOOTHING * (tokens - self.page_output_tokens)
+
+    @staticmethod
+    def _image_position(table: Dict[str, Any], images: int) -> int:
+        """Posizione (da 0) dell'immagine a cui il modello attribuisce la tabella."""
+        if images > 1:
+            try:
+                number = int(table.get("page"))
+            except (TypeError, ValueError):
+                number = 1
+            if 1 <= number <= images:
+                return number - 1
+        return 0
+
+    async def _parse_tables_from_images(
+        self,
+        pages: List[Dict[str, Any]],
+        on_row: Optional[Callable[[int, Dict[str, Any], List[str]], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Chiamata vision in streaming: la risposta passa dal parser incrementale e ogni
+        riga completata va a `on_row` (tabella della risposta, tabella, celle). Se il
+        modello si ferma per il limite di token (finish_reason "length") prima della fine
+        del JSON, fino a LLM_MAX_CONTINUATIONS richieste di continuazione riprendono
+        dall'ultima riga completa; esaurite quelle si restituiscono le righe lette. Le
+        altre risposte incomplete passano dal parsing dell'intera risposta.
+        """
+        try:
+            messages = [
+                {
+                    "role": "system",
+                    "content": """You are a medical laboratory report analysis expert. Your task is to:
+                    1. Identify and extract ALL tables from the medical report
+                    2. Preserve the exact structure and content of each table
+                    3. Pay special attention to reference ranges and units of measurement
+                    4. Ensure ALL cells are captured, even if they appear empty or unclear
+                    5. Double-check all numeric ranges columns
+
+                    Return the data in this format:
+                    {
+                        "tables": [
+                            {
+                                "page": page_number,
+                                "headers": ["exact header 1", "exact header 2", ...],
+                                "data": [
+                                    ["row1 cell1", "row1 cell2", ...],
+                                    ["row2 cell1", "row2 cell2", ...]
+                                ]
+                            }
+                        ]
+                    }
+
+                    Important rules:
+                    - Extract ALL text exactly as it appears
+                    - Preserve ALL reference ranges, especially numeric ranges
+                    - Include ALL units of measurement
+                    - If a cell appears empty but might contain data, try to enhance and recheck
+                    - Pay special attention to faint or low-contrast text
+                    - Verify that numeric ranges are complete and accurate"""
+                }
+            ]
+
+            user_content = [
+                {
+                    "type": "text",
+                    "text": "Extract all tables from these medical laboratory report images. Pay special attention to reference ranges and ensure all cells are captured accurately. Images are numbered from 1 in the order given: use that number as the table's page."
+                }
+            ]
+
+            for page in pages:
+                user_content.append({
+                    "type": "image_url",
+                    "image_url": {"url": page["data_url"], "detail": page["detail"]}
+                })
+
+            messages.append({"role": "user", "content": user_content})
+
+            llm = llm_registry.chat(settings.VISION_MODEL, max_tokens=VISION_MAX_TOKENS, temperature=0)
+            tokens = (
+                text_tokens(messages[0]["content"] + user_content[0]["text"])
+                + sum(image_tokens(page["width"], page["height"], page["detail"]) for page in pages)
+                + VISION_MAX_TOKENS
+            )
+            # Righe già passate a `on_row` per ogni tabella: i tentativi paralleli (hedging)
+            # e le continuazioni non le ripetono
+            emitted: List[int] = []
+
+            def emit(tables: List[Dict[str, Any]]) -> None:
+                for table_index, table in enumerate(tables):
+                    if table_index == len(emitted):
+                        emitted.append(0)
+                    for row in table.get("data", [])[emitted[table_index]:]:
+                        emitted[table_index] += 1
+                        cells = [str(cell).strip() for cell in row] if isinstance(row, list) else []
+                        if any(cells):
+                            on_row(table_index, table, cells)
+
+            async def stream(call_messages: List[Dict[str, Any]], read: List[Dict[str, Any]], call_tokens: int):
+                async def invoke() -> Tuple[TablesStreamParser, str, Optional[str]]:
+                    parser = TablesStreamParser()
+                    finish = _FinishReason()
+                    parts = []
+                    async with metrics.in_flight("vision_call"):
+                        async for chunk in llm.astream(call_messages, config={"callbacks": [finish]}):
+                            parts.append(chunk.content)
+                            if parser.feed(chunk.content) and on_row is not None:
+                                emit(append_continuation(read, parser.tables))
+                    parser.finish()
+                    content = "".join(parts)
+                    # In streaming il provider non riporta l'uso dei token: lo si stima
+                    metrics.LLM_TOKENS.labels(settings.VISION_MODEL, "in").inc(call_tokens - VISION_MAX_TOKENS)
+                    metrics.LLM_TOKENS.labels(settings.VISION_MODEL, "out").inc(text_tokens(content))
+                    return parser, content, finish.reason
+
+                return await llm_scheduler.call("vision_call", call_tokens, invoke)
+
+            try:
+                tables: List[Dict[str, Any]] = []
+                truncated = False
+                call_messages, call_tokens = messages, tokens
+                for continuation in range(settings.LLM_MAX_CONTINUATIONS + 1):
+                    parser, content, finish_reason = await stream(call_messages, tables, call_tokens)
+                    metrics.LLM_CALLS.labels("vision_call", "ok").inc()
+                    if parser.complete:
+                        tables = append_continuation(tables, parser.tables)
+                        break
+                    if parser.error or finish_reason != "length":
+                        # Risposta conclusa dal modello ma non un JSON completo (malformato o
+                        # testo libero): solo il limite di token giustifica una continuazione
+                        logging.warning(f"Parsing incrementale fallito ({parser.error or finish_reason}), "
+                                        f"parsing della risposta intera")
+                        with metrics.stage_timer("parse_response"):
+                            try:
+                                more = self._process_llm_response(content)["tables"]
+                            except Exception:
+                                more = parser.tables
+                        tables = append_continuation(tables, more)
+                        break
+                    tables = append_continuation(tables, parser.tables)
+                    if continuation == settings.LLM_MAX_CONTINUATIONS:
+                        truncated = True
+                        metrics.VISION_TRUNCATIONS.labels("exhausted").inc()
+                        logging.warning(f"Risposta del modello troncata ({finish_reason}) dopo "
+                                        f"{continuation} continuazioni: si tengono le righe complete")
+                        break
+                    # Risposta troncata: si riparte dall'ultima riga completa
+                    metrics.VISION_TRUNCATIONS.labels("continued").inc()
+                    transcribed = json.dumps({"tables": tables}, ensure_ascii=False)
+                    logging.info(f"Risposta del modello troncata ({finish_reason}) dopo {parser.rows} righe, "
+                                 f"richiesta di continuazione {continuation + 1}")
+                    call_messages = [
+                        *messages,
+                        {"role": "assistant", "content": transcribed},
+                        {"role": "user", "content": CONTINUATION_PROMPT},
+                    ]
+                    call_tokens = tokens + text_tokens(transcribed + CONTINUATION_PROMPT)
+                logging.info("Response received from model")
+                if on_row is not None:
+                    emit(tables)
+                return {**normalize_tables_response({"tables": tables}), "truncated": truncated}
+            except asyncio.TimeoutError:
+                metrics.LLM_CALLS.labels("vision_call", "timeout").inc()
+                logging.error("Timeout during model call")
+                raise HTTPException(
+                    status_code=504,
+                    detail="Request timeout while processing images"
+                )
+        
+        except Exception as e:
+            logging.error(f"Errore durante il parsing delle tabelle: {str(e)}")
+            if hasattr(e, 'response'):
+                metrics.LLM_CALLS.labels("vision_call", "error").inc()
+                logging.error(f"Dettagli errore API: {e.response}")
+            raise
+
+    def _process_llm_response(self, content: str) -> dict:
+        try:
+            logging.debug(f"Contenuto ricevuto dal modello: {content}")
+            
+            content = content.strip()
+            if content.startswith('```json'):
+                content = content[7:]
+            if content.endswith('```'):
+                content = content[:-3]
+            
+            try:
+                return normalize_tables_response(json.loads(content))
+            except json.JSONDecodeError as e:
+                logging.warning(f"Primo tentativo di parsing JSON fallito: {str(e)}")
+            
+            import re
+            json_match = re.search(r'\{[\s\S]*\}', content)
+            if json_match:
+                try:
+                    result = json.loads(json_match.group())
+                    return normalize_tables_response(result)
+                except json.JSONDecodeError as e:
+                    logging.error(f"Errore nel parsing del JSON estratto: {str(e)}")
+                    logging.error(f"JSON problematico: {json_match.group()}")
+                    raise
+            
+            logging.warning("Nessun JSON valido trovato nella risposta")
+            return {"tables": []}
+            
+        except Exception as e:
+            logging.error(f"Errore nel processing della risposta: {str(e)}")
+            raise
+
+
+class _FinishReason(BaseCallbackHandler):
+    """finish_reason dell'ultimo chunk in streaming, che `astream` non riporta nei messaggi."""
+
+    run_inline = True
+
+    def __init__(self):
+        self.reason: Optional[str] = None
+
+    def on_llm_new_token(self, token: str, *, chunk: Any = None, **kwargs: Any) -> None:
+        info = getattr(chunk, "generation_info", None) or {}
+        if info.get("finish_reason"):
+            self.reason = info["finish_reason"]
+
+
+class TesseractEngine(ExtractionEngine):
+    """
+    OCR locale: ogni pagina è letta da Tesseract in un processo del CPU executor. Le
+    pagine renderizzate a bassa risoluzione vengono ingrandite fino a `target_long_edge`.
+    """
+
+    name = "tesseract"
+
+    def __init__(self, language: str = "ita+eng", psm: int = 6, target_long_edge: int = 3000):
+        self.language = language
+        self.psm = psm
+        self.target_long_edge = target_long_edge
+        self._available: Optional[bool] = None
+
+    @classmethod
+    def from_settings(cls) -> "TesseractEngine":
+        return cls(
+            language=settings.OCR_LANGUAGE,
+            psm=settings.OCR_PSM,
+            target_long_edge=settings.OCR_TARGET_LONG_EDGE,
+        )
+
+    @property
+    def available(self) -> bool:
+        if self._available is None:
+            self._available = ocr_tables.tesseract_available()
+            if not self._available:
+                logging.warning("Tesseract non disponibile: l'estrazione locale è disattivata")
+        return self._available
+
+    def cache_params(self) -> Dict[str, Any]:
+        return {"language": self.language, "psm": self.psm, "target_long_edge": self.target_long_edge}
+
+    async def extract(
+        self, group: List[Dict[str, Any]], on_row: Optional[RowCallback] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        return list(await asyncio.gather(*(self._extract_page(page) for page in group)))
+
+    def page_images(self, page: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Immagini della pagina da inviare ai processi: intera o ritagli delle regioni."""
+        return [
+            {key: image[key] for key in ("data_url", "bbox", "table_boxes") if key in image}
+            for image in page.get("regions") or [page]
+        ]
+
+    def page_scale(self, page: Dict[str, Any]) -> float:
+        return self.target_long_edge / max(page["width"], page["height"], 1)
+
+    async def _extract_page(self, page: Dict[str, Any]) -> Dict[str, Any]:
+        result = await cpu_executor.run(
+            ocr_tables.ocr_page_tables, self.page_images(page), self.language, self.psm, self.page_scale(page)
+        )
+        tables = normalize_tables_response({"tables": result["tables"]})["tables"]
+        for table in tables:
+            table["page"] = page["page"]
+        return {"tables": tables, "engine": self.name, "confidence": result["confidence"]}
+
+
+class TemplateEngine(ExtractionEngine):
+    """
+    Pagine di layout noto, lette con i template appresi (`layout_templates`) invece che
+    dal modello. L'OCR di una fascia in cima a ogni tabella sceglie i template candidati;
+    solo le pagine con un candidato sono lette per intero da Tesseract e le parole
+    assegnate alle colonne del template. Le pagine senza template, o lette con confidenza
+    sotto OCR_MIN_CONFIDENCE, restano agli altri motori (risultato None).
+
+    Le pagine lette dal modello servono da campioni: `learn` ricava il template in
+    background, uno alla volta, e i campioni che arrivano mentre un altro è in
+    lavorazione vengono scartati.
+    """
+
+    name = "template"
+
+    def __init__(self, ocr: TesseractEngine):
+        self.ocr = ocr
+        self._learning: Set[asyncio.Task] = set()
+
+    @classmethod
+    def from_settings(cls) -> "TemplateEngine":
+        return cls(TesseractEngine.from_settings())
+
+    @property
+    def available(self) -> bool:
+        return settings.LAYOUT_TEMPLATES_ENABLED and self.ocr.available
+
+    async def extract(
+        self, group: List[Dict[str, Any]], on_row: Optional[RowCallback] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        await template_store.refresh()
+        templates = template_store.active()
+        if not templates:
+            return [None] * len(group)
+        return list(await asyncio.gather(*(self._extract_page(page, templates) for page in group)))
+
+    def learn(self, samples: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]) -> None:
+        """Avvia l'apprendimento dalle coppie (pagina, tabelle lette dal modello)."""
+        if not settings.LAYOUT_TEMPLATE_LEARNING or not self.available:
+            return
+        for page, tables in samples:
+            if self._learning:
+                metrics.LAYOUT_TEMPLATE_PAGES.labels("skipped").inc()
+                continue
+            images = self.ocr.page_images(page)
+            if not tables or not self._probable(images):
+                continue
+            # Le immagini sono copiate subito: la pagina le rilascia appena restituita
+            task = asyncio.create_task(
+                self._learn_page(images, self.ocr.page_scale(page), self._strip_height(page), tables)
+            )
+            self._learning.add(task)
+            task.add_done_callback(self._learning.discard)
+
+    async def _extract_page(self, page: Dict[str, Any], templates: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        images = self.ocr.page_images(page)
+        if not self._probable(images):
+            return None
+        scale = self.ocr.page_scale(page)
+        headers = await cpu_executor.run(
+            ocr_tables.ocr_table_headers, images, self.ocr.language, self.ocr.psm, scale, self._strip_height(page)
+        )
+        candidates = layout_templates.candidates(templates, headers)
+        if not candidates:
+            metrics.LAYOUT_TEMPLATE_PAGES.labels("no_candidate").inc()
+            return None
+        result = await cpu_executor.run(
+            ocr_tables.ocr_page_tables, images, self.ocr.language, self.ocr.psm, scale, candidates
+        )
+        if result["template"] is None or result["confidence"] < settings.OCR_MIN_CONFIDENCE:
+            metrics.LAYOUT_TEMPLATE_PAGES.labels("rejected").inc()
+            return None
+        metrics.LAYOUT_TEMPLATE_PAGES.labels("matched").inc()
+        tables = normalize_tables_response({"tables": result["tables"]})["tables"]
+        for table in tables:
+            table["page"] = page["page"]
+        return {"tables": tables, "engine": self.name, "confidence": result["confidence"]}
+
+    async def _learn_page(
+        self, images: List[Dict[str, Any]], scale: float, strip_height: int, tables: List[Dict[str, Any]]
+    ) -> None:
+        try:
+            layout = await cpu_executor.run(
+                ocr_tables.learn_page_layout, images, self.ocr.language, self.ocr.psm, scale, strip_height,
+                [{"headers": table["headers"], "data": table["data"]} for table in tables],
+                settings.LAYOUT_TEMPLATE_MIN_AGREEMENT,
+            )
+            if layout is None:
+                metrics.LAYOUT_TEMPLATE_PAGES.labels("not_learned").inc()
+                return
+            record = await template_store.add(layout)
+            metrics.LAYOUT_TEMPLATE_PAGES.labels("learned").inc()
+            logging.info(f"Template di layout {layout['id']}: campione appreso ({record['samples']} campioni)")
+        except Exception as e:
+            logging.warning(f"Apprendimento del template di layout fallito: {str(e)}")
+
+    @staticmethod
+    def _probable(images: List[Dict[str, Any]]) -> bool:
+        # Le intestazioni si cercano in cima alle regioni tabellari: senza riquadri non c'è dove guardare
+        return any("bbox" in image or image.get("table_boxes") for image in images)
+
+    @staticmethod
+    def _strip_height(page: Dict[str, Any]) -> int:
+        return max(1, round(HEADER_STRIP_RATIO * max(page["width"], page["height"])))
+
+
+def normalize_tables_response(result: dict) -> dict:
+    """Normalizza la risposta per assicurare una struttura consistente"""
+    if not isinstance(result, dict):
+        result = {"tables": []}
+    elif "tables" not in result:
+        result = {"tables": [result] if result else []}
+
+    for table in result["tables"]:
+        if "headers" not in table:
+            table["headers"] = []
+        if "data" not in table:
+            table["data"] = []
+
+        # Una colonna senza intestazione resta al suo posto, o le celle delle righe
+        # finirebbero sotto l'intestazione della colonna successiva
+        table["headers"] = [
+            str(h).strip() if h is not None and str(h).strip() else text_layer.header_placeholder(position)
+            for position, h in enumerate(table["headers"], start=1)
+        ]
+        table["data"] = [
+            [str(cell).strip() for cell in row]
+            for row in table["data"]
+            if any(str(cell).strip() for cell in row)
+        ]
+
+    return result
@@ -0,0 +1,134 @@
+"""
+Preprocessing delle pagine prima dell'invio al modello vision.
+
+Gira nei processi del CPU executor tra il rendering e la codifica in data URL:
+scala di grigi, raddrizzamento, ritaglio dei margini bianchi e normalizzazione del
+contrasto per il testo sbiadito, poi codifica in PNG ottimizzato, JPEG o WebP.
+Il raddrizzamento usa OpenCV se installato, altrimenti viene saltato.
+"""
+import logging
+from io import BytesIO
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:  # pragma: no cover - OpenCV è opzionale
+    cv2 = None
+    np = None
+
+IMAGE_FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+# Pixel più scuri di questa soglia sono considerati inchiostro (ritaglio dei margini)
+INK_THRESHOLD = 235
+# Margine bianco (px) lasciato attorno al contenuto ritagliato
+CROP_PADDING = 12
+# Angoli provati per il raddrizzamento (gradi) e rotazione minima applicata
+DESKEW_MAX_ANGLE = 5.0
+DESKEW_STEP = 0.25
+DESKEW_MIN_ANGLE = 0.3
+# Lato lungo dell'immagine ridotta su cui si stima l'inclinazione
+DESKEW_SAMPLE_EDGE = 800
+
+_warned_no_cv2 = False
+
+
+def preprocess_image(image: Image.Image, policy) -> Tuple[Image.Image, Dict[str, Any]]:
+    """Applica i passi abilitati nella policy; restituisce l'immagine e i passi eseguiti."""
+    applied: Dict[str, Any] = {}
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+
+    if policy.grayscale and image.mode != "L":
+        image = image.convert("L")
+        applied["grayscale"] = True
+
+    if policy.deskew:
+        angle = estimate_skew(image)
+        if angle is not None and abs(angle) >= DESKEW_MIN_ANGLE:
+            fill = 255 if image.mode == "L" else (255, 255, 255)
+            image = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=fill)
+            applied["deskew"] = round(angle, 2)
+
+    if policy.autocrop:
+        bbox = content_bbox(image)
+        if bbox is not None and bbox != (0, 0, image.width, image.height):
+            image = image.crop(bbox)
+            applied["autocrop"] = list(bbox)
+
+    if policy.contrast:
+        image = ImageOps.autocontrast(image, cutoff=1)
+        applied["contrast"] = True
+
+    return image, applied
+
+
+def content_bbox(image: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+    """Riquadro del contenuto non bianco con un piccolo margine; None per pagine vuote."""
+    gray = image if image.mode == "L" else image.convert("L")
+    mask = gray.point(lambda value: 255 if value < INK_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return None
+    left, top, right, bottom = bbox
+    return (
+        max(0, left - CROP_PADDING),
+        max(0, top - CROP_PADDING),
+        min(image.width, right + CROP_PADDING),
+        min(image.height, bottom + CROP_PADDING),
+    )
+
+
+def estimate_skew(image: Image.Image) -> Optional[float]:
+    """
+    Angolo (gradi, antiorari come `Image.rotate`) che raddrizza la pagina, stimato con
+    il profilo di proiezione orizzontale: le righe di testo allineate massimizzano la
+    varianza delle somme per riga. Ricerca a grana grossa e poi fine attorno al massimo.
+    """
+    global _warned_no_cv2
+    if cv2 is None:
+        if not _warned_no_cv2:
+            logging.warning("OpenCV non disponibile: raddrizzamento delle pagine disattivato")
+            _warned_no_cv2 = True
+        return None
+
+    gray = np.asarray(image if image.mode == "L" else image.convert("L"))
+    scale = DESKEW_SAMPLE_EDGE / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    if cv2.countNonZero(ink) == 0:
+        return None
+
+    coarse = _best_angle(ink, np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + 1e-9, 1.0))
+    return _best_angle(ink, np.arange(coarse - 0.75, coarse + 0.75 + 1e-9, DESKEW_STEP))
+
+
+def _best_angle(ink, angles) -> float:
+    height, width = ink.shape
+    center = (width / 2, height / 2)
+    best_angle, best_score = 0.0, -1.0
+    for angle in angles:
+        matrix = cv2.getRotationMatrix2D(center, float(angle), 1.0)
+        rotated = cv2.warpAffine(ink, matrix, (width, height), flags=cv2.INTER_NEAREST)
+        score = float(np.var(rotated.sum(axis=1, dtype=np.float64)))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def encode(image: Image.Image, image_format: str, quality: int) -> Tuple[bytes, str]:
+    """Codifica l'immagine nel formato richiesto; restituisce byte e MIME type."""
+    pil_format, mime = IMAGE_FORMATS[image_format]
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    if pil_format == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+    elif pil_format == "JPEG":
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    else:
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    return buffer.getvalue(), mime
@@ -0,0 +1,417 @@
+"""
+Acquisizione degli upload con memoria limitata.
+
+Ogni file viene scritto a blocchi in uno `SpoolFile`: resta in memoria finché è piccolo
+e oltre INGEST_MEMORY_THRESHOLD viene riversato in un file temporaneo su disco. Durante
+la scrittura si calcolano dimensione e SHA-256 (usato come chiave di cache) e si
+applicano i limiti per file e per richiesta. I processi di rendering ricevono il
+percorso del file invece dei byte, così il contenuto non viene copiato in ogni task
+del pool.
+
+Sulle route di `IngestionRoute` il parser multipart scrive i file direttamente negli
+spool invece che nei file temporanei anonimi di Starlette: l'upload viene poi adottato
+senza una seconda copia e i limiti interrompono la lettura del corpo appena superati.
+"""
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+from contextlib import asynccontextmanager
+from io import BytesIO
+from typing import Any, AsyncIterator, Callable, Coroutine, List, Optional, Tuple, Union
+
+import multipart
+from fastapi import HTTPException, Request, Response, UploadFile
+from fastapi.routing import APIRoute
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import parse_options_header
+from starlette.datastructures import FormData, Headers
+
+from app.core.config import settings
+from app.services.metrics import BYTES, stage_timer
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class SpoolFile:
+    """
+    Contenuto di un upload in scrittura: in memoria fino a INGEST_MEMORY_THRESHOLD, poi in
+    un file temporaneo con nome, apribile dai processi del CPU executor.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.size = 0
+        self.path: Optional[str] = None
+        self._buffer: Optional[BytesIO] = BytesIO()
+        self._disk_file = None
+        self._digest = hashlib.sha256()
+
+    @property
+    def rolled(self) -> bool:
+        """True se il contenuto è su disco: le scritture vanno fatte fuori dall'event loop."""
+        return self.path is not None
+
+    def write(self, chunk: bytes) -> int:
+        check_file_size(self.filename, self.size + len(chunk))
+        self._digest.update(chunk)
+        self.size += len(chunk)
+        if self.path is None and self.size > settings.INGEST_MEMORY_THRESHOLD:
+            self._rollover()
+        if self._disk_file is not None:
+            self._disk_file.write(chunk)
+        else:
+            self._buffer.write(chunk)
+        return len(chunk)
+
+    def read(self, size: int = -1) -> bytes:
+        return (self._disk_file or self._buffer).read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return (self._disk_file or self._buffer).seek(offset, whence)
+
+    def detach(self) -> Tuple[Optional[str], Optional[bytes], str]:
+        """Percorso o byte del contenuto e digest; lo spool non li possiede più."""
+        path, content = self.path, None
+        if self._disk_file is not None:
+            self._disk_file.close()
+            self._disk_file = None
+        elif self._buffer is not None:
+            content = self._buffer.getvalue()
+        self.path, self._buffer = None, None
+        return path, content, self._digest.hexdigest()
+
+    def close(self) -> None:
+        if self._disk_file is not None:
+            self._disk_file.close()
+            self._disk_file = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+        self._buffer = None
+
+    def _rollover(self) -> None:
+        suffix = os.path.splitext(self.filename)[1]
+        handle, self.path = tempfile.mkstemp(prefix="morfeo-", suffix=suffix, dir=settings.INGEST_SPOOL_DIR or None)
+        self._disk_file = os.fdopen(handle, "w+b")
+        self._disk_file.write(self._buffer.getbuffer())
+        self._buffer = None
+
+
+class SpooledUpload:
+    """File caricato, in memoria (`content`) o su disco (`path`), con il suo digest."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.size = 0
+        self.path: Optional[str] = None
+        self._content: Optional[bytes] = None
+        self._owns_path = True
+        self.sha256: Optional[str] = None
+
+    @classmethod
+    def from_spool(cls, spool: SpoolFile) -> "SpooledUpload":
+        """Adotta il contenuto di uno spool completato senza copiarlo."""
+        upload = cls(spool.filename)
+        upload.size = spool.size
+        upload.path, upload._content, upload.sha256 = spool.detach()
+        return upload
+
+    @classmethod
+    async def from_path(cls, path: str, filename: str) -> "SpooledUpload":
+        """Riferisce un file già su disco (es. upload di un job) senza copiarlo."""
+        upload = cls(filename)
+        upload.path = path
+        upload._owns_path = False
+        digest = hashlib.sha256()
+
+        def read() -> None:
+            with open(path, "rb") as handle:
+                while chunk := handle.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    upload.size += len(chunk)
+
+        await asyncio.to_thread(read)
+        upload.sha256 = digest.hexdigest()
+        return upload
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        """Argomento per le funzioni del CPU executor: percorso su disco o byte in memoria."""
+        return self.path if self.path is not None else self._content
+
+    async def read(self) -> bytes:
+        if self.path is not None:
+            return await asyncio.to_thread(_read_file, self.path)
+        return self._content
+
+    async def save(self, path: str) -> None:
+        """Sposta (o scrive) il contenuto in `path`; l'upload continua a puntare lì."""
+        if self.path is not None and self._owns_path:
+            await asyncio.to_thread(shutil.move, self.path, path)
+        elif self.path is not None:
+            await asyncio.to_thread(shutil.copyfile, self.path, path)
+        else:
+            await asyncio.to_thread(_write_file, path, self._content)
+            self._content = None
+        self.path = path
+        self._owns_path = False
+
+    def close(self) -> None:
+        """Rilascia il contenuto; chiamarlo più volte non ha effetti."""
+        if self.path is not None and self._owns_path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+        self._content = None
+
+
+class SpoolingMultipartParser:
+    """
+    Parser dei corpi multipart/form-data che scrive ogni file in uno `SpoolFile` invece
+    che in un SpooledTemporaryFile anonimo, che i processi di rendering non potrebbero
+    aprire. Usa solo le API pubbliche di python-multipart e il flusso del corpo della
+    richiesta; i limiti di file e campi sono quelli di Starlette.
+    """
+
+    def __init__(
+        self,
+        headers: Headers,
+        stream: AsyncIterator[bytes],
+        max_files: Union[int, float] = 1000,
+        max_fields: Union[int, float] = 1000,
+    ):
+        self.headers = headers
+        self.stream = stream
+        self.max_files = max_files
+        self.max_fields = max_fields
+        self.items: List[Tuple[str, Union[str, UploadFile]]] = []
+        self._charset = "utf-8"
+        self._files = 0
+        self._fields = 0
+        self._file_bytes = 0
+        self._spools: List[SpoolFile] = []
+        self._pending: List[Tuple[SpoolFile, bytes]] = []
+        self._header_name = b""
+        self._header_value = b""
+        self._part_headers: List[Tuple[bytes, bytes]] = []
+        self._disposition = b""
+        self._field_name = ""
+        self._data = b""
+        self._upload: Optional[UploadFile] = None
+
+    async def parse(self) -> FormData:
+        """
+        Raises:
+            HTTPException: 400 se il corpo non è un multipart valido, 413 se un file o la
+                richiesta superano i limiti configurati
+        """
+        _, params = parse_options_header(self.headers.get("Content-Type"))
+        charset = params.get(b"charset")
+        if charset:
+            self._charset = charset.decode("latin-1")
+        if b"boundary" not in params:
+            raise HTTPException(status_code=400, detail="Missing boundary in multipart.")
+        parser = multipart.MultipartParser(params[b"boundary"], {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+        try:
+            async for chunk in self.stream:
+                parser.write(chunk)
+                # Le scritture su disco non passano dai callback sincroni del parser
+                for spool, data in self._pending:
+                    if spool.rolled:
+                        await asyncio.to_thread(spool.write, data)
+                    else:
+                        spool.write(data)
+                self._pending.clear()
+            parser.finalize()
+        except MultipartParseError as e:
+            self._close()
+            raise HTTPException(status_code=400, detail=f"Invalid multipart body: {e}")
+        except BaseException:
+            self._close()
+            raise
+        completed = set()
+        for _, value in self.items:
+            if isinstance(value, UploadFile):
+                value.size = value.file.size
+                completed.add(id(value.file))
+        # Parti non terminate (corpo interrotto): non entrano nel form e vanno rilasciate
+        for spool in self._spools:
+            if id(spool) not in completed:
+                spool.close()
+        return FormData(self.items)
+
+    def _close(self) -> None:
+        for spool in self._spools:
+            spool.close()
+
+    def _decode(self, value: bytes) -> str:
+        try:
+            return value.decode(self._charset)
+        except (UnicodeDecodeError, LookupError):
+            return value.decode("latin-1")
+
+    def _on_part_begin(self) -> None:
+        self._part_headers, self._disposition, self._data, self._upload = [], b"", b"", None
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        name = self._header_name.lower()
+        if name == b"content-disposition":
+            self._disposition = self._header_value
+        self._part_headers.append((name, self._header_value))
+        self._header_name, self._header_value = b"", b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        if b"name" not in options:
+            raise HTTPException(status_code=400, detail='The Content-Disposition header field "name" must be provided.')
+        self._field_name = self._decode(options[b"name"])
+        if b"filename" not in options:
+            self._fields += 1
+            if self._fields > self.max_fields:
+                raise HTTPException(status_code=400, detail=f"Too many fields. Maximum number of fields is {self.max_fields}.")
+            return
+        self._files += 1
+        if self._files > self.max_files:
+            raise HTTPException(status_code=400, detail=f"Too many files. Maximum number of files is {self.max_files}.")
+        spool = SpoolFile(self._decode(options[b"filename"]))
+        self._spools.append(spool)
+        self._upload = UploadFile(spool, filename=spool.filename, headers=Headers(raw=self._part_headers))
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._upload is None:
+            self._data += data[start:end]
+            return
+        self._file_bytes += end - start
+        check_request_size(self._file_bytes)
+        self._pending.append((self._upload.file, data[start:end]))
+
+    def _on_part_end(self) -> None:
+        if self._upload is None:
+            self.items.append((self._field_name, self._decode(self._data)))
+        else:
+            self.items.append((self._field_name, self._upload))
+
+
+class SpoolingRequest(Request):
+    """Richiesta il cui form multipart viene letto da `SpoolingMultipartParser`."""
+
+    _spooled_form: Optional[FormData] = None
+
+    async def form(self, *, max_files: Union[int, float] = 1000, max_fields: Union[int, float] = 1000) -> FormData:
+        content_type, _ = parse_options_header(self.headers.get("Content-Type"))
+        if content_type != b"multipart/form-data":
+            return await super().form(max_files=max_files, max_fields=max_fields)
+        if self._spooled_form is None:
+            parser = SpoolingMultipartParser(self.headers, self.stream(), max_files, max_fields)
+            self._spooled_form = await parser.parse()
+        return self._spooled_form
+
+
+class IngestionRoute(APIRoute):
+    """Route i cui file caricati sono scritti direttamente negli spool dell'ingestione."""
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+
+        async def spooling_handler(request: Request) -> Response:
+            return await handler(SpoolingRequest(request.scope, request.receive))
+
+        return spooling_handler
+
+
+def check_file_size(filename: str, size: int) -> None:
+    if size > settings.INGEST_MAX_FILE_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File {filename} exceeds {settings.INGEST_MAX_FILE_BYTES} bytes"
+        )
+
+
+def check_request_size(size: int) -> None:
+    if size > settings.INGEST_MAX_REQUEST_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Request exceeds {settings.INGEST_MAX_REQUEST_BYTES} bytes"
+        )
+
+
+async def ingest_uploads(files: List[UploadFile]) -> List[SpooledUpload]:
+    """
+    Acquisisce gli upload applicando i limiti per file e per richiesta. I file già
+    scritti in uno spool (route `IngestionRoute`) sono adottati, gli altri copiati a blocchi.
+
+    Raises:
+        HTTPException: 413 se un file o la richiesta superano i limiti configurati
+    """
+    uploads: List[SpooledUpload] = []
+    total = 0
+    try:
+        with stage_timer("ingest"):
+            for file in files:
+                if isinstance(file.file, SpoolFile):
+                    total += file.file.size
+                    check_request_size(total)
+                    uploads.append(SpooledUpload.from_spool(file.file))
+                    continue
+                spool = SpoolFile(file.filename)
+                try:
+                    while chunk := await file.read(CHUNK_SIZE):
+                        total += len(chunk)
+                        check_request_size(total)
+                        if spool.rolled:
+                            await asyncio.to_thread(spool.write, chunk)
+                        else:
+                            spool.write(chunk)
+                    uploads.append(SpooledUpload.from_spool(spool))
+                finally:
+                    spool.close()
+        BYTES.labels("upload").inc(total)
+        return uploads
+    except BaseException:
+        close_uploads(uploads)
+        raise
+
+
+def close_uploads(uploads: List[SpooledUpload]) -> None:
+    for upload in uploads:
+        upload.close()
+
+
+@asynccontextmanager
+async def ingested_uploads(files: List[UploadFile]) -> AsyncIterator[List[SpooledUpload]]:
+    uploads = await ingest_uploads(files)
+    try:
+        yield uploads
+    finally:
+        close_uploads(uploads)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as handle:
+        return handle.read()
+
+
+def _write_file(path: str, content: bytes) -> None:
+    with open(path, "wb") as handle:
+        handle.write(content)
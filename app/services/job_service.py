@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import os
+import shutil
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException, UploadFile
+from sqlalchemy import and_, or_, select, update
+
+from app.core.config import settings
+from app.db.models import ExtractionJob, PDFExtraction, utcnow
+from app.db.session import SessionLocal
+from app.services.ingestion import SpooledUpload, close_uploads, ingest_uploads
+from app.services.llm_scheduler import batch_priority
+from app.services.metrics import RETRIES
+from app.schemas.job import JobStatus
+from app.schemas.pdf import PDFExtraction as PDFExtractionSchema
+
+JOB_KINDS = ("medical", "tables")
+
+
+class JobService:
+    """
+    Coda persistente di job di estrazione con un pool di worker in-process.
+
+    I job e i file caricati sono salvati su database e su disco prima di rispondere,
+    quindi sopravvivono al riavvio del processo. Ogni worker prende in carico un job
+    con un lease, rinnovato finché il tentativo è in corso: se il processo muore, alla
+    scadenza del lease il job torna disponibile per un altro worker (anche di un'altra
+    istanza uvicorn); all'arresto ordinato torna subito in coda. Le scritture finali
+    valgono solo per il tentativo che possiede ancora il job. Il numero di
+    worker (JOB_WORKERS) regola il throughput indipendentemente dalle connessioni HTTP.
+    """
+
+    def __init__(self, pdf_service, structure_service, workers: int = 2):
+        self.pdf_service = pdf_service
+        self.structure_service = structure_service
+        self.workers = workers
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+        logging.info(f"Job worker pool avviato con {self.workers} worker")
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, kind: str, files: List[UploadFile]) -> str:
+        if kind not in JOB_KINDS:
+            raise HTTPException(status_code=400, detail=f"Unsupported job kind: {kind}")
+
+        job_id = str(uuid.uuid4())
+        job_dir = os.path.join(settings.JOBS_DIR, job_id)
+        uploads = await ingest_uploads(files)
+        try:
+            stored = await self._store_uploads(job_dir, uploads)
+        finally:
+            close_uploads(uploads)
+        await asyncio.to_thread(self._insert_job, job_id, kind, stored)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        logging.info(f"Job {job_id} accodato ({kind}, {len(stored)} file)")
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[JobStatus]:
+        return await asyncio.to_thread(self._load_status, job_id)
+
+    async def _worker(self, worker_number: int) -> None:
+        while not self._stopping:
+            try:
+                job = await asyncio.to_thread(self._claim_next)
+            except Exception as e:
+                logging.error(f"Job worker {worker_number}: errore nel prelievo dalla coda: {str(e)}")
+                job = None
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=settings.JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            await self._run(job)
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        renewal = asyncio.create_task(self._keep_lease(job, asyncio.current_task()))
+        try:
+            uploads = [await SpooledUpload.from_path(f["path"], f["filename"]) for f in job["files"]]
+            logging.info(f"Job {job_id}: tentativo {job['attempts']}")
+            # I job cedono il passo alle richieste HTTP nella coda delle chiamate al modello
+            with batch_priority():
+                if job["kind"] == "tables":
+                    extracted_data = await self.pdf_service.extract_tables_data(uploads)
+                else:
+                    medical_fields = await self.structure_service.process_medical_files(uploads)
+                    extracted_data = {"medical_fields": medical_fields}
+            renewal.cancel()
+            if await asyncio.to_thread(self._complete, job, extracted_data):
+                logging.info(f"Job {job_id} completato")
+            else:
+                logging.warning(f"Job {job_id}: lease perso durante il tentativo {job['attempts']}, risultato scartato")
+        except asyncio.CancelledError:
+            if job.get("lease_lost") and not self._stopping:
+                # Il job è passato a un altro worker: questo tentativo si ferma senza toccarlo
+                asyncio.current_task().uncancel()
+                logging.warning(f"Job {job_id}: lease perso durante il tentativo {job['attempts']}, interrotto")
+                return
+            # Arresto del worker: il job torna in coda subito, senza attendere la scadenza del lease
+            await asyncio.to_thread(self._release, job)
+            logging.info(f"Job {job_id} rimesso in coda per l'arresto del worker")
+            raise
+        except Exception as e:
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+            retry = job["attempts"] < settings.JOB_MAX_ATTEMPTS
+            logging.error(f"Job {job_id} fallito ({'nuovo tentativo' if retry else 'definitivo'}): {error}")
+            if retry:
+                RETRIES.labels("job").inc()
+            await asyncio.to_thread(self._fail, job, error, retry)
+        finally:
+            renewal.cancel()
+
+    async def _keep_lease(self, job: Dict[str, Any], runner: asyncio.Task) -> None:
+        """
+        Rinnova il lease del job mentre il tentativo è in corso. Se il lease è già passato
+        a un altro worker (processo sospeso oltre la scadenza) il tentativo viene interrotto.
+        """
+        while True:
+            await asyncio.sleep(settings.JOB_LEASE_SECONDS / 3)
+            try:
+                renewed = await asyncio.to_thread(self._renew_lease, job)
+            except Exception as e:
+                logging.error(f"Job {job['id']}: rinnovo del lease fallito: {str(e)}")
+                continue
+            if not renewed:
+                job["lease_lost"] = True
+                runner.cancel()
+                return
+
+    async def _store_uploads(self, job_dir: str, uploads: List[SpooledUpload]) -> List[Dict[str, str]]:
+        """Sposta gli upload nella cartella del job (i file già su disco non vengono ricopiati)."""
+        await asyncio.to_thread(os.makedirs, job_dir, exist_ok=True)
+        stored = []
+        for index, upload in enumerate(uploads):
+            path = os.path.join(job_dir, f"{index:03d}_{os.path.basename(upload.filename)}")
+            await upload.save(path)
+            stored.append({"filename": upload.filename, "path": path})
+        return stored
+
+    def _insert_job(self, job_id: str, kind: str, files: List[Dict[str, str]]) -> None:
+        with SessionLocal.begin() as session:
+            session.add(ExtractionJob(id=job_id, kind=kind, status="queued", files=files, attempts=0))
+
+    def _claim_next(self) -> Optional[Dict[str, Any]]:
+        now = utcnow()
+        with SessionLocal.begin() as session:
+            job = session.execute(
+                select(ExtractionJob)
+                .where(or_(
+                    ExtractionJob.status == "queued",
+                    and_(ExtractionJob.status == "running", ExtractionJob.lease_expires_at < now),
+                ))
+                .order_by(ExtractionJob.created_at)
+                .limit(1)
+            ).scalar_one_or_none()
+            if job is None:
+                return None
+
+            # Aggiornamento condizionato: se un altro worker ha preso il job nel frattempo
+            # `attempts` è cambiato e nessuna riga viene aggiornata. Il valore va letto
+            # prima: l'update sincronizza l'oggetto `job` della sessione.
+            attempts = job.attempts + 1
+            claimed = session.execute(
+                update(ExtractionJob)
+                .where(ExtractionJob.id == job.id, ExtractionJob.attempts == job.attempts)
+                .values(
+                    status="running",
+                    attempts=attempts,
+                    started_at=now,
+                    lease_expires_at=now + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+                )
+            ).rowcount
+            if claimed != 1:
+                return None
+            return {"id": job.id, "kind": job.kind, "files": job.files, "attempts": attempts}
+
+    def _owned(self, job: Dict[str, Any]):
+        """Condizione delle scritture sul job: ancora in corso con il tentativo di questo worker."""
+        return and_(
+            ExtractionJob.id == job["id"],
+            ExtractionJob.status == "running",
+            ExtractionJob.attempts == job["attempts"],
+        )
+
+    def _renew_lease(self, job: Dict[str, Any]) -> bool:
+        with SessionLocal.begin() as session:
+            return session.execute(
+                update(ExtractionJob)
+                .where(self._owned(job))
+                .values(lease_expires_at=utcnow() + timedelta(seconds=settings.JOB_LEASE_SECONDS))
+            ).rowcount == 1
+
+    def _complete(self, job: Dict[str, Any], extracted_data: Dict[str, Any]) -> bool:
+        """Registra il risultato; False se il job non appartiene più a questo tentativo."""
+        files = job["files"]
+        with SessionLocal.begin() as session:
+            owned = session.execute(
+                update(ExtractionJob)
+                .where(self._owned(job))
+                .values(status="completed", error=None, finished_at=utcnow(), lease_expires_at=None)
+            ).rowcount == 1
+            if not owned:
+                return False
+            extraction = PDFExtraction(
+                filename=", ".join(f["filename"] for f in files),
+                extracted_data=extracted_data,
+            )
+            session.add(extraction)
+            session.flush()
+            session.execute(
+                update(ExtractionJob).where(ExtractionJob.id == job["id"]).values(extraction_id=extraction.id)
+            )
+        self._remove_uploads(files)
+        return True
+
+    def _fail(self, job: Dict[str, Any], error: str, retry: bool) -> None:
+        values = {"error": error, "lease_expires_at": None}
+        if retry:
+            values["status"] = "queued"
+        else:
+            values.update(status="failed", finished_at=utcnow())
+        with SessionLocal.begin() as session:
+            owned = session.execute(update(ExtractionJob).where(self._owned(job)).values(**values)).rowcount == 1
+        if owned and not retry:
+            self._remove_uploads(job["files"])
+
+    def _release(self, job: Dict[str, Any]) -> None:
+        """Rimette in coda un job interrotto dall'arresto; il tentativo non viene contato."""
+        with SessionLocal.begin() as session:
+            session.execute(
+                update(ExtractionJob)
+                .where(self._owned(job))
+                .values(status="queued", attempts=job["attempts"] - 1, lease_expires_at=None)
+            )
+
+    def _remove_uploads(self, files: List[Dict[str, str]]) -> None:
+        if files:
+            shutil.rmtree(os.path.dirname(files[0]["path"]), ignore_errors=True)
+
+    def _load_status(self, job_id: str) -> Optional[JobStatus]:
+        with SessionLocal() as session:
+            job = session.get(ExtractionJob, job_id)
+            if job is None:
+                return None
+            return JobStatus(
+                id=job.id,
+                kind=job.kind,
+                status=job.status,
+                filenames=[f["filename"] for f in job.files],
+                attempts=job.attempts,
+                error=job.error,
+                created_at=job.created_at,
+                started_at=job.started_at,
+                finished_at=job.finished_at,
+                result=PDFExtractionSchema.model_validate(job.extraction) if job.extraction else None,
+            )
+
+
+def run_migrations() -> None:
+    """Porta il database all'ultima revisione Alembic (usato all'avvio se DB_AUTO_MIGRATE)."""
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config("alembic.ini")
+    config.attributes["configure_logger"] = False
+    command.upgrade(config, "head")
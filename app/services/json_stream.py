@@ -0,0 +1,207 @@
+"""
+Parser JSON incrementale per le risposte vision {"tables": [{"page", "headers", "data"}]}.
+
+Il testo arriva a pezzi durante lo streaming: ogni riga di "data" viene restituita da
+`feed` appena la sua parentesi di chiusura è arrivata, senza attendere la fine della
+risposta. Se la risposta si interrompe (limite di token raggiunto) `tables` contiene
+le righe complete lette fino a quel punto, da cui una richiesta di continuazione può
+ripartire; `append_continuation` unisce poi le tabelle della continuazione.
+
+Eventuale testo prima del JSON (es. ```json) e dopo la sua chiusura viene ignorato.
+"""
+import json
+import re
+from json.decoder import scanstring
+from typing import Any, Dict, List, Optional, Tuple
+
+_WHITESPACE = " \t\r\n"
+_NUMBER = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?")
+_NUMBER_PREFIX = re.compile(r"-?[\d.eE+-]*")
+_DELIMITERS = ",]}" + _WHITESPACE
+_LITERALS = {"true": True, "false": False, "null": None}
+
+
+class TablesStreamParser:
+    """
+    Legge la risposta a pezzi; `feed` restituisce le righe completate (tabella, riga).
+    Su JSON malformato il parsing si ferma e `error` ne riporta il motivo.
+    """
+
+    def __init__(self):
+        self.tables: List[Dict[str, Any]] = []
+        self.complete = False
+        self.error: Optional[str] = None
+        self.rows = 0
+        self._buffer = ""
+        self._position = 0
+        # Contenitori aperti: [tipo "{" o "[", inizio, chiave o indice corrente, stato]
+        self._stack: List[List[Any]] = []
+
+    def feed(self, text: str) -> List[Tuple[int, List[Any]]]:
+        """Aggiunge testo e restituisce le righe completate nel frattempo."""
+        self._buffer += text
+        return self._parse()
+
+    def finish(self) -> List[Tuple[int, List[Any]]]:
+        """
+        Fine della risposta. Se il JSON non è chiuso la risposta è troncata, anche quando
+        si interrompe a metà di un valore ("page": nu, 1500.): `complete` resta False
+        senza `error`, e una continuazione riparte dall'ultima riga completa.
+        """
+        return self._parse()
+
+    def _parse(self) -> List[Tuple[int, List[Any]]]:
+        if self.complete or self.error:
+            return []
+        try:
+            return self._scan()
+        except ValueError as e:
+            self.error = str(e)
+            return []
+
+    def _scan(self) -> List[Tuple[int, List[Any]]]:
+        rows: List[Tuple[int, List[Any]]] = []
+        buffer = self._buffer
+        position = self._position
+        stack = self._stack
+        while position < len(buffer) and not self.complete:
+            char = buffer[position]
+            if char in _WHITESPACE:
+                position += 1
+                continue
+            if not stack:
+                if char == "{":
+                    stack.append(["{", position, None, "key"])
+                position += 1
+                continue
+
+            frame = stack[-1]
+            kind, state = frame[0], frame[3]
+            if state == "comma":
+                if char == ",":
+                    if kind == "{":
+                        frame[3] = "key"
+                    else:
+                        frame[2] += 1
+                        frame[3] = "value"
+                    position += 1
+                elif char == ("}" if kind == "{" else "]"):
+                    position = self._close(position, rows)
+                else:
+                    raise ValueError(f"JSON non valido alla posizione {position}: {char!r}")
+                continue
+            if kind == "{" and state == "key":
+                if char == "}":
+                    position = self._close(position, rows)
+                    continue
+                if char != '"':
+                    raise ValueError(f"JSON non valido alla posizione {position}: {char!r}")
+                try:
+                    frame[2], position = scanstring(buffer, position + 1, False)
+                except ValueError:
+                    break
+                frame[3] = "colon"
+                continue
+            if state == "colon":
+                if char != ":":
+                    raise ValueError(f"JSON non valido alla posizione {position}: {char!r}")
+                frame[3] = "value"
+                position += 1
+                continue
+            if kind == "[" and state == "value" and char == "]":
+                position = self._close(position, rows)
+                continue
+
+            # Inizio di un valore
+            if char in "{[":
+                stack.append([char, position, 0 if char == "[" else None, "value" if char == "[" else "key"])
+                if char == "{" and self._path()[:1] == ("tables",) and len(stack) == 3:
+                    self.tables.append({})
+                position += 1
+                continue
+            if char == '"':
+                try:
+                    value, end = scanstring(buffer, position + 1, False)
+                except ValueError:
+                    break
+            else:
+                match = _NUMBER.match(buffer, position)
+                literal = next((word for word in _LITERALS if buffer.startswith(word, position)), None)
+                # Un numero è completo solo quando lo segue un delimitatore ("1" può diventare
+                # "1.5"): dentro un oggetto aperto non può chiudere la risposta
+                if match and match.end() < len(buffer) and buffer[match.end()] in _DELIMITERS:
+                    value, end = json.loads(match.group()), match.end()
+                elif literal:
+                    value, end = _LITERALS[literal], position + len(literal)
+                elif _NUMBER_PREFIX.fullmatch(buffer, position) or any(
+                    word.startswith(buffer[position:]) for word in _LITERALS
+                ):
+                    # Valore interrotto dalla fine del testo arrivato finora
+                    break
+                else:
+                    raise ValueError(f"JSON non valido alla posizione {position}: {char!r}")
+            self._on_value(self._path(), value, rows)
+            frame[3] = "comma"
+            position = end
+
+        self._position = position
+        return rows
+
+    def _path(self) -> Tuple[Any, ...]:
+        """Percorso del valore corrente: chiavi degli oggetti e indici degli array aperti."""
+        return tuple(frame[2] for frame in self._stack)
+
+    def _close(self, position: int, rows: List[Tuple[int, List[Any]]]) -> int:
+        path = self._path()
+        frame = self._stack.pop()
+        if not self._stack:
+            self.complete = True
+            return position + 1
+        parent_path = path[:-1]
+        if self._interesting(parent_path):
+            self._on_value(parent_path, json.loads(self._buffer[frame[1]:position + 1]), rows)
+        self._stack[-1][3] = "comma"
+        return position + 1
+
+    def _interesting(self, path: Tuple[Any, ...]) -> bool:
+        # Righe (tables[i].data[j]) e attributi delle tabelle (tables[i].headers, ...)
+        return len(path) >= 3 and path[0] == "tables" and (
+            (len(path) == 3 and path[2] != "data") or (len(path) == 4 and path[2] == "data")
+        )
+
+    def _on_value(self, path: Tuple[Any, ...], value: Any, rows: List[Tuple[int, List[Any]]]) -> None:
+        if not self._interesting(path) or not self.tables:
+            return
+        table = self.tables[-1]
+        if len(path) == 3:
+            table[path[2]] = value
+        elif isinstance(value, list):
+            table.setdefault("data", []).append(value)
+            self.rows += 1
+            rows.append((len(self.tables) - 1, value))
+
+
+def append_continuation(
+    tables: List[Dict[str, Any]], more: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Unisce le tabelle di una continuazione a quelle già lette. Se la prima tabella
+    della continuazione ha le stesse intestazioni dell'ultima (interrotta), le sue
+    righe proseguono quella tabella, tolte quelle che il modello ha ripetuto.
+    """
+    tables = list(tables)
+    if tables and more and _same_table(tables[-1], more[0]):
+        done, rows = tables[-1].get("data", []), more[0].get("data", [])
+        overlap = next(
+            (size for size in range(min(len(done), len(rows)), 0, -1) if done[-size:] == rows[:size]), 0
+        )
+        tables[-1] = {**tables[-1], "data": done + rows[overlap:]}
+        more = more[1:]
+    return tables + list(more)
+
+
+def _same_table(table: Dict[str, Any], other: Dict[str, Any]) -> bool:
+    page: Optional[Any] = table.get("page")
+    return table.get("headers") == other.get("headers") and (
+        page is None or other.get("page") is None or str(page) == str(other.get("page"))
+    )
@@ -0,0 +1,256 @@
+"""
+Template di layout dei referti, appresi per formato (in pratica per laboratorio).
+
+Un template descrive le tabelle di una pagina: per ciascuna il testo della riga di
+intestazione, le intestazioni come le restituisce il modello e i confini delle colonne
+in frazioni dell'estensione della riga di intestazione, quindi indipendenti da
+risoluzione, margini e ritaglio della scansione. Applicarlo significa ritrovare le
+righe di intestazione tra le parole della pagina (text layer o Tesseract) e assegnare
+ogni parola alla colonna nota, come fa `text_layer` con le colonne di una griglia.
+
+Un template si apprende da una pagina letta dal modello solo se la lettura
+deterministica con le colonne ricavate ne riproduce le celle. Sono funzioni pure,
+eseguite nei processi del CPU executor; l'archivio è in `template_store`.
+"""
+import difflib
+import hashlib
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from app.services import text_layer
+
+# Parola (x0, y0, x1, y1, testo), come in text_layer (che importa questo modulo)
+Word = Tuple[float, float, float, float, str]
+
+# Similarità minima tra il testo di una riga e l'intestazione di un template
+HEADER_SIMILARITY = 0.85
+
+
+def normalize_text(text: str) -> str:
+    """Minuscolo, senza accenti né punteggiatura, con spazi singoli."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+
+def similarity(first: str, second: str) -> float:
+    """Similarità di due testi normalizzati (0 sotto HEADER_SIMILARITY)."""
+    return _similarity(difflib.SequenceMatcher(None, "", second), first)
+
+
+def similar(first: str, second: str) -> bool:
+    """Testi normalizzati uguali a meno di errori di lettura (HEADER_SIMILARITY)."""
+    return similarity(first, second) > 0
+
+
+def template_id(header_texts: Sequence[str]) -> str:
+    """Id del layout: impronta dei testi di intestazione delle sue tabelle, nell'ordine."""
+    return hashlib.sha1("|".join(header_texts).encode("utf-8")).hexdigest()[:16]
+
+
+def candidates(templates: List[Dict[str, Any]], headers: List[str]) -> List[Dict[str, Any]]:
+    """
+    Template le cui tabelle corrispondono una a una, dall'alto, alle intestazioni
+    individuate sulla pagina: una tabella in più o in meno esclude il template, così
+    nessuna tabella della pagina resta fuori dalla lettura.
+    """
+    detected = [normalize_text(header) for header in headers]
+    return [
+        template for template in templates
+        if len(template["tables"]) == len(detected)
+        and all(similar(text, table["header_text"]) for table, text in zip(template["tables"], detected))
+    ]
+
+
+def match_page(
+    words: List[Word], templates: List[Dict[str, Any]]
+) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Id del template che si applica alla pagina e tabelle lette con le sue colonne; None
+    se nessun template corrisponde. Tra più template possibili (intestazioni simili di
+    laboratori diversi) vale quello con le intestazioni più simili.
+    """
+    if not words or not templates:
+        return None
+    lines = text_layer._group_lines(words)
+    texts = [normalize_text(" ".join(word[4] for word in line)) for line in lines]
+    hits = _header_hits(texts, {table["header_text"] for template in templates for table in template["tables"]})
+    # Le intestazioni note presenti sulla pagina devono essere esattamente quelle del
+    # template: una tabella in più finirebbe nelle righe dell'ultima tabella letta
+    starts = sorted({index for found in hits.values() for index in found})
+    scored = []
+    for template in templates:
+        if len(template["tables"]) != len(starts):
+            continue
+        scores = [hits[table["header_text"]].get(start, 0.0) for table, start in zip(template["tables"], starts)]
+        if all(scores):
+            scored.append((sum(scores), template))
+    for _, template in sorted(scored, key=lambda item: -item[0]):
+        tables = _apply(lines, starts, template)
+        if tables is not None:
+            for table in tables:
+                table["layout_template"] = template["id"]
+            return template["id"], tables
+    return None
+
+
+def learn_layout(
+    words: List[Word],
+    tables: List[Dict[str, Any]],
+    headers: List[str],
+    min_agreement: float,
+) -> Optional[Dict[str, Any]]:
+    """
+    Template dalla lettura del modello (`tables`) e dalle parole della stessa pagina.
+    `headers` sono le intestazioni individuate localmente, che devono corrispondere alle
+    tabelle del modello perché il template sia poi riconoscibile. None se le colonne non
+    emergono o se la lettura con esse concorda con il modello su meno di `min_agreement`
+    delle celle.
+    """
+    tables = [table for table in tables if table.get("headers") and table.get("data")]
+    if not words or not tables:
+        return None
+    lines = text_layer._group_lines(words)
+    texts = [normalize_text(" ".join(word[4] for word in line)) for line in lines]
+
+    # Le tabelle del modello seguono l'ordine delle immagini inviate: le si riordina
+    # dall'alto come le intestazioni sulla pagina
+    positions = []
+    for table in tables:
+        header_text = _header_text(table["headers"])
+        index = next((index for index, text in enumerate(texts) if similar(text, header_text)), None)
+        if index is None:
+            return None
+        positions.append(index)
+    if len(set(positions)) != len(positions):
+        return None
+    tables = [table for _, table in sorted(zip(positions, tables), key=lambda item: item[0])]
+    starts = sorted(positions)
+    header_texts = [_header_text(table["headers"]) for table in tables]
+    layout_tables = [{"headers": list(table["headers"]), "header_text": text} for table, text in zip(tables, header_texts)]
+    layout = {"id": template_id(header_texts), "tables": layout_tables}
+    if not candidates([layout], headers):
+        return None
+    page_width = max(word[2] for word in words) + 1
+    for table, span in zip(layout_tables, _spans(lines, starts)):
+        columns = text_layer._column_bounds([text_layer._segments(line) for line in span], page_width)
+        if len(columns) != len(table["headers"]):
+            return None
+        x0, width = _extent(span[0])
+        table["columns"] = [[round((left - x0) / width, 4), round((right - x0) / width, 4)] for left, right in columns]
+
+    extracted = _apply(lines, starts, layout)
+    if extracted is None:
+        return None
+    cells = equal = 0
+    for table, read in zip(tables, extracted):
+        expected, actual = table["data"], read["data"]
+        cells += max(len(expected), len(actual)) * len(table["headers"])
+        equal += sum(
+            normalize_text(str(first)) == normalize_text(str(second))
+            for expected_row, actual_row in zip(expected, actual)
+            for first, second in zip(expected_row, actual_row)
+        )
+    if not cells or equal / cells < min_agreement:
+        return None
+    return layout
+
+
+def compatible(first: Dict[str, Any], second: Dict[str, Any]) -> bool:
+    """
+    True se i due campioni hanno le stesse tabelle e colonne che si corrispondono: ogni
+    colonna si sovrappone alla stessa dell'altro campione e l'unione resta separata
+    dalle vicine. Le estensioni dipendono dal contenuto della pagina (il nome d'esame
+    più lungo), non dal layout, e quindi non devono coincidere.
+    """
+    if len(first["tables"]) != len(second["tables"]):
+        return False
+    for table, other in zip(first["tables"], second["tables"]):
+        if len(table["columns"]) != len(other["columns"]):
+            return False
+        if any(
+            max(left, other_left) >= min(right, other_right)
+            for (left, right), (other_left, other_right) in zip(table["columns"], other["columns"])
+        ):
+            return False
+        columns = _union(table["columns"], other["columns"])
+        if any(previous[1] >= current[0] for previous, current in zip(columns, columns[1:])):
+            return False
+    return True
+
+
+def merge(layout: Dict[str, Any], sample: Dict[str, Any]) -> Dict[str, Any]:
+    """Unisce le colonne di un nuovo campione compatibile a quelle del template."""
+    tables = [
+        {**table, "columns": _union(table["columns"], other["columns"])}
+        for table, other in zip(layout["tables"], sample["tables"])
+    ]
+    return {**layout, "tables": tables}
+
+
+def _apply(
+    lines: List[List[Word]], starts: List[int], template: Dict[str, Any]
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Tabelle lette con le colonne del template dalle righe di intestazione `starts`.
+    None se le intestazioni non cadono ciascuna nella sua colonna: stesse intestazioni
+    ma colonne in altre posizioni sono un altro layout.
+    """
+    tables = []
+    for table, span in zip(template["tables"], _spans(lines, starts)):
+        x0, width = _extent(span[0])
+        columns = [(x0 + left * width, x0 + right * width) for left, right in table["columns"]]
+        # La prima sequenza di righe tabellari parte dalla riga di intestazione
+        runs = text_layer.tables_from_words([word for line in span for word in line], 0, columns)
+        if not runs or not all(
+            similar(normalize_text(cell), normalize_text(header))
+            for cell, header in zip(runs[0]["headers"], table["headers"])
+        ):
+            return None
+        tables.append({"headers": list(table["headers"]), "data": runs[0]["data"]})
+    return tables
+
+
+def _header_text(headers: List[str]) -> str:
+    """Testo della riga di intestazione: le colonne senza etichetta non vi compaiono."""
+    return normalize_text(" ".join(header for header in headers if not text_layer.is_header_placeholder(header)))
+
+
+def _header_hits(texts: List[str], header_texts: Set[str]) -> Dict[str, Dict[int, float]]:
+    """Per ogni intestazione, le righe della pagina che le somigliano e la similarità."""
+    hits = {}
+    for header_text in header_texts:
+        # Un matcher per intestazione: SequenceMatcher indicizza la seconda sequenza
+        matcher = difflib.SequenceMatcher(None, "", header_text)
+        found = {}
+        for index, text in enumerate(texts):
+            score = _similarity(matcher, text)
+            if score:
+                found[index] = score
+        hits[header_text] = found
+    return hits
+
+
+def _similarity(matcher: difflib.SequenceMatcher, text: str) -> float:
+    if text == matcher.b:
+        return 1.0
+    matcher.set_seq1(text)
+    if matcher.real_quick_ratio() < HEADER_SIMILARITY or matcher.quick_ratio() < HEADER_SIMILARITY:
+        return 0.0
+    ratio = matcher.ratio()
+    return ratio if ratio >= HEADER_SIMILARITY else 0.0
+
+
+def _spans(lines: List[List[Word]], starts: List[int]) -> List[List[List[Word]]]:
+    """Righe di ogni tabella: dalla sua intestazione a quella della tabella successiva."""
+    return [lines[start:end] for start, end in zip(starts, starts[1:] + [len(lines)])]
+
+
+def _union(columns: List[List[float]], others: List[List[float]]) -> List[List[float]]:
+    return [[min(a[0], b[0]), max(a[1], b[1])] for a, b in zip(columns, others)]
+
+
+def _extent(line: List[Word]) -> Tuple[float, float]:
+    x0 = min(word[0] for word in line)
+    return x0, max(1.0, max(word[2] for word in line) - x0)
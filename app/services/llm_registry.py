@@ -0,0 +1,124 @@
+import importlib.util
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+import openai
+from langchain_openai import ChatOpenAI
+
+from app.core.config import settings
+from app.services.metrics import TokenUsageCallback
+
+
+class _CountingTransport(httpx.AsyncHTTPTransport):
+    """Transport che conta le richieste e le nuove connessioni aperte dal pool."""
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.requests = 0
+        self.connections_opened = 0
+        self._known_connections = set()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        response = await super().handle_async_request(request)
+        current = {id(connection) for connection in self._pool.connections}
+        self.connections_opened += len(current - self._known_connections)
+        self._known_connections = current
+        return response
+
+
+class LLMClientRegistry:
+    """
+    Client HTTP e modelli condivisi dall'applicazione.
+
+    Un solo pool di connessioni (dimensionato esplicitamente, con keep-alive e HTTP/2
+    quando il pacchetto `h2` è disponibile) viene creato nel lifespan di FastAPI e
+    riusato da tutte le istanze `ChatOpenAI`, così le richieste non ripetono handshake TLS.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = True,
+        timeout: float = 120.0,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        self.timeout = timeout
+        self._transport: Optional[_CountingTransport] = None
+        self._async_http: Optional[httpx.AsyncClient] = None
+        self._sync_http: Optional[httpx.Client] = None
+        self._async_openai: Optional[openai.AsyncOpenAI] = None
+        self._sync_openai: Optional[openai.OpenAI] = None
+        self._models: Dict[Tuple, ChatOpenAI] = {}
+
+    def start(self) -> None:
+        if self._async_http is not None:
+            return
+        self._transport = _CountingTransport(limits=self.limits, http2=self.http2)
+        self._async_http = httpx.AsyncClient(transport=self._transport, timeout=self.timeout)
+        self._sync_http = httpx.Client(limits=self.limits, http2=self.http2, timeout=self.timeout)
+        client_params = {
+            "api_key": settings.OPENAI_API_KEY,
+            "base_url": settings.OPENAI_BASE_URL or None,
+            "timeout": self.timeout,
+            # I nuovi tentativi sono gestiti da `llm_scheduler`
+            "max_retries": 0,
+        }
+        self._async_openai = openai.AsyncOpenAI(http_client=self._async_http, **client_params)
+        self._sync_openai = openai.OpenAI(http_client=self._sync_http, **client_params)
+        logging.info(
+            f"LLM client registry avviato (max_connections={self.limits.max_connections}, "
+            f"keepalive={self.limits.max_keepalive_connections}, http2={self.http2})"
+        )
+
+    async def aclose(self) -> None:
+        if self._async_http is not None:
+            await self._async_http.aclose()
+            self._sync_http.close()
+        self._async_http = self._sync_http = None
+        self._async_openai = self._sync_openai = None
+        self._transport = None
+        self._models.clear()
+
+    def chat(self, model: str, **kwargs: Any) -> ChatOpenAI:
+        """Restituisce (e memorizza) un `ChatOpenAI` sul pool condiviso per questi parametri."""
+        self.start()
+        key = (model, tuple(sorted(kwargs.items())))
+        if key not in self._models:
+            self._models[key] = ChatOpenAI(
+                model=model,
+                api_key=settings.OPENAI_API_KEY,
+                client=self._sync_openai.chat.completions,
+                async_client=self._async_openai.chat.completions,
+                callbacks=[TokenUsageCallback(model)],
+                **kwargs,
+            )
+        return self._models[key]
+
+    def stats(self) -> Dict[str, Any]:
+        transport = self._transport
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "requests": transport.requests if transport else 0,
+            "connections_opened": transport.connections_opened if transport else 0,
+            "open_connections": len(transport._pool.connections) if transport else 0,
+            "models": len(self._models),
+        }
+
+
+llm_registry = LLMClientRegistry(
+    max_connections=settings.LLM_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+    http2=settings.LLM_HTTP2,
+)
@@ -0,0 +1,333 @@
+"""
+Scheduler centrale delle chiamate al modello.
+
+Tutte le chiamate di `PDFService` e `StructureDataService` passano da qui:
+
+- concorrenza massima (LLM_MAX_CONCURRENCY) e budget di richieste e token al minuto
+  (LLM_RPM_LIMIT, LLM_TPM_LIMIT) applicati con due token bucket; i token di ogni
+  chiamata sono stimati in anticipo, immagini comprese, dalle dimensioni delle pagine;
+- coda a priorità: le richieste HTTP ("interactive") passano prima dei job ("batch");
+- oltre LLM_MAX_QUEUE chiamate interattive in attesa si risponde subito 503;
+- 429, errori 5xx e di connessione vengono ritentati con backoff esponenziale con
+  jitter, rispettando `Retry-After`; un 429 sospende anche le altre chiamate;
+- ogni tentativo ha una scadenza (LLM_CALL_TIMEOUT); una chiamata interattiva che
+  supera il percentile LLM_HEDGE_PERCENTILE delle latenze recenti della sua fase viene
+  duplicata, se c'è capacità libera, e vince la prima risposta.
+
+Le ripetizioni del client OpenAI sono disattivate in `llm_registry`.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import openai
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.services.metrics import HEDGES, LLM_CALLS, LLM_QUEUE, RETRIES, stage_timer
+
+T = TypeVar("T")
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+_priority: ContextVar[str] = ContextVar("morfeo_llm_priority", default="interactive")
+
+# Stima dei token: caratteri per token del testo e formula OpenAI per le immagini
+CHARS_PER_TOKEN = 4
+IMAGE_LOW_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+IMAGE_MAX_EDGE = 2048
+IMAGE_SHORT_EDGE = 768
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+# Latenze recenti conservate per fase (base del percentile di hedging)
+LATENCY_WINDOW = 200
+
+
+@contextmanager
+def batch_priority() -> Iterator[None]:
+    """Le chiamate al modello eseguite nel blocco (anche nei task figli) hanno priorità batch."""
+    token = _priority.set("batch")
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def text_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """Token di un'immagine: lato lungo entro 2048, lato corto entro 768, 170 token ogni tile 512x512."""
+    if detail == "low" or not width or not height:
+        return IMAGE_LOW_TOKENS
+    scale = min(1.0, IMAGE_MAX_EDGE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, IMAGE_SHORT_EDGE / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return IMAGE_LOW_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+class TokenBucket:
+    """Bucket che si ricarica di `per_minute` unità al minuto; 0 = nessun limite."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.capacity)
+
+    def take(self, amount: float, now: float) -> None:
+        if self.capacity > 0:
+            self._refill(now)
+            self.level -= min(amount, self.capacity)
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        max_concurrency: int,
+        rpm: int = 0,
+        tpm: int = 0,
+        max_queue: int = 0,
+        max_retries: int = 4,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        call_timeout: float = 180.0,
+        hedge_percentile: Optional[float] = None,
+        hedge_min_samples: int = 20,
+    ):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.call_timeout = call_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self._active = 0
+        self._waiters: List[Tuple[int, int, int, str, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.counters = {"calls": 0, "retries": 0, "shed": 0, "rate_limited": 0, "hedged": 0, "hedge_wins": 0}
+
+    async def call(self, stage: str, tokens: int, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Esegue `fn` (una chiamata al modello, idempotente) quando budget e priorità lo
+        consentono. Solleva `asyncio.TimeoutError` se un tentativo supera LLM_CALL_TIMEOUT.
+        """
+        priority = _priority.get()
+        self._check_queue(stage, priority)
+        attempt = 0
+        while True:
+            with stage_timer("llm_queue_wait"):
+                await self._acquire(tokens, priority)
+            try:
+                self.counters["calls"] += 1
+                return await asyncio.wait_for(self._run(stage, tokens, priority, fn), self.call_timeout)
+            except RETRYABLE_ERRORS as e:
+                rate_limited = isinstance(e, openai.RateLimitError)
+                if rate_limited:
+                    self.counters["rate_limited"] += 1
+                if attempt >= self.max_retries:
+                    if rate_limited:
+                        raise HTTPException(
+                            status_code=503,
+                            detail="LLM provider rate limit exceeded, retry later",
+                            headers={"Retry-After": str(math.ceil(self._retry_delay(e, attempt)))},
+                        )
+                    raise
+                delay = self._retry_delay(e, attempt)
+                reason = type(e).__name__
+                if rate_limited:
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            finally:
+                self._release()
+            attempt += 1
+            self.counters["retries"] += 1
+            RETRIES.labels("llm").inc()
+            logging.warning(f"{stage}: {reason}, nuovo tentativo {attempt}/{self.max_retries} tra {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _run(self, stage: str, tokens: int, priority: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """Un tentativo, duplicato se la risposta tarda oltre la soglia di hedging."""
+        started = time.monotonic()
+        primary = asyncio.ensure_future(fn())
+        attempts = [primary]
+        try:
+            threshold = self._hedge_threshold(stage) if priority == "interactive" else None
+            if threshold is not None:
+                done, _ = await asyncio.wait({primary}, timeout=threshold)
+                if not done and self._acquire_spare(tokens):
+                    self.counters["hedged"] += 1
+                    HEDGES.labels(stage, "issued").inc()
+                    logging.info(f"{stage}: nessuna risposta dopo {threshold:.1f}s, richiesta duplicata")
+                    hedge = asyncio.ensure_future(fn())
+                    hedge.add_done_callback(lambda _: self._release())
+                    attempts.append(hedge)
+            pending = set(attempts)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Vince la prima risposta riuscita; un errore conta solo se non resta altro in corso
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None or not pending:
+                    winner = winner or next(iter(done))
+                    break
+            result = winner.result()
+            if winner is not primary:
+                self.counters["hedge_wins"] += 1
+                HEDGES.labels(stage, "won").inc()
+            self._latencies[stage].append(time.monotonic() - started)
+            return result
+        finally:
+            for task in attempts:
+                if task.done() and not task.cancelled():
+                    task.exception()  # l'errore del tentativo perdente è già stato gestito
+                task.cancel()
+
+    def _hedge_threshold(self, stage: str) -> Optional[float]:
+        """Percentile configurato delle latenze recenti della fase; None senza abbastanza campioni."""
+        latencies = self._latencies[stage]
+        if self.hedge_percentile is None or len(latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    def _acquire_spare(self, tokens: int) -> bool:
+        """Occupa subito un posto solo se nessuno è in coda e il budget lo consente."""
+        now = time.monotonic()
+        if self._active >= self.max_concurrency or any(not waiter[4].done() for waiter in self._waiters):
+            return False
+        if max(self._paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now)) > 0:
+            return False
+        self.requests.take(1, now)
+        self.tokens.take(tokens, now)
+        self._active += 1
+        return True
+
+    def _check_queue(self, stage: str, priority: str) -> None:
+        """Le chiamate interattive oltre la profondità massima della coda vengono rifiutate."""
+        if priority != "interactive" or not self.max_queue:
+            return
+        waiting = sum(1 for waiter in self._waiters if waiter[3] == "interactive" and not waiter[4].done())
+        if waiting >= self.max_queue:
+            self.counters["shed"] += 1
+            LLM_CALLS.labels(stage, "shed").inc()
+            retry_after = max(1, math.ceil(waiting / max(1, self.max_concurrency) * self.base_delay))
+            raise HTTPException(
+                status_code=503,
+                detail="Too many requests waiting for the model, retry later",
+                headers={"Retry-After": str(retry_after)},
+            )
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """
+        `Retry-After` del provider (più un piccolo jitter, così le chiamate sospese non
+        ripartono insieme) se presente, altrimenti backoff esponenziale con jitter pieno.
+        """
+        response = getattr(error, "response", None)
+        if response is not None:
+            for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+                try:
+                    return float(response.headers[header]) * scale + random.uniform(0, self.base_delay)
+                except (KeyError, ValueError):
+                    continue
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _acquire(self, tokens: int, priority: str) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITIES[priority], next(self._sequence), tokens, priority, future))
+        LLM_QUEUE.labels(priority).inc()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Il posto era già stato assegnato: lo si restituisce
+                self._release()
+            raise
+        finally:
+            LLM_QUEUE.labels(priority).dec()
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Assegna i posti liberi in ordine di priorità finché i budget lo permettono."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters and self._active < self.max_concurrency:
+            _, _, tokens, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            now = time.monotonic()
+            wait = max(
+                self._paused_until - now,
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(tokens, now),
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self.requests.take(1, now)
+            self.tokens.take(tokens, now)
+            self._active += 1
+            future.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        waiting = [waiter for waiter in self._waiters if not waiter[4].done()]
+        return {
+            **self.counters,
+            "active": self._active,
+            "queued": {priority: sum(1 for w in waiting if w[3] == priority) for priority in PRIORITIES},
+            "rpm_limit": int(self.requests.capacity),
+            "tpm_limit": int(self.tokens.capacity),
+            "paused_seconds": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            "hedge_thresholds": {
+                stage: round(threshold, 3)
+                for stage in list(self._latencies)
+                if (threshold := self._hedge_threshold(stage)) is not None
+            },
+        }
+
+
+llm_scheduler = LLMScheduler(
+    max_concurrency=settings.LLM_MAX_CONCURRENCY,
+    rpm=settings.LLM_RPM_LIMIT,
+    tpm=settings.LLM_TPM_LIMIT,
+    max_queue=settings.LLM_MAX_QUEUE,
+    max_retries=settings.LLM_MAX_RETRIES,
+    base_delay=settings.LLM_RETRY_BASE_DELAY,
+    max_delay=settings.LLM_RETRY_MAX_DELAY,
+    call_timeout=settings.LLM_CALL_TIMEOUT,
+    hedge_percentile=settings.LLM_HEDGE_PERCENTILE if settings.LLM_HEDGE_ENABLED else None,
+    hedge_min_samples=settings.LLM_HEDGE_MIN_SAMPLES,
+)
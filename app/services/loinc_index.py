@@ -0,0 +1,580 @@
+"""
+Indice LOINC locale: dal nome dell'esame stampato sul referto al codice LOINC e al
+pannello di appartenenza, senza chiamate al modello.
+
+Sorgenti (CSV della distribuzione LOINC, non incluse nel repository):
+- la tabella LOINC (`Loinc.csv` o `LoincTableCore.csv`): codici di laboratorio attivi,
+  indicizzati per COMPONENT;
+- la variante linguistica italiana (`itIT...LinguisticVariant.csv`), facoltativa;
+- `PanelsAndForms.csv`, per i pannelli (pannello → codici membri), facoltativo;
+- un CSV di sinonimi del laboratorio (`name,loinc[,panel]`), con la precedenza su tutto.
+
+I nomi sono normalizzati (accenti, punteggiatura, "B 12" → "b12", parole vuote, suffissi
+flessivi italiani, token ordinati) e cercati per hash; se non c'è corrispondenza esatta
+si passa ai trigrammi (coefficiente di Dice, soglia LOINC_MIN_SIMILARITY). Tra i codici
+con lo stesso nome si sceglie quello compatibile con l'unità di misura (es. "%" → frazione,
+"10^3/mm^3" → conteggio), poi per sistema (siero/plasma, sangue) e diffusione del test.
+Per i nomi in gergo di laboratorio (GLICEMIA, GLOBULI BIANCHI, ...) `ITALIAN_ALIASES`
+indica il COMPONENT inglese corrispondente; in un nome composto ("CALCIO IONIZZATO")
+l'alias di un token si sostituisce nel nome, che resta da cercare per intero: le parole
+in più cambiano l'analita.
+
+L'indice compilato viene salvato in JSON in LOINC_INDEX_PATH (un formato che non esegue
+codice alla lettura) e riletto all'avvio; è ricompilato solo quando cambiano le sorgenti.
+"""
+import csv
+import difflib
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import unicodedata
+from array import array
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.core.config import settings
+
+# Da incrementare a ogni modifica della normalizzazione o del formato dell'indice
+INDEX_VERSION = "3"
+NOT_FOUND = "N/A"
+
+# Codici candidati conservati per ogni nome normalizzato
+MAX_CANDIDATES = 64
+# Voci massime della memoizzazione delle ricerche (nome, unità)
+MEMO_ENTRIES = 100_000
+
+STOPWORDS = {
+    "di", "del", "della", "dei", "delle", "degli", "in", "e", "il", "la", "lo", "le", "gli",
+    "su", "per", "of", "the", "and", "by", "on", "totale", "total", "tot",
+}
+# Materiale e metodo: non cambiano l'analita ("FERRO SIERICO" è "FERRO")
+CONTEXT_WORDS = {
+    "siero", "sierico", "plasma", "plasmatico", "sangue", "ematico", "intero", "venoso",
+    "capillare", "dosaggio", "serum", "blood",
+}
+ABBREVIATIONS = {"lib": "liber", "ass": "assolut", "perc": "percentual", "tx": "transaminas"}
+# Ordine di preferenza dei sistemi a parità di nome
+SYSTEM_PREFERENCE = {"Ser/Plas": 0, "Bld": 1, "Ser": 2, "Plas": 3, "Ser/Plas/Bld": 4}
+
+# Nomi in gergo dei referti italiani → COMPONENT LOINC inglese
+ITALIAN_ALIASES = {
+    "GLICEMIA": "Glucose",
+    "GLUCOSIO": "Glucose",
+    "AZOTEMIA": "Urea nitrogen",
+    "UREA": "Urea",
+    "CREATININEMIA": "Creatinine",
+    "CREATININA": "Creatinine",
+    "URICEMIA": "Urate",
+    "ACIDO URICO": "Urate",
+    "SIDEREMIA": "Iron",
+    "FERRO": "Iron",
+    "FERRITINA": "Ferritin",
+    "TRANSFERRINA": "Transferrin",
+    "SODIEMIA": "Sodium",
+    "SODIO": "Sodium",
+    "POTASSIEMIA": "Potassium",
+    "POTASSIO": "Potassium",
+    "CLOREMIA": "Chloride",
+    "CALCEMIA": "Calcium",
+    "CALCIO": "Calcium",
+    "MAGNESEMIA": "Magnesium",
+    "FOSFOREMIA": "Phosphate",
+    "COLESTEROLO": "Cholesterol",
+    "COLESTEROLO TOTALE": "Cholesterol",
+    "COLESTEROLO HDL": "Cholesterol.in HDL",
+    "COLESTEROLO LDL": "Cholesterol.in LDL",
+    "TRIGLICERIDI": "Triglyceride",
+    "BILIRUBINA TOTALE": "Bilirubin",
+    "BILIRUBINA DIRETTA": "Bilirubin.glucuronidated+Bilirubin.albumin bound",
+    "BILIRUBINA INDIRETTA": "Bilirubin.non-glucuronidated",
+    "CALCIO IONIZZATO": "Calcium.ionized",
+    "COLESTEROLO NON HDL": "Cholesterol.non HDL",
+    "GOT": "Aspartate aminotransferase",
+    "AST": "Aspartate aminotransferase",
+    "GOT/AST TRANSAMINASI": "Aspartate aminotransferase",
+    "GPT": "Alanine aminotransferase",
+    "ALT": "Alanine aminotransferase",
+    "GPT/ALT TRANSAMINASI": "Alanine aminotransferase",
+    "GAMMA GT": "Gamma glutamyl transferase",
+    "FOSFATASI ALCALINA": "Alkaline phosphatase",
+    "INSULINA": "Insulin",
+    "EMOGLOBINA GLICATA": "Hemoglobin A1c/Hemoglobin.total",
+    "EMOGLOBINA": "Hemoglobin",
+    "EMATOCRITO": "Hematocrit",
+    "GLOBULI BIANCHI": "Leukocytes",
+    "LEUCOCITI": "Leukocytes",
+    "GLOBULI ROSSI": "Erythrocytes",
+    "ERITROCITI": "Erythrocytes",
+    "PIASTRINE": "Platelets",
+    "NEUTROFILI": "Neutrophils",
+    "LINFOCITI": "Lymphocytes",
+    "MONOCITI": "Monocytes",
+    "EOSINOFILI": "Eosinophils",
+    "BASOFILI": "Basophils",
+    "MCV": "Erythrocyte mean corpuscular volume",
+    "MCH": "Erythrocyte mean corpuscular hemoglobin",
+    "MCHC": "Erythrocyte mean corpuscular hemoglobin concentration",
+    "RDW": "Erythrocyte distribution width",
+    "RDW-CV": "Erythrocyte distribution width",
+    "RDW-SD": "Erythrocyte distribution width",
+    "MPV": "Platelet mean volume",
+    "PDW": "Platelet distribution width",
+    "PCT": "Plateletcrit",
+    "VES": "Erythrocyte sedimentation rate",
+    "PCR": "C reactive protein",
+    "TSH": "Thyrotropin",
+    "FT3": "Triiodothyronine.free",
+    "FT4": "Thyroxine.free",
+    "VITAMINA B12": "Cobalamins",
+    "COBALAMINA": "Cobalamins",
+    "FOLATI": "Folate",
+    "ACIDO FOLICO": "Folate",
+    "OMOCISTEINA": "Homocysteine",
+    "HCV": "Hepatitis C virus Ab",
+    "HBSAG": "Hepatitis B virus surface Ag",
+}
+
+# Proprietà LOINC compatibili con l'unità di misura stampata
+UNIT_PROPERTIES: List[Tuple[re.Pattern, Tuple[str, ...]]] = [
+    (re.compile(r"^%$"), ("NFr", "MFr", "VFr", "SFr", "CFr", "Ratio", "RelRto")),
+    (re.compile(r"^(x\s*)?10\^?\d+\s*/\s*(mm\^?3|ul|l|mcl)$|^/\s*(mm\^?3|ul|mcl)$"), ("NCnc",)),
+    (re.compile(r"^(k|m|u|n|p)?g\s*/\s*(d|m|c)?l$"), ("MCnc",)),
+    (re.compile(r"^(m|u|n|p)?(mol|eq)\s*/\s*(d|m)?l$"), ("SCnc",)),
+    (re.compile(r"^(m|u|k)?(u|ui|iu)\s*/\s*(d|m)?l$"), ("CCnc", "ACnc")),
+    (re.compile(r"^(p|f)g$"), ("EntMass",)),
+    (re.compile(r"^(fl|um\^?3)$"), ("EntVol",)),
+    (re.compile(r"^mm\s*/\s*h$"), ("Vel",)),
+    (re.compile(r"^s\s*/\s*co$|^index$"), ("ACnc", "PrThr")),
+]
+
+
+def normalize_name(name: str) -> str:
+    """Chiave di ricerca: minuscolo senza accenti, token senza flessione e ordinati."""
+    text = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii").lower()
+    text = re.sub(r"[^a-z0-9]+", " ", text)
+    # "vitamina b 12" → "vitamina b12"
+    text = re.sub(r"\b([a-z])\s+(\d+)\b", r"\1\2", text)
+    tokens = set()
+    for token in text.split():
+        if token in STOPWORDS:
+            continue
+        if len(token) >= 5 and token.isalpha() and token[-1] in "aeiou":
+            token = token[:-1]
+        tokens.add(ABBREVIATIONS.get(token, token))
+    return " ".join(sorted(tokens))
+
+
+_ALIAS_KEYS = {normalize_name(alias): normalize_name(component) for alias, component in ITALIAN_ALIASES.items()}
+_CONTEXT_TOKENS = set(normalize_name(" ".join(CONTEXT_WORDS)).split())
+_NOISE_WORDS = sorted(STOPWORDS | _CONTEXT_TOKENS)
+_NO_POSTINGS = array("I")
+
+
+def _rewrite_aliases(key: str) -> str:
+    """
+    Chiave con gli alias dei singoli token sostituiti dal COMPONENT ("calci ionizzat" →
+    "calcium ionizzat"); le parole di materiale e metodo si tolgono solo se resta l'alias.
+    """
+    tokens = key.split()
+    aliased = [_ALIAS_KEYS.get(token) for token in tokens]
+    if not any(aliased):
+        return key
+    if all(alias or token in _CONTEXT_TOKENS for token, alias in zip(tokens, aliased)):
+        tokens = [token for token in tokens if token not in _CONTEXT_TOKENS]
+        aliased = [_ALIAS_KEYS.get(token) for token in tokens]
+    return normalize_name(" ".join(alias or token for token, alias in zip(tokens, aliased)))
+
+
+def _qualifier(token: str) -> bool:
+    """
+    True se il token può cambiare l'analita: non è una parola di materiale o metodo né
+    una parola vuota letta male dall'OCR ("ttal" per "totale").
+    """
+    if len(token) <= 3 or token in _CONTEXT_TOKENS:
+        return False
+    return not any(
+        difflib.SequenceMatcher(None, token, word).ratio() >= 0.8 for word in _NOISE_WORDS
+    )
+
+
+def name_variants(name: str) -> List[str]:
+    """Il nome, il nome senza le parti tra parentesi e ciascuna di esse: "FT4 (TIROXINA LIB.)"."""
+    inner = re.findall(r"\(([^()]*)\)", name)
+    outer = re.sub(r"\([^()]*\)", " ", name)
+    variants = [name, outer, *inner] if inner else [name]
+    return [variant for variant in dict.fromkeys(v.strip() for v in variants) if variant]
+
+
+def unit_properties(unit: str) -> Optional[Tuple[str, ...]]:
+    """Proprietà LOINC ammesse per l'unità, None se l'unità non è riconosciuta."""
+    text = unit.strip().lower().replace("µ", "u").replace("μ", "u").replace("mc", "u").replace(" ", "")
+    text = text.replace("10e", "10^").replace("³", "^3")
+    for pattern, properties in UNIT_PROPERTIES:
+        if pattern.match(text):
+            return properties
+    return None
+
+
+def trigrams(key: str) -> List[str]:
+    padded = f"  {key} "
+    return sorted({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+
+class LoincIndex:
+    """Indice compatto dei nomi LOINC; `annotate` aggiunge codice e pannello ai campi."""
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None, min_similarity: float = 0.6):
+        self.min_similarity = min_similarity
+        self._load_data(data or _empty_index())
+
+    @property
+    def size(self) -> int:
+        return len(self.codes)
+
+    @property
+    def signature(self) -> str:
+        """Identità dell'indice per le chiavi di cache dei risultati."""
+        return f"{self._signature}:{self.min_similarity}"
+
+    @classmethod
+    def from_settings(cls) -> "LoincIndex":
+        return cls(min_similarity=settings.LOINC_MIN_SIMILARITY)
+
+    def load(self) -> None:
+        """
+        Legge l'indice da LOINC_INDEX_PATH o, se le sorgenti sono cambiate, lo ricompila
+        dai CSV configurati e lo salva. Senza sorgenti l'indice resta vuoto.
+        """
+        if not settings.LOINC_ENABLED:
+            return
+        sources = {
+            "table": settings.LOINC_TABLE_PATH,
+            "linguistic_variant": settings.LOINC_LINGUISTIC_VARIANT_PATH,
+            "panels": settings.LOINC_PANELS_PATH,
+            "synonyms": settings.LOINC_SYNONYMS_PATH,
+        }
+        sources = {kind: path for kind, path in sources.items() if path}
+        if not sources:
+            logging.info("Nessuna sorgente LOINC configurata: codici LOINC non disponibili")
+            return
+        signature = _sources_signature(sources)
+
+        data = None
+        path = settings.LOINC_INDEX_PATH
+        if os.path.exists(path):
+            try:
+                data = read_index(path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.warning(f"Indice LOINC illeggibile, lo si ricompila: {e}")
+            if data is not None and data.get("signature") != signature:
+                data = None
+        if data is None:
+            data = build_index(sources, signature)
+            write_index(data, path)
+            logging.info(f"Indice LOINC compilato: {len(data['codes'])} codici, {len(data['keys'])} nomi")
+        self._load_data(data)
+        logging.info(f"Indice LOINC caricato: {self.size} codici")
+
+    def lookup(self, name: str, unit: str = "") -> Optional[str]:
+        index = self._lookup(name, unit)
+        return None if index is None else self.codes[index]
+
+    def annotate(self, fields: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Aggiunge a ogni campo LOINC_value e belonging_panel_LOINC_value ("N/A" se
+        sconosciuti). Tra i pannelli di un codice si sceglie quello che contiene più
+        esami dello stesso referto.
+        """
+        memo = self._memo
+        matches = []
+        for field in fields:
+            memo_key = (field.get("field_name", ""), field.get("field_unit_of_measure", ""))
+            matches.append(memo[memo_key] if memo_key in memo else self._lookup(*memo_key))
+        coverage = Counter(panel for index in matches if index is not None for panel in self.panels_of[index])
+        for field, index in zip(fields, matches):
+            if index is None:
+                field["LOINC_value"] = field["belonging_panel_LOINC_value"] = NOT_FOUND
+                continue
+            field["LOINC_value"] = self.codes[index]
+            panels = self.panels_of[index]
+            if not panels:
+                field["belonging_panel_LOINC_value"] = NOT_FOUND
+            elif len(panels) == 1:
+                field["belonging_panel_LOINC_value"] = self.panel_codes[panels[0]]
+            else:
+                field["belonging_panel_LOINC_value"] = self.panel_codes[max(panels, key=coverage.__getitem__)]
+        return fields
+
+    def _load_data(self, data: Dict[str, Any]) -> None:
+        self._signature = data["signature"]
+        self.codes: List[str] = data["codes"]
+        self.properties: List[str] = data["properties"]
+        self.panel_codes: List[str] = data["panel_codes"]
+        self.panels_of: List[Tuple[int, ...]] = data["panels_of"]
+        self.keys: List[str] = data["keys"]
+        self.candidates: List[Tuple[int, ...]] = data["candidates"]
+        self.key_ids: Dict[str, int] = {key: position for position, key in enumerate(self.keys)}
+        self.key_trigrams: array = data["key_trigrams"]
+        self.postings: Dict[str, array] = data["postings"]
+        self._memo: Dict[Tuple[str, str], Optional[int]] = {}
+
+    def _lookup(self, name: str, unit: str) -> Optional[int]:
+        memo_key = (name, unit)
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+        result = None
+        keys = [key for key in map(normalize_name, name_variants(name)) if key]
+        if self.codes and keys:
+            # Nome esatto e alias del nome intero (per il nome completo e le sue parti tra
+            # parentesi), poi il nome con gli alias dei token sostituiti, esatto e per trigrammi
+            rewritten = [_rewrite_aliases(key) for key in keys]
+            exact = [k for key in keys for k in (key, _ALIAS_KEYS.get(key))] + rewritten
+            key_id = next((self.key_ids[k] for k in exact if k in self.key_ids), None)
+            if key_id is None:
+                queries = list(dict.fromkeys(keys + rewritten))
+                key_id, _ = max((self._fuzzy(key) for key in queries), key=lambda match: match[1])
+            if key_id is not None:
+                result = self._choose(self.candidates[key_id], unit)
+        if len(self._memo) >= MEMO_ENTRIES:
+            self._memo.clear()
+        self._memo[memo_key] = result
+        return result
+
+    def _fuzzy(self, key: str) -> Tuple[Optional[int], float]:
+        """
+        Nome indicizzato più simile per trigrammi (Dice) e punteggio, se sopra la soglia.
+        Un nome con almeno `required` trigrammi in comune contiene per forza uno dei
+        `len(grams) - required + 1` trigrammi più rari: solo quei nomi vengono valutati,
+        a partire da quelli che ne condividono di più, saltando quelli che anche con tutti
+        gli altri trigrammi in comune non supererebbero il migliore trovato.
+        """
+        grams = trigrams(key)
+        if not grams:
+            return None, 0.0
+        threshold = self.min_similarity
+        required = max(1, math.ceil(threshold * len(grams) / (2 - threshold)))
+        rare = len(grams) - required + 1
+        postings = sorted((self.postings.get(gram, _NO_POSTINGS) for gram in grams), key=len)
+        shared_rare: Counter = Counter()
+        for posting in postings[:rare]:
+            shared_rare.update(posting)
+        shortest, longest = len(grams) * threshold / (2 - threshold), len(grams) * (2 - threshold) / threshold
+        query = set(grams)
+        tokens = set(key.split())
+        qualifiers = {token for token in tokens if _qualifier(token)}
+        best, best_score = None, threshold
+        for key_id, shared in shared_rare.most_common():
+            size = self.key_trigrams[key_id]
+            if not shortest <= size <= longest:
+                continue
+            if 2 * (shared + len(grams) - rare) / (len(grams) + size) < best_score:
+                continue
+            score = 2 * len(query.intersection(trigrams(self.keys[key_id]))) / (len(grams) + size)
+            candidate = set(self.keys[key_id].split())
+            if candidate < tokens and qualifiers - candidate:
+                # Un nome più generico: "BILIRUBINA INDIRETTA" non è "BILIRUBINA"
+                continue
+            if score > best_score or (score == best_score and best is None):
+                best, best_score = key_id, score
+        return best, (best_score if best is not None else 0.0)
+
+    def _choose(self, candidates: Tuple[int, ...], unit: str) -> Optional[int]:
+        """
+        Primo candidato (già in ordine di preferenza) compatibile con l'unità; None se
+        l'unità è riconosciuta e nessun candidato ha una proprietà compatibile. I codici
+        dei sinonimi, senza proprietà, sono compatibili con qualunque unità.
+        """
+        properties = unit_properties(unit) if unit else None
+        if properties:
+            for index in candidates:
+                if not self.properties[index] or self.properties[index] in properties:
+                    return index
+            return None
+        return candidates[0]
+
+
+def _empty_index() -> Dict[str, Any]:
+    return {
+        "signature": "",
+        "codes": [],
+        "properties": [],
+        "panel_codes": [],
+        "panels_of": [],
+        "keys": [],
+        "candidates": [],
+        "key_trigrams": array("H"),
+        "postings": {},
+    }
+
+
+def build_index(sources: Dict[str, str], signature: str = "") -> Dict[str, Any]:
+    """Compila l'indice dai CSV: `sources` ha le chiavi table, linguistic_variant, panels, synonyms."""
+    codes: List[str] = []
+    properties: List[str] = []
+    ranks: List[Tuple] = []
+    code_ids: Dict[str, int] = {}
+    names: Dict[str, Dict[int, int]] = defaultdict(dict)
+    panel_parents = set()
+
+    def add_code(code: str, prop: str = "", rank: Tuple = (9, 9, 9, 9, 10 ** 6)) -> int:
+        if code not in code_ids:
+            code_ids[code] = len(codes)
+            codes.append(code)
+            properties.append(prop)
+            ranks.append(rank)
+        return code_ids[code]
+
+    def add_name(name: str, code_id: int, priority: int) -> None:
+        key = normalize_name(name)
+        if key:
+            names[key][code_id] = min(priority, names[key].get(code_id, priority))
+
+    def add_component(component: str, code_id: int, prop: str) -> None:
+        add_name(component, code_id, 1)
+        # "Neutrophils/100 leukocytes" (frazione) si cerca anche come "Neutrophils"
+        if "/" in component and prop.endswith("Fr"):
+            add_name(component.split("/")[0], code_id, 1)
+
+    if "table" in sources:
+        for row in _read_csv(sources["table"]):
+            code = row.get("LOINC_NUM", "")
+            if not code or row.get("STATUS", "ACTIVE") not in ("ACTIVE", ""):
+                continue
+            loinc_class = row.get("CLASS", "")
+            if loinc_class.startswith("PANEL") or row.get("PanelType") == "Panel":
+                panel_parents.add(code)
+                continue
+            if row.get("CLASSTYPE", "1") != "1":
+                continue
+            component = row.get("COMPONENT", "")
+            prop = row.get("PROPERTY", "")
+            common_rank = int(row.get("COMMON_TEST_RANK") or 0) or 10 ** 6
+            rank = (
+                0 if row.get("TIME_ASPCT", "Pt") == "Pt" else 1,
+                SYSTEM_PREFERENCE.get(row.get("SYSTEM", ""), 9),
+                0 if row.get("SCALE_TYP", "Qn") == "Qn" else 1,
+                0 if row.get("METHOD_TYP", "") in ("", "Automated count") else 1,
+                common_rank,
+            )
+            code_id = add_code(code, prop, rank)
+            add_component(component, code_id, prop)
+
+    if "linguistic_variant" in sources:
+        for row in _read_csv(sources["linguistic_variant"]):
+            code_id = code_ids.get(row.get("LOINC_NUM", ""))
+            if code_id is not None and row.get("COMPONENT"):
+                add_component(row["COMPONENT"], code_id, properties[code_id])
+
+    panel_members: Dict[str, List[str]] = defaultdict(list)
+    if "panels" in sources:
+        for row in _read_csv(sources["panels"]):
+            parent, member = row.get("ParentLoinc", ""), row.get("Loinc", "")
+            if parent and member and parent != member and (not panel_parents or parent in panel_parents):
+                panel_members[parent].append(member)
+
+    if "synonyms" in sources:
+        for row in _read_csv(sources["synonyms"]):
+            name, code = row.get("name", "").strip(), row.get("loinc", "").strip()
+            if name and code:
+                code_id = add_code(code)
+                # I sinonimi del laboratorio precedono qualunque altro nome
+                add_name(name, code_id, 0)
+                if row.get("panel"):
+                    panel_members[row["panel"].strip()].append(code)
+
+    # I nomi in gergo entrano nell'indice, così sono trovati anche se letti male dall'OCR
+    for alias_key, component_key in _ALIAS_KEYS.items():
+        for code_id, priority in list(names.get(component_key, {}).items()):
+            aliased = names[alias_key]
+            aliased[code_id] = min(priority, aliased.get(code_id, priority))
+
+    panel_codes = sorted(panel_members)
+    panels_of: List[List[int]] = [[] for _ in codes]
+    for panel_id, panel in enumerate(panel_codes):
+        for member in dict.fromkeys(panel_members[panel]):
+            if member in code_ids:
+                panels_of[code_ids[member]].append(panel_id)
+
+    keys = sorted(names)
+    candidates = [
+        tuple(sorted(names[key], key=lambda code_id: (names[key][code_id], ranks[code_id]))[:MAX_CANDIDATES])
+        for key in keys
+    ]
+    postings: Dict[str, List[int]] = defaultdict(list)
+    key_trigrams = array("H")
+    for key_id, key in enumerate(keys):
+        grams = trigrams(key)
+        key_trigrams.append(min(len(grams), 65535))
+        for gram in grams:
+            postings[gram].append(key_id)
+
+    return {
+        "signature": signature,
+        "codes": codes,
+        "properties": properties,
+        "panel_codes": panel_codes,
+        "panels_of": [tuple(panels) for panels in panels_of],
+        "keys": keys,
+        "candidates": candidates,
+        "key_trigrams": key_trigrams,
+        "postings": {gram: array("I", ids) for gram, ids in postings.items()},
+    }
+
+
+def write_index(data: Dict[str, Any], path: str) -> None:
+    """Salva l'indice compilato in JSON (scrittura atomica)."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    serialized = {
+        **data,
+        "key_trigrams": data["key_trigrams"].tolist(),
+        "postings": {gram: ids.tolist() for gram, ids in data["postings"].items()},
+    }
+    with open(path + ".tmp", "w", encoding="utf-8") as handle:
+        json.dump(serialized, handle, ensure_ascii=False, separators=(",", ":"))
+    os.replace(path + ".tmp", path)
+
+
+def read_index(path: str) -> Dict[str, Any]:
+    """
+    Rilegge un indice salvato da `write_index`.
+
+    Raises:
+        ValueError: se il file non è un indice valido
+    """
+    with open(path, encoding="utf-8") as handle:
+        data = json.load(handle)
+    if not isinstance(data, dict):
+        raise ValueError("formato dell'indice non valido")
+    return {
+        "signature": str(data["signature"]),
+        "codes": data["codes"],
+        "properties": data["properties"],
+        "panel_codes": data["panel_codes"],
+        "panels_of": [tuple(panels) for panels in data["panels_of"]],
+        "keys": data["keys"],
+        "candidates": [tuple(candidates) for candidates in data["candidates"]],
+        "key_trigrams": array("H", data["key_trigrams"]),
+        "postings": {gram: array("I", ids) for gram, ids in data["postings"].items()},
+    }
+
+
+def _read_csv(path: str) -> Iterator[Dict[str, str]]:
+    with open(path, newline="", encoding="utf-8-sig") as handle:
+        yield from csv.DictReader(handle)
+
+
+def _sources_signature(sources: Dict[str, str]) -> str:
+    described = {
+        kind: [os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+        for kind, path in sorted(sources.items())
+    }
+    payload = json.dumps({"version": INDEX_VERSION, "sources": described}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+loinc_index = LoincIndex.from_settings()
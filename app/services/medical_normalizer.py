@@ -0,0 +1,203 @@
+"""
+Normalizzazione deterministica delle righe estratte dai referti in `MedicalFieldInfo`.
+
+Applica localmente le stesse regole che il prompt di `transform_medical_data` chiede
+al modello: virgola decimale → punto, range "3,1 - 20,5" → low/high, "< 5" / "> 40"
+come limite singolo, nome e unità copiati così come sono. Le righe ambigue (colonne
+non riconosciute, separatori delle migliaia, range multipli per sesso/età) vengono
+restituite come non risolte e inviate al modello.
+"""
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# Parole chiave delle intestazioni, in ordine di priorità: "valoriNormali" deve
+# essere riconosciuto come range prima che "valor" lo classifichi come valore.
+HEADER_ROLES: List[Tuple[str, Tuple[str, ...]]] = [
+    ("range", ("normal", "riferiment", "range", "intervall", "limit", "reference", "rif.")),
+    ("unit", ("unit", "u.m", "misura", "um")),
+    ("value", ("esit", "risult", "valor", "value", "result", "dato")),
+    ("name", ("esam", "descri", "analis", "test", "parametr", "prestazion", "determinazion",
+              "indagin", "nome", "name")),
+]
+
+EMPTY_VALUES = {"", "-", "--", "/", "n/a", "na", "n.d.", "nd"}
+
+# Esiti qualitativi copiati così come sono. Un testo fuori da questo vocabolario nella
+# colonna del valore è di solito una colonna scivolata ("mg/dL" al posto di "95") e va
+# lasciato al modello.
+QUALITATIVE_RE = re.compile(
+    r"^(?:(?:debolmente|fortemente|francamente)\s+)?(?:non\s+)?"
+    r"(?:positiv[oaie]|negativ[oaie]|assent[ei]|present[ei]|tracce|normal[ei]|reattiv[oaie]|"
+    r"rilevat[oaie]|rilevabil[ei]|dosabil[ei]|dubbi[oa]|indeterminat[oaie]|"
+    r"positive|negative|absent|present|traces?|normal|reactive|detected|"
+    r"limpid[oa]|torbid[oa]|opalescente|giallo(?:\s+paglierino)?|paglierino|ambra)$",
+    re.IGNORECASE,
+)
+
+NUMBER = r"[+-]?\d+(?:[.,]\d+)*"
+NUMBER_RE = re.compile(rf"^{NUMBER}$")
+# Flag di anomalia accodati al valore: "13,23 *", "5,2 H", "↑ 180", "(L) 3,1"
+FLAG_RE = re.compile(r"^\s*(?:[*↑↓]+|\(?[HL+]\)?)\s+|\s+(?:[*↑↓]+|\(?[HL+]\)?)\s*$|[*↑↓]+")
+VALUE_WITH_UNIT_RE = re.compile(rf"^({NUMBER})\s*([^\d\s].*)$")
+BETWEEN_RE = re.compile(rf"^(?:da\s+)?({NUMBER})\s*(?:-|–|—|÷|~|\ba\b|\bto\b)\s*({NUMBER})$", re.IGNORECASE)
+UPPER_RE = re.compile(rf"^(?:<=?|≤|fino\s+a|inferiore\s+a|minore\s+di|up\s+to)\s*({NUMBER})$", re.IGNORECASE)
+LOWER_RE = re.compile(rf"^(?:>=?|≥|superiore\s+a|maggiore\s+di|oltre)\s*({NUMBER})$", re.IGNORECASE)
+
+
+class MedicalRowNormalizer:
+    """Converte le righe di `clean_table_data_json` in record `MedicalFieldInfo`."""
+
+    def normalize(self, rows: List[Dict[str, Any]]) -> Tuple[List[Optional[Dict[str, str]]], List[int]]:
+        """
+        Restituisce una lista allineata a `rows` con il record normalizzato (o None per
+        le righe scartate o non risolte) e gli indici delle righe da inviare al modello.
+        """
+        fields: List[Optional[Dict[str, str]]] = []
+        unresolved: List[int] = []
+        for index, row in enumerate(rows):
+            status, field = self.normalize_row(row)
+            fields.append(field)
+            if status == "unresolved":
+                unresolved.append(index)
+        return fields, unresolved
+
+    def normalize_row(self, row: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, str]]]:
+        """Restituisce ("ok", record), ("skip", None) per righe vuote o di sezione, ("unresolved", None)."""
+        cells = self._classify(row)
+        if cells is None:
+            return "unresolved", None
+
+        name = cells.get("name", "").strip()
+        raw_value = cells.get("value", "").strip()
+        raw_range = cells.get("range", "").strip()
+        unit = cells.get("unit", "").strip()
+
+        if not name:
+            return ("skip", None) if not raw_value and not raw_range else ("unresolved", None)
+        if raw_value.lower() in EMPTY_VALUES:
+            # Titoli di sezione ("EMOCROMO") senza valore né range
+            return ("skip", None) if raw_range.lower() in EMPTY_VALUES else ("unresolved", None)
+
+        if NUMBER_RE.match(unit):
+            # Un numero nella colonna dell'unità: le celle non sono allineate alle intestazioni
+            return "unresolved", None
+        value, embedded_unit = self._parse_value(raw_value)
+        if value is None:
+            return "unresolved", None
+        if not unit and embedded_unit:
+            unit = embedded_unit
+
+        bounds = self._parse_range(raw_range, unit)
+        if bounds is None:
+            return "unresolved", None
+
+        return "ok", {
+            "field_name": name,
+            "field_value": value,
+            "field_unit_of_measure": unit,
+            "reference_range_low": bounds[0],
+            "reference_range_high": bounds[1],
+        }
+
+    def _classify(self, row: Dict[str, Any]) -> Optional[Dict[str, str]]:
+        """
+        Associa ogni colonna a un ruolo; None se le colonne non sono riconoscibili o se
+        una cella piena non ha un'intestazione classificata (celle più delle intestazioni).
+        """
+        cells: Dict[str, str] = {}
+        for key, value in row.items():
+            role = self._header_role(str(key))
+            if role is None:
+                if str(value).strip():
+                    return None
+                continue
+            if role in cells:
+                if str(value).strip() and cells[role]:
+                    return None
+                cells[role] = cells[role] or str(value)
+            else:
+                cells[role] = str(value)
+        if "name" not in cells or "value" not in cells:
+            return None
+        return cells
+
+    def _header_role(self, header: str) -> Optional[str]:
+        header = header.lower()
+        for role, keywords in HEADER_ROLES:
+            for keyword in keywords:
+                if keyword == "um":
+                    if header in ("um", "u.m", "u.m."):
+                        return role
+                elif keyword in header:
+                    return role
+        return None
+
+    def _parse_value(self, raw: str) -> Tuple[Optional[str], str]:
+        value = FLAG_RE.sub("", raw).strip()
+        comparator = ""
+        if value[:1] in "<>≤≥":
+            comparator, value = value[0], value[1:].strip()
+
+        unit = ""
+        if not NUMBER_RE.match(value):
+            match = VALUE_WITH_UNIT_RE.match(value)
+            if match and not comparator:
+                value, unit = match.group(1), match.group(2).strip()
+            elif comparator or re.search(r"\d", value):
+                # Numeri con testo non interpretabile: meglio chiedere al modello
+                return None, ""
+            elif QUALITATIVE_RE.match(" ".join(value.split())):
+                # Esiti qualitativi ("Negativo", "Assente") copiati così come sono
+                return raw.strip(), ""
+            else:
+                return None, ""
+
+        number = self._normalize_number(value)
+        if number is None:
+            return None, ""
+        return f"{comparator}{number}", unit
+
+    def _parse_range(self, raw: str, unit: str) -> Optional[Tuple[str, str]]:
+        text = raw.strip()
+        if unit and text.lower().endswith(unit.lower()):
+            text = text[: -len(unit)].strip()
+        if text.lower() in EMPTY_VALUES:
+            return "", ""
+
+        match = BETWEEN_RE.match(text)
+        if match:
+            low, high = self._normalize_number(match.group(1)), self._normalize_number(match.group(2))
+            if low is None or high is None:
+                return None
+            return low, high
+
+        match = UPPER_RE.match(text)
+        if match:
+            high = self._normalize_number(match.group(1))
+            return ("", high) if high is not None else None
+
+        match = LOWER_RE.match(text)
+        if match:
+            low = self._normalize_number(match.group(1))
+            return (low, "") if low is not None else None
+
+        return None
+
+    def _normalize_number(self, text: str) -> Optional[str]:
+        """
+        Porta il numero alla notazione con il punto decimale mantenendo le cifre scritte
+        ("0,120" → "0.120"). Restituisce None se il separatore è ambiguo ("252.000").
+        """
+        text = text.strip()
+        if "," in text and "." in text:
+            if text.rfind(",") < text.rfind("."):
+                return None
+            return text.replace(".", "").replace(",", ".")
+        if text.count(",") > 1 or text.count(".") > 1:
+            return None
+        if "." in text:
+            integer, decimals = text.lstrip("+-").split(".")
+            if len(decimals) == 3 and integer not in ("", "0"):
+                return None
+            return text
+        return text.replace(",", ".")
@@ -0,0 +1,214 @@
+"""
+Metriche Prometheus e header `Server-Timing`.
+
+Ogni fase della pipeline è misurata con `stage_timer(stage)`: la durata finisce
+nell'istogramma `morfeo_stage_seconds` e, se la fase appartiene a una richiesta HTTP,
+nei tempi riportati nell'header `Server-Timing` della risposta. Le metriche sono
+esposte su `/metrics`; con più worker uvicorn va impostata la variabile
+PROMETHEUS_MULTIPROC_DIR (modalità multiprocesso di prometheus_client).
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+from starlette.requests import Request
+from starlette.responses import Response
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUEST_SECONDS = Histogram(
+    "morfeo_request_seconds", "Durata delle richieste HTTP", ["route", "method", "status"],
+    buckets=STAGE_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge("morfeo_requests_in_flight", "Richieste HTTP in corso", multiprocess_mode="livesum")
+STAGE_SECONDS = Histogram(
+    "morfeo_stage_seconds", "Durata delle fasi della pipeline", ["stage"], buckets=STAGE_BUCKETS
+)
+STAGE_IN_FLIGHT = Gauge(
+    "morfeo_stage_in_flight", "Fasi in corso (chiamate al modello, task CPU)", ["stage"],
+    multiprocess_mode="livesum",
+)
+PAGES = Counter("morfeo_pages_total", "Pagine elaborate per origine", ["source"])
+BYTES = Counter("morfeo_bytes_total", "Byte caricati e inviati al modello", ["kind"])
+LLM_TOKENS = Counter("morfeo_llm_tokens_total", "Token consumati", ["model", "direction"])
+LLM_CALLS = Counter("morfeo_llm_calls_total", "Chiamate al modello per esito", ["stage", "outcome"])
+LLM_QUEUE = Gauge(
+    "morfeo_llm_queue_depth", "Chiamate al modello in attesa per priorità", ["priority"],
+    multiprocess_mode="livesum",
+)
+ENGINE_PAGES = Counter(
+    "morfeo_engine_pages_total", "Pagine renderizzate per motore di estrazione (escalated: da Tesseract al modello)", ["engine"]
+)
+LAYOUT_TEMPLATE_PAGES = Counter(
+    "morfeo_layout_template_pages_total",
+    "Pagine lette con un template di layout (matched) o no, e campioni di apprendimento (learned, not_learned, skipped)",
+    ["outcome"],
+)
+VISION_TRUNCATIONS = Counter(
+    "morfeo_vision_truncations_total", "Risposte vision troncate: continuate o lasciate parziali", ["outcome"]
+)
+BATCH_REPORTS = Counter(
+    "morfeo_batch_reports_total", "Referti delle richieste batch per esito (cached: dalla cache)", ["outcome"]
+)
+HEDGES = Counter("morfeo_llm_hedges_total", "Richieste duplicate (hedging) e quelle che hanno vinto", ["stage", "result"])
+RETRIES = Counter("morfeo_retries_total", "Nuovi tentativi", ["component"])
+CACHE_LOOKUPS = Counter("morfeo_cache_lookups_total", "Letture della cache dei risultati", ["result"])
+SINGLE_FLIGHT = Counter(
+    "morfeo_single_flight_total", "Richieste eseguite (leader) o agganciate a una identica in corso (follower)", ["role"]
+)
+EVENT_LOOP_LAG = Histogram(
+    "morfeo_event_loop_lag_seconds", "Ritardo del loop asyncio rispetto al risveglio previsto",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+# Intervallo di campionamento del ritardo del loop
+EVENT_LOOP_SAMPLE_SECONDS = 0.1
+
+# Tempi per fase della richiesta corrente (None fuori da una richiesta HTTP)
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("morfeo_request_timings", default=None)
+
+
+def _record(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def collect_timings() -> Iterator[Dict[str, float]]:
+    """Raccoglie il totale per fase di tutto ciò che viene eseguito nel blocco (anche nei task figli)."""
+    timings: Dict[str, float] = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """Misura un blocco sincrono o un `await` come fase `stage`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(stage, time.perf_counter() - started)
+
+
+@asynccontextmanager
+async def in_flight(stage: str) -> AsyncIterator[None]:
+    """Come `stage_timer`, contando anche le istanze in corso della fase."""
+    gauge = STAGE_IN_FLIGHT.labels(stage)
+    gauge.inc()
+    try:
+        with stage_timer(stage):
+            yield
+    finally:
+        gauge.dec()
+
+
+async def monitor_event_loop(interval: float = EVENT_LOOP_SAMPLE_SECONDS) -> None:
+    """Misura di quanto ogni risveglio del loop arriva in ritardo (lavoro sincrono che lo blocca)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+
+def record_page(entry: Dict[str, Any]) -> None:
+    PAGES.labels(entry["source"]).inc()
+    if entry.get("bytes_original"):
+        BYTES.labels("image_original").inc(entry["bytes_original"])
+    if entry["source"] == "vision" and entry.get("bytes"):
+        BYTES.labels("image_sent").inc(entry["bytes"])
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """Conta i token riportati dal provider (`llm_output.token_usage`) per ogni chiamata."""
+
+    def __init__(self, model: str):
+        self.model = model
+
+    def on_llm_end(self, response: Any, **kwargs: Any) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage.get("prompt_tokens"):
+            LLM_TOKENS.labels(self.model, "in").inc(usage["prompt_tokens"])
+        if usage.get("completion_tokens"):
+            LLM_TOKENS.labels(self.model, "out").inc(usage["completion_tokens"])
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: durata e richieste in corso per route, header `Server-Timing`
+    con il totale di ogni fase eseguita durante la richiesta.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+        REQUESTS_IN_FLIGHT.inc()
+        timings: Dict[str, float] = {}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                entries = [f"{_metric_name(stage)};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()]
+                entries.append(f"total;dur={(time.perf_counter() - started) * 1000:.1f}")
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", ", ".join(entries).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            with collect_timings() as timings:
+                await self.app(scope, receive, send_with_timing)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            REQUEST_SECONDS.labels(_route_label(scope), scope["method"], str(status["code"])).observe(
+                time.perf_counter() - started
+            )
+
+
+def _route_label(scope) -> str:
+    """Percorso della route con i parametri al posto dei valori (es. /morfeo/jobs/{job_id})."""
+    if "endpoint" not in scope:
+        return "unmatched"
+    path = scope["path"]
+    for name, value in scope.get("path_params", {}).items():
+        path = path.replace(str(value), "{" + name + "}")
+    return path
+
+
+def _metric_name(stage: str) -> str:
+    return "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in stage)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
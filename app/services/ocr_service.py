@@ -1,192 +1,630 @@
-import base64
-from typing import List, Dict, Any
-from fastapi import UploadFile
+from typing import List, Dict, Any, AsyncIterator, Callable, Optional, Tuple
 from bs4 import BeautifulSoup
-from pdf2image import convert_from_bytes
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage
 import os
 import asyncio
-from io import BytesIO
+from collections import deque
 import json
-import fitz
 import logging
+import time
 from app.core.config import settings
+from app.services import metrics, page_fingerprint, render_worker, text_layer
+from app.services.cache_service import result_cache, single_flight
+from app.services.cpu_executor import cpu_executor
+from app.services.ingestion import SpooledUpload
+from app.services.extraction_engines import (
+    ENGINE_MODES,
+    ExtractionEngine,
+    LLMEngine,
+    RowCallback,
+    TemplateEngine,
+    TesseractEngine,
+    normalize_tables_response,
+)
+from app.services.render_policy import RenderPolicy
+from app.services.template_store import template_store
 from fastapi import HTTPException
 
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp')
+
+# Pagine non inviate al modello, riportate in metadata.skipped_pages
+SKIPPED_SOURCES = ("no_table", "blank", "duplicate")
+# Pagine non completate entro la scadenza della richiesta, riportate in metadata.missing_pages
+MISSING_SOURCE = "missing"
+# File di un referto del batch che non è stato possibile leggere o renderizzare
+FAILED_SOURCE = "failed"
+# Campi interni delle pagine esclusi da metadata e stream
+INTERNAL_FIELDS = ("data_url", "ink_mask", "table_boxes")
+
+
 class PDFService:
-    async def extract_tables_data(self, files: List[UploadFile]) -> Dict[str, Any]:
+    def __init__(
+        self,
+        render_policy: Optional[RenderPolicy] = None,
+        llm_engine: Optional[ExtractionEngine] = None,
+        local_engine: Optional[ExtractionEngine] = None,
+        template_engine: Optional[TemplateEngine] = None,
+    ):
+        self.render_policy = render_policy or RenderPolicy.from_settings()
+        self.llm_engine = llm_engine or LLMEngine()
+        self.local_engine = local_engine or TesseractEngine.from_settings()
+        self.template_engine = template_engine or TemplateEngine.from_settings()
+
+    def engine_mode(self, engine: Optional[str] = None) -> str:
+        """Modalità di estrazione richiesta, o quella di EXTRACTION_ENGINE."""
+        mode = engine or settings.EXTRACTION_ENGINE
+        if mode not in ENGINE_MODES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Motore di estrazione non valido: {mode} ({', '.join(ENGINE_MODES)})"
+            )
+        return mode
+
+    def cache_params(self, engine: Optional[str] = None, packed: bool = False) -> Dict[str, Any]:
+        """
+        Parametri che determinano il risultato dell'estrazione, usati nella chiave di cache.
+        `packed` per l'estrazione batch, con le pagine di più referti nella stessa chiamata.
+        """
+        mode = self.engine_mode(engine)
+        fanout = ["packed", settings.BATCH_PAGES_PER_CALL] if packed else [
+            settings.LLM_FANOUT_MODE, settings.LLM_PAGES_PER_CALL
+        ]
+        params = {
+            "engine": mode,
+            "render_policy": self.render_policy.model_dump(),
+            "text_layer": [settings.TEXT_LAYER_ENABLED, settings.TEXT_LAYER_MIN_CHARS],
+            "fanout": fanout,
+            "dedup": [settings.PAGE_DEDUP_MAX_DISTANCE, settings.PAGE_DEDUP_MAX_MISMATCH],
+            "layout_templates": settings.LAYOUT_TEMPLATES_ENABLED,
+        }
+        if mode != "tesseract":
+            params["llm"] = self.llm_engine.cache_params()
+        if mode != "llm":
+            params["local"] = {**self.local_engine.cache_params(), "min_confidence": settings.OCR_MIN_CONFIDENCE}
+        return params
+
+    async def extract_tables_data(
+        self, files: List[SpooledUpload], deadline: Optional[float] = None, engine: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Tabelle di tutte le pagine. Con `deadline` (istante di `time.monotonic()`) le pagine
+        non completate in tempo sono riportate in metadata.missing_pages e il risultato,
+        parziale, non viene messo in cache. Le richieste identiche in corso condividono
+        un'unica estrazione. `engine` sceglie il motore per le pagine renderizzate
+        ("llm", "tesseract" o "auto"; default EXTRACTION_ENGINE).
+        """
+        cache_key = result_cache.key_for_uploads("tables", files, **self.cache_params(engine))
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            logging.info("Tabelle restituite dalla cache")
+            return cached
+
+        async def extract() -> Dict[str, Any]:
+            result = await self._extract_tables_data(files, deadline, engine)
+            if not result["metadata"]["missing_pages"]:
+                await result_cache.set(cache_key, result)
+            return result
+
+        return await single_flight.run(cache_key, extract)
+
+    async def _extract_tables_data(
+        self, files: List[SpooledUpload], deadline: Optional[float] = None, engine: Optional[str] = None
+    ) -> Dict[str, Any]:
         try:
-            data_urls = []
-            
-            for file in files:
-                contents = await file.read()
-                if file.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.bmp')):
-                    img_buffer = BytesIO(contents)
-                    data_urls.append(self._images_to_data_urls([img_buffer])[0])
-                    logging.info(f"Immagine processata: {file.filename}")
-                else:
-                    image_buffers = self._pdf_to_images(contents)
-                    data_urls.extend(self._images_to_data_urls(image_buffers))
-                    logging.info(f"PDF processato: {file.filename}")
-            
-            logging.info(f"Totale immagini da processare: {len(data_urls)}")
-            result = await self._parse_tables_from_images(data_urls)
+            # Le pagine arrivano in ordine di completamento: si riordinano per posizione nel documento
+            items = [item async for item in self._iter_entries(files, deadline, engine)]
+            entries = [entry for _, entry in sorted(items, key=lambda item: item[0])]
+
+            result = normalize_tables_response({
+                "tables": [table for entry in entries for table in entry["tables"]]
+            })
+            result["metadata"] = {
+                "pages": [{**self.page_record(entry), "tables": len(entry["tables"])} for entry in entries],
+                "skipped_pages": [self.skipped_record(entry) for entry in entries
+                                  if entry["source"] in SKIPPED_SOURCES],
+                "missing_pages": [{"file": entry["file"], "page": entry["page"]} for entry in entries
+                                  if entry["source"] == MISSING_SOURCE],
+            }
             return result
         except Exception as e:
             logging.error(f"Errore durante l'estrazione delle tabelle: {str(e)}")
             raise
 
-    def _pdf_to_images(self, file_content: bytes, dpi: int = 800) -> List[BytesIO]:
-        try:
-            images = convert_from_bytes(file_content, dpi=dpi)
-            
-            image_buffers = []
-            for image in images:
-                img_buffer = BytesIO()
-                image.save(img_buffer, format='PNG', quality=100)
-                img_buffer.seek(0)
-                image_buffers.append(img_buffer)
-            
-            return image_buffers
-        except Exception as e:
-            logging.error(f"Error converting PDF to images: {e}")
-            raise
+    async def iter_page_tables(
+        self,
+        files: List[SpooledUpload],
+        deadline: Optional[float] = None,
+        engine: Optional[str] = None,
+        on_row: Optional[RowCallback] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Restituisce ogni pagina con le sue tabelle appena è pronta (ordine di completamento,
+        non di documento): le pagine dal text layer escono subito, quelle renderizzate
+        quando la relativa chiamata al modello termina. Allo scadere di `deadline` le
+        pagine rimanenti escono con source "missing". `on_row` riceve le righe lette dal
+        modello mentre la risposta è ancora in streaming.
+        """
+        async for _, entry in self._iter_entries(files, deadline, engine, on_row):
+            yield self.page_record(entry)
 
-    def _images_to_data_urls(self, image_buffers: List[BytesIO]) -> List[str]:
-        return [
-            f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode('utf-8')}"
-            for buf in image_buffers
-        ]
+    async def iter_report_pages(
+        self, files: List[SpooledUpload], reports: List[str], engine: Optional[str] = None
+    ) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Estrazione batch: `reports[i]` è il referto a cui appartiene `files[i]`. Le pagine
+        di referti diversi vengono impacchettate nelle stesse chiamate vision e restituite,
+        in ordine di completamento, come coppie (posizione, pagina) con la chiave "report".
+        Gli errori restano nei singoli referti: un file illeggibile produce una pagina con
+        source "failed" e una chiamata fallita viene ripetuta un referto alla volta.
+        """
+        async for position, entry in self._iter_entries(files, engine=engine, reports=reports):
+            yield position, self.page_record(entry)
 
-    def _process_llm_response(self, content: str) -> dict:
-        try:
-            logging.debug(f"Contenuto ricevuto dal modello: {content}")
-            
-            content = content.strip()
-            if content.startswith('```json'):
-                content = content[7:]
-            if content.endswith('```'):
-                content = content[:-3]
-            
+    async def stream_tables(
+        self,
+        files: List[SpooledUpload],
+        deadline: Optional[float] = None,
+        engine: Optional[str] = None,
+        rows: bool = False,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Record per lo streaming: uno per pagina ({"type": "page", ...}) e un riepilogo finale.
+        Con `rows` anche un record provvisorio {"type": "row", "file", "page", "table",
+        "headers", "row"} per ogni riga appena il modello la scrive; il record della pagina
+        resta quello definitivo.
+        """
+        started = time.perf_counter()
+        pages = tables = 0
+        failed_pages = []
+        skipped_pages = []
+        missing_pages = []
+        async for record in self._with_rows(
+            lambda on_row: self.iter_page_tables(files, deadline, engine, on_row), self.row_record if rows else None
+        ):
+            if record["type"] == "page":
+                pages += 1
+                tables += len(record["tables"])
+                if record["source"] == MISSING_SOURCE:
+                    missing_pages.append({"file": record["file"], "page": record["page"]})
+                elif "error" in record:
+                    failed_pages.append({"file": record["file"], "page": record["page"]})
+                if record["source"] in SKIPPED_SOURCES:
+                    skipped_pages.append(self.skipped_record(record))
+            yield record
+        yield {
+            "type": "summary",
+            "pages": pages,
+            "tables": tables,
+            "failed_pages": failed_pages,
+            "skipped_pages": skipped_pages,
+            "missing_pages": missing_pages,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000),
+        }
+
+    @staticmethod
+    async def _with_rows(
+        pages: Callable[[Optional[RowCallback]], AsyncIterator[Dict[str, Any]]],
+        row_record: Optional[Callable[[Dict[str, Any], int, List[str], List[str]], Optional[Dict[str, Any]]]],
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Record {"type": "page", ...} di `pages` intercalati, se `row_record` è dato, con i
+        record delle righe lette dal modello durante lo streaming delle risposte.
+        """
+        if row_record is None:
+            async for page in pages(None):
+                yield {"type": "page", **page}
+            return
+
+        records: asyncio.Queue = asyncio.Queue()
+
+        def on_row(page: Dict[str, Any], table: int, headers: List[str], row: List[str]) -> None:
+            record = row_record(page, table, headers, row)
+            if record is not None:
+                records.put_nowait(record)
+
+        async def produce() -> None:
             try:
-                return json.loads(content)
-            except json.JSONDecodeError as e:
-                logging.warning(f"Primo tentativo di parsing JSON fallito: {str(e)}")
-            
-            import re
-            json_match = re.search(r'\{[\s\S]*\}', content)
-            if json_match:
-                try:
-                    result = json.loads(json_match.group())
-                    return self._normalize_tables_response(result)
-                except json.JSONDecodeError as e:
-                    logging.error(f"Errore nel parsing del JSON estratto: {str(e)}")
-                    logging.error(f"JSON problematico: {json_match.group()}")
-                    raise
-            
-            logging.warning("Nessun JSON valido trovato nella risposta")
-            return {"tables": []}
-            
-        except Exception as e:
-            logging.error(f"Errore nel processing della risposta: {str(e)}")
-            raise
+                async for page in pages(on_row):
+                    await records.put({"type": "page", **page})
+            finally:
+                await records.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (record := await records.get()) is not None:
+                yield record
+            await producer
+        finally:
+            producer.cancel()
+
+    @staticmethod
+    def row_record(page: Dict[str, Any], table: int, headers: List[str], row: List[str]) -> Dict[str, Any]:
+        return {"type": "row", "file": page["file"], "page": page["page"], "table": table, "headers": headers, "row": row}
 
-    def _normalize_tables_response(self, result: dict) -> dict:
-        """Normalizza la risposta per assicurare una struttura consistente"""
-        if not isinstance(result, dict):
-            result = {"tables": []}
-        elif "tables" not in result:
-            result = {"tables": [result] if result else []}
-        
-        for table in result["tables"]:
-            if "headers" not in table:
-                table["headers"] = []
-            if "data" not in table:
-                table["data"] = []
-            
-            table["headers"] = [str(h).strip() for h in table["headers"] if h]
-            table["data"] = [
-                [str(cell).strip() for cell in row]
-                for row in table["data"]
-                if any(str(cell).strip() for cell in row)
+    def skipped_record(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        record = {"file": entry["file"], "page": entry["page"], "reason": entry["source"]}
+        if "duplicate_of" in entry:
+            record["duplicate_of"] = entry["duplicate_of"]
+        return record
+
+    def page_record(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Pagina senza le immagini codificate, come riportata in metadata e negli stream."""
+        record = {k: v for k, v in entry.items() if k not in INTERNAL_FIELDS}
+        if "regions" in record:
+            record["regions"] = [
+                {k: v for k, v in region.items() if k != "data_url"} for region in record["regions"]
             ]
-        
-        return result
+        return record
+
+    async def _iter_entries(
+        self,
+        files: List[SpooledUpload],
+        deadline: Optional[float] = None,
+        engine: Optional[str] = None,
+        on_row: Optional[RowCallback] = None,
+        reports: Optional[List[str]] = None,
+    ) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Pipeline per pagina: mentre le pagine vengono renderizzate, i gruppi già completi
+        partono verso il modello. Restituisce coppie (posizione nel documento, pagina).
+
+        Allo scadere di `deadline` rendering e chiamate in corso vengono annullati e le
+        pagine non ancora restituite escono con source "missing" (in coda, dopo le altre).
+
+        In modalità "per_page" le pagine (o gruppi di LLM_PAGES_PER_CALL pagine dello
+        stesso file) diventano chiamate indipendenti e concorrenti, regolate da
+        `llm_scheduler`: un gruppo fallito lascia vuote solo le sue pagine. Il motore che
+        legge i gruppi è scelto da `_extract_group`.
 
-    async def _parse_tables_from_images(self, data_urls: List[str]) -> Dict[str, Any]:
+        Con `reports` (referto di ogni file) i gruppi riuniscono pagine di file e referti
+        diversi, fino a `pages_per_call(BATCH_PAGES_PER_CALL)` pagine; le pagine duplicate
+        sono cercate solo nello stesso referto e l'errore di un gruppo non interrompe il batch.
+        """
+        mode = self.engine_mode(engine)
+        per_page = settings.LLM_FANOUT_MODE != "single"
+        results: asyncio.Queue = asyncio.Queue()
+        tasks: List[asyncio.Task] = []
+        failures: List[BaseException] = []
+
+        async def run_group(group: List[Tuple[int, Dict[str, Any]]]) -> None:
+            pages = [entry for _, entry in group]
+            try:
+                page_tables = await self._extract_group(pages, mode, on_row)
+            except Exception as e:
+                group_reports = list(dict.fromkeys(page.get("report") for page in pages))
+                if len(group_reports) > 1:
+                    # Chiamata con pagine di più referti: la si ripete un referto alla volta,
+                    # così l'errore resta solo ai referti che lo causano
+                    logging.warning(f"Estrazione fallita per un gruppo di {len(group_reports)} referti, "
+                                    f"nuovo tentativo per referto: {str(e)}")
+                    await asyncio.gather(*(
+                        run_group([item for item in group if item[1].get("report") == report])
+                        for report in group_reports
+                    ))
+                    return
+                logging.error(f"Estrazione fallita per {pages[0]['file']} pagine "
+                              f"{[page['page'] for page in pages]}: {str(e)}")
+                failures.append(e)
+                page_tables = [[] for _ in pages]
+                for page in pages:
+                    page["error"] = str(e) or type(e).__name__
+            for (position, entry), tables in zip(group, page_tables):
+                entry["tables"] = tables
+                # Le immagini codificate non servono più: le si rilascia senza attendere la fine del documento
+                entry.pop("data_url", None)
+                for region in entry.get("regions", []):
+                    region.pop("data_url", None)
+                await results.put((position, entry))
+
+        async def produce() -> None:
+            group: List[Tuple[int, Dict[str, Any]]] = []
+            # Pagine già viste per referto (un unico insieme fuori dal batch)
+            seen: Dict[Optional[str], List[Dict[str, Any]]] = {}
+
+            def flush() -> None:
+                if group:
+                    tasks.append(asyncio.create_task(run_group(list(group))))
+                    group.clear()
+
+            try:
+                position = 0
+                async for entry in self._iter_prepared_pages(files, reports):
+                    position += 1
+                    if entry["source"] == "vision":
+                        self._mark_duplicate(entry, seen.setdefault(entry.get("report"), []))
+                    if entry["source"] != "vision":
+                        await results.put((position, entry))
+                        continue
+                    if reports is not None:
+                        if group and len(group) >= self.llm_engine.pages_per_call(settings.BATCH_PAGES_PER_CALL):
+                            flush()
+                    elif per_page and group and (
+                        len(group) >= settings.LLM_PAGES_PER_CALL or group[-1][1]["file"] != entry["file"]
+                    ):
+                        flush()
+                    group.append((position, entry))
+                flush()
+                await asyncio.gather(*tasks)
+            finally:
+                await results.put(None)
+
+        producer = asyncio.create_task(produce())
+        emitted = set()
+        last_position = 0
+        timed_out = False
         try:
-            messages = [
-                {
-                    "role": "system",
-                    "content": """You are a medical laboratory report analysis expert. Your task is to:
-                    1. Identify and extract ALL tables from the medical report
-                    2. Preserve the exact structure and content of each table
-                    3. Pay special attention to reference ranges and units of measurement
-                    4. Ensure ALL cells are captured, even if they appear empty or unclear
-                    5. Double-check all numeric ranges columns
-
-                    Return the data in this format:
-                    {
-                        "tables": [
-                            {
-                                "page": page_number,
-                                "headers": ["exact header 1", "exact header 2", ...],
-                                "data": [
-                                    ["row1 cell1", "row1 cell2", ...],
-                                    ["row2 cell1", "row2 cell2", ...]
-                                ]
-                            }
-                        ]
-                    }
-
-                    Important rules:
-                    - Extract ALL text exactly as it appears
-                    - Preserve ALL reference ranges, especially numeric ranges
-                    - Include ALL units of measurement
-                    - If a cell appears empty but might contain data, try to enhance and recheck
-                    - Pay special attention to faint or low-contrast text
-                    - Verify that numeric ranges are complete and accurate"""
-                }
-            ]
+            while True:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                try:
+                    item = await asyncio.wait_for(results.get(), timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    break
+                if item is None:
+                    break
+                emitted.add((item[1]["file"], item[1]["page"]))
+                last_position = max(last_position, item[0])
+                metrics.record_page(item[1])
+                yield item
+            if not timed_out:
+                await producer
+        finally:
+            for task in [producer, *tasks]:
+                task.cancel()
 
-            user_content = [
-                {
-                    "type": "text",
-                    "text": "Extract all tables from these medical laboratory report images. Pay special attention to reference ranges and ensure all cells are captured accurately."
-                }
-            ]
+        if timed_out:
+            missing = await self._missing_entries(files, emitted)
+            logging.warning(f"Scadenza della richiesta raggiunta: {len(missing)} pagine non completate")
+            for offset, entry in enumerate(missing, start=1):
+                metrics.record_page(entry)
+                yield last_position + offset, entry
+        elif reports is None and tasks and len(failures) == len(tasks):
+            raise failures[0]
+
+    async def _missing_entries(self, files: List[SpooledUpload], emitted: set) -> List[Dict[str, Any]]:
+        """Pagine dei file non ancora restituite, in ordine di documento."""
+        missing = []
+        for file in files:
+            if file.filename.lower().endswith(IMAGE_EXTENSIONS):
+                page_count = 1
+            else:
+                page_count = len(await cpu_executor.run(render_worker.pdf_page_sizes, file.source))
+            missing.extend(
+                {"file": file.filename, "page": page, "source": MISSING_SOURCE, "tables": [],
+                 "error": "deadline exceeded"}
+                for page in range(1, page_count + 1)
+                if (file.filename, page) not in emitted
+            )
+        return missing
 
-            for data_url in data_urls:
-                user_content.append({"type": "image_url", "image_url": {"url": data_url}})
+    async def _iter_prepared_pages(
+        self, files: List[SpooledUpload], reports: Optional[List[str]] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Pagine in ordine di documento: dal text layer già con le tabelle, le altre renderizzate.
+        Ai processi del pool si passa `file.source` (percorso o byte), mai una copia letta qui.
+        Con `reports` ogni pagina riporta il suo referto e un file che non si riesce a leggere
+        diventa una pagina con source "failed" invece di interrompere le altre.
+        """
+        for index, file in enumerate(files):
+            if reports is None:
+                async for entry in self._iter_file_pages(file):
+                    yield entry
+                continue
+            try:
+                async for entry in self._iter_file_pages(file):
+                    entry["report"] = reports[index]
+                    yield entry
+            except Exception as e:
+                logging.error(f"Referto {reports[index]}: lettura di {file.filename} fallita: {str(e)}")
+                yield {"file": file.filename, "report": reports[index], "page": None,
+                       "source": FAILED_SOURCE, "tables": [], "error": str(e) or type(e).__name__}
 
-            messages.append({"role": "user", "content": user_content})
+    async def _iter_file_pages(self, file: SpooledUpload) -> AsyncIterator[Dict[str, Any]]:
+        """Pagine di un file: un'immagine, oppure le pagine del PDF dal text layer o renderizzate."""
+        contents = file.source
+        if file.filename.lower().endswith(IMAGE_EXTENSIONS):
+            page = await cpu_executor.run(render_worker.encode_image, contents, self.render_policy)
+            yield self._page_entry(file.filename, 1, page)
+            logging.info(f"Immagine processata: {file.filename}")
+            return
 
-            llm = ChatOpenAI(
-                model="gpt-4o",  
-                api_key=settings.OPENAI_API_KEY,
-                max_tokens=4096,
-                temperature=0,
-                timeout=120,
-                request_timeout=120.0
+        text_entries = []
+        scanned_pages = None
+        if settings.TEXT_LAYER_ENABLED:
+            templates = None
+            if settings.LAYOUT_TEMPLATES_ENABLED:
+                await template_store.refresh()
+                templates = template_store.active()
+            page_tables = await cpu_executor.run(
+                text_layer.extract_text_tables, contents, settings.TEXT_LAYER_MIN_CHARS, templates
             )
-            
+            for tables in page_tables:
+                if tables and "layout_template" in tables[0]:
+                    metrics.LAYOUT_TEMPLATE_PAGES.labels("matched").inc()
+            scanned_pages = [n for n, tables in enumerate(page_tables, start=1) if tables is None]
+            text_entries = deque(
+                {"file": file.filename, "page": page_number, "source": "text_layer", "tables": tables}
+                for page_number, tables in enumerate(page_tables, start=1)
+                if tables is not None
+            )
+        async for page in self.iter_pdf_pages(file.filename, contents, scanned_pages):
+            while text_entries and text_entries[0]["page"] < page["page"]:
+                yield text_entries.popleft()
+            yield page
+        for entry in text_entries:
+            yield entry
+        logging.info(f"PDF processato: {file.filename}")
+
+    async def iter_pdf_pages(
+        self,
+        filename: str,
+        file_content: render_worker.Source,
+        page_numbers: Optional[List[int]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Renderizza le pagine del PDF nel pool di processi e le restituisce in ordine.
+        Se `page_numbers` è indicato vengono renderizzate solo quelle pagine (1-based).
+
+        Al massimo `cpu_executor.max_workers` pagine sono in lavorazione contemporaneamente,
+        così le pagine renderizzate ma non ancora consumate restano limitate.
+        """
+        try:
+            page_sizes = await cpu_executor.run(render_worker.pdf_page_sizes, file_content)
+            plans = [self.render_policy.plan_pdf_page(*size) for size in page_sizes]
+            if page_numbers is None:
+                page_numbers = list(range(1, len(plans) + 1))
+
+            def submit(page_number: int) -> asyncio.Task:
+                return asyncio.create_task(cpu_executor.run(
+                    render_worker.render_pdf_page,
+                    file_content,
+                    page_number,
+                    plans[page_number - 1]["dpi"],
+                    self.render_policy.engine,
+                    self.render_policy,
+                ))
+
+            window = deque()
+            pending = deque(page_numbers)
             try:
-                response = await asyncio.wait_for(
-                    llm.ainvoke(messages),
-                    timeout=180.0
-                )
-                logging.info("Response received from model")
-                return self._process_llm_response(response.content)
-            except asyncio.TimeoutError:
-                logging.error("Timeout during model call")
-                raise HTTPException(
-                    status_code=504,
-                    detail="Request timeout while processing images"
-                )
-        
+                while pending or window:
+                    while pending and len(window) < cpu_executor.max_workers:
+                        page_number = pending.popleft()
+                        window.append((page_number, submit(page_number)))
+                    page_number, task = window.popleft()
+                    rendered = await task
+                    yield self._page_entry(filename, page_number, {**plans[page_number - 1], **rendered})
+            finally:
+                for _, task in window:
+                    task.cancel()
         except Exception as e:
-            logging.error(f"Errore durante il parsing delle tabelle: {str(e)}")
-            if hasattr(e, 'response'):
-                logging.error(f"Dettagli errore API: {e.response}")
-            raise 
\ No newline at end of file
+            logging.error(f"Error converting PDF to images: {e}")
+            raise
+
+    def _mark_duplicate(self, entry: Dict[str, Any], seen: List[Dict[str, Any]]) -> None:
+        """
+        Confronta la pagina con quelle già viste nella richiesta (anche di altri file):
+        se l'impronta è quasi identica la pagina non viene inviata al modello.
+        """
+        fingerprint = entry.get("fingerprint")
+        if fingerprint is None or settings.PAGE_DEDUP_MAX_DISTANCE < 0:
+            return
+        for previous in seen:
+            if page_fingerprint.is_duplicate(
+                fingerprint, entry["ink_mask"],
+                previous["fingerprint"], previous["ink_mask"],
+                settings.PAGE_DEDUP_MAX_DISTANCE, settings.PAGE_DEDUP_MAX_MISMATCH,
+            ):
+                entry["source"] = "duplicate"
+                entry["duplicate_of"] = {"file": previous["file"], "page": previous["page"]}
+                entry.pop("data_url", None)
+                entry.pop("regions", None)
+                logging.info(f"{entry['file']} pagina {entry['page']}: duplicata di "
+                             f"{previous['file']} pagina {previous['page']}, pagina saltata")
+                return
+        seen.append(entry)
+
+    def _page_entry(self, filename: str, page_number: int, rendered: Dict[str, Any]) -> Dict[str, Any]:
+        entry = {
+            "file": filename,
+            "page": page_number,
+            "source": "vision",
+            "tables": [],
+            **rendered,
+            "detail": self.render_policy.detail_for(rendered["width"], rendered["height"]),
+        }
+        if entry.get("fingerprint"):
+            entry["ink_mask"] = entry["fingerprint"].pop("mask")
+        if entry.pop("blank", False):
+            entry["source"] = "blank"
+            logging.info(f"{filename} pagina {page_number}: pagina bianca, pagina saltata")
+        elif "regions" in entry:
+            for region in entry["regions"]:
+                region["detail"] = self.render_policy.detail_for(region["width"], region["height"])
+            if not entry["regions"]:
+                # Nessuna tabella individuata: la pagina non viene inviata al modello
+                entry["source"] = "no_table"
+                logging.info(f"{filename} pagina {page_number}: nessuna tabella, pagina saltata")
+        return entry
+
+    async def _extract_group(
+        self, pages: List[Dict[str, Any]], mode: str, on_row: Optional[RowCallback] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Tabelle di un gruppo di pagine. Le pagine di un layout noto sono lette con il suo
+        template (`TemplateEngine`); le altre con il motore della modalità `mode`, e
+        quelle lette dal modello servono da campioni per apprendere nuovi template.
+        Motore e confidenza sono riportati in ogni pagina ("engine", "ocr_confidence");
+        "truncated" segnala le pagine la cui risposta vision è rimasta incompleta.
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(pages)
+        if self.template_engine.available:
+            try:
+                results = await self.template_engine.extract(pages)
+            except Exception as e:
+                logging.warning(f"Lettura con i template fallita per {pages[0]['file']}: {str(e)}")
+        pending = [index for index, result in enumerate(results) if result is None]
+        if pending:
+            extracted = await self._extract_with_engines([pages[index] for index in pending], mode, on_row)
+            for index, result in zip(pending, extracted):
+                results[index] = result
+            self.template_engine.learn([
+                (pages[index], results[index]["tables"]) for index in pending
+                if results[index]["engine"] == self.llm_engine.name and not results[index].get("truncated")
+            ])
+
+        for page, result in zip(pages, results):
+            page["engine"] = result["engine"]
+            if result.get("truncated"):
+                page["truncated"] = True
+            if result["confidence"] is not None:
+                page["ocr_confidence"] = result["confidence"]
+            metrics.ENGINE_PAGES.labels(result["engine"]).inc()
+        return [result["tables"] for result in results]
+
+    async def _extract_with_engines(
+        self, pages: List[Dict[str, Any]], mode: str, on_row: Optional[RowCallback] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Lettura con il motore della modalità `mode`. In "auto" le pagine lette da
+        Tesseract con confidenza sotto OCR_MIN_CONFIDENCE (o senza tabelle) passano al
+        modello in un'unica chiamata; se Tesseract non è disponibile o fallisce si usa solo
+        il modello, se fallisce il modello si tengono le letture locali.
+        """
+        results = None
+        if mode != "llm":
+            if not self.local_engine.available:
+                if mode == "tesseract":
+                    raise HTTPException(status_code=503, detail="Estrazione locale non disponibile: Tesseract non installato")
+            elif mode == "tesseract":
+                results = await self.local_engine.extract(pages)
+            else:
+                try:
+                    results = await self.local_engine.extract(pages)
+                except Exception as e:
+                    logging.warning(f"OCR locale fallito per {pages[0]['file']}, si passa al modello: {str(e)}")
+
+        if results is None:
+            results = await self.llm_engine.extract(pages, on_row)
+        elif mode == "auto":
+            escalate = [
+                index for index, result in enumerate(results)
+                if result["confidence"] < settings.OCR_MIN_CONFIDENCE
+            ]
+            if escalate:
+                logging.info(f"{pages[0]['file']} pagine {[pages[i]['page'] for i in escalate]}: "
+                             f"confidenza OCR bassa, inoltro al modello")
+                try:
+                    escalated = await self.llm_engine.extract([pages[index] for index in escalate], on_row)
+                except Exception as e:
+                    logging.warning(f"Inoltro al modello fallito, si tengono le letture locali: {str(e)}")
+                    for index in escalate:
+                        pages[index]["escalation_error"] = str(e) or type(e).__name__
+                else:
+                    for index, result in zip(escalate, escalated):
+                        pages[index]["ocr_confidence"] = results[index]["confidence"]
+                        results[index] = result
+                        metrics.ENGINE_PAGES.labels("escalated").inc()
+
+        return results
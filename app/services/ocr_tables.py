@@ -0,0 +1,198 @@
+"""
+Lettura locale delle tabelle con Tesseract, eseguita nei processi del CPU executor.
+
+Le parole riconosciute (coordinate e confidenza) passano dalla stessa ricostruzione a
+colonne del text layer; se la tabella è bordata, le colonne sono gli spazi tra le
+linee verticali della griglia. La confidenza è la media delle confidenze delle parole
+pesata sui caratteri (0 se non emerge alcuna tabella): sotto soglia la pagina può
+essere inoltrata al modello vision.
+"""
+import base64
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from app.services import layout_templates, text_layer
+
+try:
+    import pytesseract
+except ImportError:  # pragma: no cover - Tesseract è opzionale
+    pytesseract = None
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:  # pragma: no cover - OpenCV è opzionale
+    cv2 = None
+    np = None
+
+# Ingrandimento massimo applicato alle immagini prima dell'OCR
+MAX_UPSCALE = 3.0
+# Altezza minima di una linea verticale della griglia, in frazione dell'immagine
+MIN_RULE_HEIGHT = 0.5
+# Larghezza minima (px) di una colonna delimitata da due linee
+MIN_RULED_COLUMN = 8
+
+
+def tesseract_available() -> bool:
+    """True se pytesseract è installato e l'eseguibile `tesseract` risponde."""
+    if pytesseract is None:
+        return False
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception:
+        return False
+    return True
+
+
+def ocr_page_tables(
+    images: List[Dict[str, Any]],
+    language: str,
+    psm: int,
+    scale: float = 1.0,
+    templates: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """
+    Tabelle di una pagina, inviata intera o come ritagli delle regioni tabellari
+    (`images` con "data_url" ed eventuale "bbox"). Restituisce {"tables", "confidence",
+    "words", "template"}; le tabelle dei ritagli riportano il riquadro in "region".
+    Con `templates` la pagina è letta solo con le colonne del template che le corrisponde
+    ("template" ne riporta l'id; nessuna tabella se nessuno corrisponde).
+    """
+    tables: List[Dict[str, Any]] = []
+    weighted = 0.0
+    chars = 0
+    recognized = _page_words(images, language, psm, scale)
+    for image, words in recognized:
+        if templates is None:
+            for table in text_layer.tables_from_words(
+                [word[:5] for word in words], image["width"], image["columns"]
+            ):
+                if "bbox" in image:
+                    table["region"] = image["bbox"]
+                tables.append(table)
+        for *_, text, confidence in words:
+            weighted += confidence * len(text)
+            chars += len(text)
+
+    template = None
+    if templates is not None:
+        match = layout_templates.match_page(
+            [word[:5] for _, words in recognized for word in words], templates
+        )
+        if match:
+            template, tables = match
+    confidence = round(weighted / chars / 100, 4) if tables and chars else 0.0
+    return {
+        "tables": tables,
+        "confidence": confidence,
+        "words": sum(len(words) for _, words in recognized),
+        "template": template,
+    }
+
+
+def ocr_table_headers(
+    images: List[Dict[str, Any]], language: str, psm: int, scale: float, strip_height: int
+) -> List[str]:
+    """
+    Testo della prima riga (l'intestazione) di ogni tabella della pagina, dall'alto;
+    si legge solo una fascia alta `strip_height` px in cima a ogni ritaglio o, per le
+    pagine intere, a ogni riquadro in "table_boxes". Costa una frazione dell'OCR della
+    pagina e basta a scegliere i template candidati.
+    """
+    scale = min(max(scale, 1.0), MAX_UPSCALE)
+    headers = []
+    for image in images:
+        with _open_data_url(image["data_url"]) as opened:
+            gray = opened.convert("L")
+        top = image["bbox"][1] if "bbox" in image else 0
+        for x0, y0, x1, y1 in image.get("table_boxes") or [(0, 0, gray.width, gray.height)]:
+            strip = gray.crop((x0, y0, x1, min(y1, y0 + strip_height)))
+            if scale > 1.0:
+                strip = strip.resize((round(strip.width * scale), round(strip.height * scale)), Image.LANCZOS)
+            lines = text_layer._group_lines([word[:5] for word in _recognize(strip, language, psm)])
+            if lines:
+                headers.append((top + y0, " ".join(word[4] for word in lines[0])))
+    return [text for _, text in sorted(headers, key=lambda header: header[0])]
+
+
+def learn_page_layout(
+    images: List[Dict[str, Any]],
+    language: str,
+    psm: int,
+    scale: float,
+    strip_height: int,
+    tables: List[Dict[str, Any]],
+    min_agreement: float,
+) -> Optional[Dict[str, Any]]:
+    """Template di layout dalla pagina letta dal modello (`tables`), vedi `layout_templates.learn_layout`."""
+    headers = ocr_table_headers(images, language, psm, scale, strip_height)
+    words = [word[:5] for _, recognized in _page_words(images, language, psm, scale) for word in recognized]
+    return layout_templates.learn_layout(words, tables, headers, min_agreement)
+
+
+def _page_words(
+    images: List[Dict[str, Any]], language: str, psm: int, scale: float
+) -> List[Tuple[Dict[str, Any], List[Tuple[float, float, float, float, str, float]]]]:
+    """
+    Parole riconosciute in ogni immagine, in coordinate della pagina (ingrandita di
+    `scale`), con larghezza dell'immagine e colonne della griglia per la lettura euristica.
+    """
+    scale = min(max(scale, 1.0), MAX_UPSCALE)
+    recognized = []
+    for image in images:
+        with _open_data_url(image["data_url"]) as opened:
+            gray = opened.convert("L")
+        if scale > 1.0:
+            gray = gray.resize((round(gray.width * scale), round(gray.height * scale)), Image.LANCZOS)
+        dx, dy = (image["bbox"][0] * scale, image["bbox"][1] * scale) if "bbox" in image else (0, 0)
+        columns = _ruled_columns(gray)
+        words = [
+            (x0 + dx, y0 + dy, x1 + dx, y1 + dy, text, confidence)
+            for x0, y0, x1, y1, text, confidence in _recognize(gray, language, psm)
+        ]
+        info = {
+            "width": gray.width + dx,
+            "columns": [(left + dx, right + dx) for left, right in columns] if columns else None,
+            **({"bbox": image["bbox"]} if "bbox" in image else {}),
+        }
+        recognized.append((info, words))
+    return recognized
+
+
+def _open_data_url(data_url: str) -> Image.Image:
+    return Image.open(BytesIO(base64.b64decode(data_url.partition(",")[2])))
+
+
+def _recognize(image: Image.Image, language: str, psm: int) -> List[Tuple[float, float, float, float, str, float]]:
+    """Parole (x0, y0, x1, y1, testo, confidenza 0-100) riconosciute da Tesseract."""
+    data = pytesseract.image_to_data(
+        image, lang=language, config=f"--psm {psm}", output_type=pytesseract.Output.DICT
+    )
+    recognized = []
+    for left, top, width, height, text, confidence in zip(
+        data["left"], data["top"], data["width"], data["height"], data["text"], data["conf"]
+    ):
+        text = str(text).strip()
+        confidence = float(confidence)
+        if text and confidence >= 0:
+            recognized.append((left, top, left + width, top + height, text, confidence))
+    return recognized
+
+
+def _ruled_columns(gray: Image.Image) -> Optional[List[Tuple[float, float]]]:
+    """Colonne tra le linee verticali della griglia; None se la tabella non è bordata."""
+    if cv2 is None:
+        return None
+    _, ink = cv2.threshold(np.asarray(gray), 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    height = ink.shape[0]
+    vertical = cv2.morphologyEx(
+        ink, cv2.MORPH_OPEN,
+        cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(10, int(height * MIN_RULE_HEIGHT)))),
+    )
+    has_rule = np.concatenate([[False], vertical.any(axis=0), [False]])
+    edges = np.flatnonzero(has_rule[1:] != has_rule[:-1])
+    rules = [(int(x0) + int(x1)) / 2 for x0, x1 in zip(edges[::2], edges[1::2])]
+    columns = [(left, right) for left, right in zip(rules, rules[1:]) if right - left >= MIN_RULED_COLUMN]
+    return columns if len(columns) >= 2 else None
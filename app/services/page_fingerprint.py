@@ -0,0 +1,95 @@
+"""
+Impronta delle pagine renderizzate per scartare pagine bianche e duplicate.
+
+Su una miniatura in scala di grigi si misurano la copertura d'inchiostro (pagine
+bianche) e, sul solo contenuto ritagliato, un difference hash (dHash) a 256 bit e una
+maschera binaria a bassa risoluzione. Il dHash seleziona i candidati duplicati; la
+maschera conferma che il contenuto coincide davvero, perché pagine di referto con lo
+stesso layout e valori diversi hanno dHash quasi identici. L'impronta viene calcolata
+nei processi del CPU executor; il confronto tra pagine avviene in `PDFService`.
+"""
+from typing import Any, Dict, Tuple
+
+from PIL import Image, ImageChops, ImageFilter
+
+HASH_SIZE = 16
+# Larghezza della maschera di conferma e della miniatura da cui viene ricavata
+MASK_WIDTH = 256
+SAMPLE_WIDTH = 2 * MASK_WIDTH
+# Pixel della miniatura più scuri di questa soglia contano come inchiostro; la media
+# sulla miniatura attenua il rumore di scansione e le trasparenze del retro
+INK_LEVEL = 200
+# Differenza relativa massima di copertura d'inchiostro e di proporzioni tra duplicati
+MAX_INK_DELTA = 0.05
+MAX_ASPECT_DELTA = 0.03
+
+
+def fingerprint(image: Image.Image) -> Dict[str, Any]:
+    """
+    {"dhash": hash esadecimale, "ink": frazione di pixel d'inchiostro,
+    "mask": (larghezza, altezza, bit della maschera del contenuto)}.
+    """
+    gray = image if image.mode == "L" else image.convert("L")
+    sample = gray.resize((SAMPLE_WIDTH, max(1, round(gray.height * SAMPLE_WIDTH / gray.width))), Image.BOX)
+    ink_pixels = sample.point(lambda value: 255 if value < INK_LEVEL else 0)
+    ink = ink_pixels.histogram()[255] / (sample.width * sample.height)
+
+    bbox = ink_pixels.getbbox()
+    content = sample.crop(bbox) if bbox else sample
+
+    pixels = list(content.resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX).getdata())
+    bits = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+
+    mask_height = max(1, round(content.height * MASK_WIDTH / content.width))
+    mask = content.resize((MASK_WIDTH, mask_height), Image.BOX).point(
+        lambda value: 255 if value < INK_LEVEL else 0
+    ).convert("1")
+
+    return {
+        "dhash": f"{bits:0{HASH_SIZE * HASH_SIZE // 4}x}",
+        "ink": round(ink, 5),
+        "mask": (mask.width, mask.height, mask.tobytes()),
+    }
+
+
+def hamming(first: str, second: str) -> int:
+    return (int(first, 16) ^ int(second, 16)).bit_count()
+
+
+def is_duplicate(
+    first: Dict[str, Any],
+    first_mask: Tuple[int, int, bytes],
+    second: Dict[str, Any],
+    second_mask: Tuple[int, int, bytes],
+    max_distance: int,
+    max_mismatch: float,
+) -> bool:
+    """True se le due pagine hanno lo stesso contenuto entro le tolleranze indicate."""
+    if hamming(first["dhash"], second["dhash"]) > max_distance:
+        return False
+    if abs(first["ink"] - second["ink"]) > MAX_INK_DELTA * max(first["ink"], second["ink"]):
+        return False
+    return mask_mismatch(first_mask, second_mask) <= max_mismatch
+
+
+def mask_mismatch(first: Tuple[int, int, bytes], second: Tuple[int, int, bytes]) -> float:
+    """
+    Quota di pixel d'inchiostro di una maschera non coperti dall'altra dilatata di un
+    pixel (tollera piccoli spostamenti di scansione). 1.0 se le proporzioni differiscono.
+    """
+    a = Image.frombytes("1", first[:2], first[2]).convert("L")
+    b = Image.frombytes("1", second[:2], second[2]).convert("L")
+    if abs(a.height / a.width - b.height / b.width) > MAX_ASPECT_DELTA * a.height / a.width:
+        return 1.0
+    b = b.resize(a.size, Image.NEAREST)
+    a_grown = a.filter(ImageFilter.MaxFilter(3))
+    b_grown = b.filter(ImageFilter.MaxFilter(3))
+    missing = (
+        ImageChops.subtract(a, b_grown).histogram()[255]
+        + ImageChops.subtract(b, a_grown).histogram()[255]
+    )
+    return missing / max(1, a.histogram()[255] + b.histogram()[255])
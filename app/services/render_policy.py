@@ -0,0 +1,91 @@
+from typing import Dict, Any, Tuple
+from pydantic import BaseModel
+from app.core.config import settings
+
+POINTS_PER_INCH = 72.0
+
+# Risoluzione massima utile per modello: l'immagine viene prima contenuta in un
+# quadrato `max_long_edge` e poi ridotta finché il lato corto non supera
+# `max_short_edge`. Pixel oltre questi limiti vengono scartati lato server.
+MODEL_IMAGE_LIMITS: Dict[str, Tuple[int, int]] = {
+    "gpt-4o": (2048, 768),
+    "gpt-4o-mini": (2048, 768),
+}
+DEFAULT_IMAGE_LIMITS = (2048, 768)
+
+# Sotto questa dimensione il dettaglio "low" (512x512) non perde informazione
+LOW_DETAIL_MAX_EDGE = 512
+
+
+class RenderPolicy(BaseModel):
+    """Sceglie DPI e dettaglio per ogni pagina in base a formato fisico e modello."""
+    model: str = "gpt-4o"
+    engine: str = "pymupdf"
+    target_long_edge: int = 2048
+    min_dpi: int = 72
+    max_dpi: int = 300
+    detail: str = "auto"
+    # Preprocessing e codifica delle immagini inviate al modello (vedi image_preprocess)
+    grayscale: bool = True
+    deskew: bool = True
+    autocrop: bool = True
+    contrast: bool = True
+    image_format: str = "png"
+    image_quality: int = 85
+    # Invia al modello solo i ritagli delle tabelle individuate (vedi table_regions)
+    table_detection: bool = True
+    # Pagine bianche (copertura d'inchiostro <= blank_max_ink) scartate prima della codifica
+    page_filter: bool = True
+    blank_max_ink: float = 0.001
+
+    @classmethod
+    def from_settings(cls) -> "RenderPolicy":
+        return cls(
+            model=settings.VISION_MODEL,
+            engine=settings.RENDER_ENGINE,
+            target_long_edge=settings.RENDER_TARGET_LONG_EDGE,
+            min_dpi=settings.RENDER_MIN_DPI,
+            max_dpi=settings.RENDER_MAX_DPI,
+            detail=settings.RENDER_IMAGE_DETAIL,
+            grayscale=settings.IMAGE_GRAYSCALE,
+            deskew=settings.IMAGE_DESKEW,
+            autocrop=settings.IMAGE_AUTOCROP,
+            contrast=settings.IMAGE_CONTRAST,
+            image_format=settings.IMAGE_FORMAT,
+            image_quality=settings.IMAGE_QUALITY,
+            table_detection=settings.TABLE_DETECTION_ENABLED,
+            page_filter=settings.PAGE_FILTER_ENABLED,
+            blank_max_ink=settings.PAGE_BLANK_MAX_INK,
+        )
+
+    @property
+    def preprocessing(self) -> bool:
+        """True se almeno un passo di preprocessing modifica i pixel della pagina."""
+        return self.grayscale or self.deskew or self.autocrop or self.contrast
+
+    def max_long_edge(self, width: float, height: float) -> int:
+        """Lato lungo massimo (px) che il modello sfrutta per un'immagine di queste proporzioni."""
+        long_edge, short_edge = max(width, height), min(width, height)
+        model_long, model_short = MODEL_IMAGE_LIMITS.get(self.model, DEFAULT_IMAGE_LIMITS)
+        useful = model_long
+        if short_edge > 0:
+            useful = min(model_long, int(model_short * long_edge / short_edge))
+        return min(self.target_long_edge, useful)
+
+    def detail_for(self, width: int, height: int) -> str:
+        if self.detail != "auto":
+            return self.detail
+        return "low" if max(width, height) <= LOW_DETAIL_MAX_EDGE else "high"
+
+    def plan_pdf_page(self, width_pt: float, height_pt: float) -> Dict[str, Any]:
+        """Calcola i DPI di rendering per una pagina PDF di dimensioni date in punti."""
+        long_edge_in = max(width_pt, height_pt) / POINTS_PER_INCH
+        target = self.max_long_edge(width_pt, height_pt)
+        dpi = target / long_edge_in if long_edge_in > 0 else self.max_dpi
+        dpi = int(max(self.min_dpi, min(self.max_dpi, dpi)))
+        return {
+            "dpi": dpi,
+            "target_long_edge": target,
+            "page_width_pt": round(width_pt, 1),
+            "page_height_pt": round(height_pt, 1),
+        }
@@ -0,0 +1,205 @@
+"""
+Funzioni eseguite nei processi del CPU executor.
+
+Devono restare funzioni di modulo (serializzabili con pickle) e importare solo le
+librerie necessarie al rendering, perché ogni processo del pool le re-importa.
+Il documento arriva come `Source`: i byte per gli upload piccoli, il percorso del
+file temporaneo per quelli riversati su disco (letto da MuPDF/Pillow su richiesta).
+"""
+import base64
+import os
+from io import BytesIO
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+import fitz
+from PIL import Image
+from pdf2image import convert_from_bytes, convert_from_path
+
+from app.services import image_preprocess, page_fingerprint, table_regions
+from app.services.render_policy import RenderPolicy
+
+RENDER_ENGINES = ('pymupdf', 'pdf2image')
+
+# Formati accettati direttamente dall'API vision; gli altri vengono convertiti in PNG
+PASSTHROUGH_FORMATS = ('PNG', 'JPEG', 'WEBP', 'GIF')
+
+# Oltre questa quota dell'area della pagina i ritagli non convengono: si invia la pagina intera
+MAX_REGION_COVERAGE = 0.85
+
+Source = Union[bytes, str]
+
+
+def open_pdf(source: Source) -> fitz.Document:
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def pdf_page_sizes(source: Source) -> List[Tuple[float, float]]:
+    """Dimensioni (larghezza, altezza) in punti di ogni pagina, rotazione inclusa."""
+    with open_pdf(source) as doc:
+        return [(page.rect.width, page.rect.height) for page in doc]
+
+
+def render_pdf_page(
+    source: Source,
+    page_number: int,
+    dpi: int,
+    engine: str = 'pymupdf',
+    policy: Optional[RenderPolicy] = None,
+) -> Dict[str, Any]:
+    """
+    Rasterizza una singola pagina (1-based) e la restituisce come data URL. Con una
+    `policy` la pagina passa dal preprocessing e dal formato configurati, altrimenti
+    viene inviata come PNG a colori.
+    """
+    if engine == 'pdf2image':
+        return _render_pdf2image(source, page_number, dpi, policy)
+    with open_pdf(source) as doc:
+        return _render_pymupdf(doc[page_number - 1], dpi, policy)
+
+
+def _render_pymupdf(page: fitz.Page, dpi: int, policy: Optional[RenderPolicy] = None) -> Dict[str, Any]:
+    pixmap = page.get_pixmap(dpi=dpi, alpha=False)
+    if policy is None:
+        content = pixmap.tobytes("png")
+        return {
+            "data_url": _to_data_url(content, "image/png"),
+            "width": pixmap.width,
+            "height": pixmap.height,
+            "bytes": len(content),
+        }
+    image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+    return _finish_page(image, policy, len(pixmap.samples))
+
+
+def _render_pdf2image(source: Source, page_number: int, dpi: int, policy: Optional[RenderPolicy] = None) -> Dict[str, Any]:
+    convert = convert_from_path if isinstance(source, str) else convert_from_bytes
+    images = convert(source, dpi=dpi, first_page=page_number, last_page=page_number)
+    if policy is None:
+        return _encode_png(images[0])
+    return _finish_page(images[0], policy, _raw_size(images[0]))
+
+
+def _finish_page(image: Image.Image, policy: RenderPolicy, original_bytes: int) -> Dict[str, Any]:
+    """
+    Preprocessing e codifica secondo la policy. `bytes_original` è la dimensione della
+    bitmap renderizzata non compressa (o del file caricato), per confronto: codificarla
+    in PNG solo per misurarla costerebbe quanto la codifica della pagina inviata.
+    """
+    fingerprint = None
+    if policy.page_filter:
+        fingerprint = page_fingerprint.fingerprint(image)
+        if fingerprint["ink"] <= policy.blank_max_ink:
+            # Pagina bianca: nessun preprocessing né codifica
+            return {
+                "blank": True,
+                "width": image.width,
+                "height": image.height,
+                "bytes": 0,
+                "bytes_original": original_bytes,
+                "fingerprint": fingerprint,
+            }
+
+    applied = {}
+    if policy.preprocessing:
+        image, applied = image_preprocess.preprocess_image(image, policy)
+
+    boxes = table_regions.detect_table_regions(image) if policy.table_detection else None
+    if boxes is not None:
+        covered = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes)
+        if not boxes or covered < MAX_REGION_COVERAGE * image.width * image.height:
+            # Le coordinate dei riquadri si riferiscono all'immagine preprocessata
+            regions = [
+                {"bbox": list(box), **_encode_region(image.crop(box), policy)}
+                for box in boxes
+            ]
+            return {
+                "regions": regions,
+                "width": image.width,
+                "height": image.height,
+                "bytes": sum(region["bytes"] for region in regions),
+                "bytes_original": original_bytes,
+                "preprocess": applied,
+                "fingerprint": fingerprint,
+            }
+
+    page = {
+        **_encode_region(image, policy),
+        "bytes_original": original_bytes,
+        "preprocess": applied,
+        "fingerprint": fingerprint,
+    }
+    if boxes:
+        # Pagina quasi tutta tabellare, inviata intera: i riquadri servono comunque a
+        # riconoscere le intestazioni delle tabelle (template di layout)
+        page["table_boxes"] = [list(box) for box in boxes]
+    return page
+
+
+def _encode_region(image: Image.Image, policy: RenderPolicy) -> Dict[str, Any]:
+    content, mime = image_preprocess.encode(image, policy.image_format, policy.image_quality)
+    return {
+        "data_url": _to_data_url(content, mime),
+        "width": image.width,
+        "height": image.height,
+        "bytes": len(content),
+    }
+
+
+def encode_image(source: Source, policy: RenderPolicy) -> Dict[str, Any]:
+    """
+    Prepara un'immagine caricata dall'utente: se supera la risoluzione utile del
+    modello viene ridotta, altrimenti i byte originali vengono inviati così come sono.
+    """
+    with Image.open(source if isinstance(source, str) else BytesIO(source)) as image:
+        width, height = image.size
+        max_edge = policy.max_long_edge(width, height)
+        if (
+            policy.preprocessing
+            or max(width, height) > max_edge
+            or image.format not in PASSTHROUGH_FORMATS
+        ):
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            return _finish_page(image, policy, _source_size(source))
+
+        file_content = _read_source(source)
+        return {
+            "data_url": _to_data_url(file_content, Image.MIME[image.format]),
+            "width": width,
+            "height": height,
+            "bytes": len(file_content),
+        }
+
+
+def _encode_png(image: Image.Image) -> Dict[str, Any]:
+    if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+        image = image.convert('RGB')
+    img_buffer = BytesIO()
+    image.save(img_buffer, format='PNG')
+    content = img_buffer.getvalue()
+    return {
+        "data_url": _to_data_url(content, "image/png"),
+        "width": image.width,
+        "height": image.height,
+        "bytes": len(content),
+    }
+
+
+def _raw_size(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+def _source_size(source: Source) -> int:
+    return os.path.getsize(source) if isinstance(source, str) else len(source)
+
+
+def _read_source(source: Source) -> bytes:
+    if isinstance(source, str):
+        with open(source, "rb") as handle:
+            return handle.read()
+    return source
+
+
+def _to_data_url(content: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(content).decode('utf-8')}"
@@ -1,49 +1,107 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
+import asyncio
 import logging
+import time
 # from langchain_huggingface import HuggingFaceEndpoint
 from langchain_core.prompts import PromptTemplate, ChatPromptTemplate
-from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 import json
 from app.core.config import settings
-from fastapi import UploadFile
-from app.services.ocr_service import PDFService
+from app.services.ingestion import SpooledUpload
+from app.services.ocr_service import FAILED_SOURCE, MISSING_SOURCE, PDFService
+from app.services.cache_service import result_cache, single_flight
+from app.services.medical_normalizer import MedicalRowNormalizer
+from app.services.loinc_index import loinc_index
+from app.services.llm_registry import llm_registry
+from app.services.llm_scheduler import batch_priority, llm_scheduler, text_tokens
+from app.services.metrics import BATCH_REPORTS, LLM_CALLS, in_flight, stage_timer
 from fastapi import HTTPException
 
-class MedicalFieldInfo(BaseModel):
+class ExtractedFieldInfo(BaseModel):
     field_name: str = Field(description="Medical test name")
     field_value: str = Field(description="Test result value, converted to use dot as decimal separator")
     field_unit_of_measure: str = Field(description="Unit of measurement for the test value")
     reference_range_low: str = Field(description="Lower bound of the reference range")
     reference_range_high: str = Field(description="Upper bound of the reference range")
 
+class MedicalFieldInfo(ExtractedFieldInfo):
+    # Assegnati dall'indice LOINC locale, non dal modello
+    LOINC_value: str = Field(default="N/A", description="LOINC code of the test")
+    belonging_panel_LOINC_value: str = Field(default="N/A", description="LOINC code of the panel the test belongs to")
+
 class MedicalDataResponse(BaseModel):
-    medical_fields: List[MedicalFieldInfo] = Field(description="List of analyzed medical fields")
+    medical_fields: List[ExtractedFieldInfo] = Field(description="List of analyzed medical fields")
+
+# Da incrementare a ogni modifica del prompt di strutturazione: invalida la cache dei risultati
+STRUCTURE_PROMPT_VERSION = "1"
+
 
 class StructureDataService:
-    def __init__(self):
-        self.chat_llm = ChatOpenAI(
-            model="gpt-4o",
-            temperature=0,
-            api_key=settings.OPENAI_API_KEY
-        )
-        self.ocr_service = PDFService()
+    def __init__(self, ocr_service: Optional[PDFService] = None):
+        self.ocr_service = ocr_service or PDFService()
+        self.normalizer = MedicalRowNormalizer()
 
-    async def process_medical_files(self, files: List[UploadFile]) -> List[Dict[str, str]]:
+    async def process_medical_files(self, files: List[SpooledUpload]) -> List[Dict[str, str]]:
         """
         Process medical files through three steps:
         1. Extract tables from images/PDFs
         2. Clean and structure table data
         3. Transform data into final standardized format
+
+        Results are cached by upload content and pipeline parameters.
+        """
+        final_data, _ = await self.extract_medical_data(files)
+        return final_data
+
+    async def extract_medical_data(
+        self, files: List[SpooledUpload], deadline: Optional[float] = None, engine: Optional[str] = None
+    ) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+        """
+        Like process_medical_files, with an optional overall `deadline` (a `time.monotonic()`
+        instant) for table extraction and the table extraction `engine` ("llm", "tesseract"
+        or "auto"). Returns the fields and the pages that did not finish in time; partial
+        results are not cached. Identical requests already in flight share a single
+        pipeline run.
         """
+        cache_key = self._cache_key(files, engine)
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            logging.info("Medical data served from cache")
+            return cached, []
+
+        async def process() -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+            final_data, missing_pages = await self._process_medical_files(files, deadline, engine)
+            if not missing_pages:
+                await result_cache.set(cache_key, final_data)
+            return final_data, missing_pages
+
+        return await single_flight.run(cache_key, process)
+
+    def _cache_key(self, files: List[SpooledUpload], engine: Optional[str] = None, packed: bool = False) -> str:
+        return result_cache.key_for_uploads(
+            "medical",
+            files,
+            structure_model=settings.STRUCTURE_MODEL,
+            structure_prompt_version=STRUCTURE_PROMPT_VERSION,
+            normalizer=settings.NORMALIZER_ENABLED,
+            loinc=loinc_index.signature if settings.LOINC_ENABLED else None,
+            **self.ocr_service.cache_params(engine, packed),
+        )
+
+    async def _process_medical_files(
+        self, files: List[SpooledUpload], deadline: Optional[float] = None, engine: Optional[str] = None
+    ) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
         try:
             logging.info("Starting medical files processing...")
             
             try:
-                tables_data = await self.ocr_service.extract_tables_data(files)
+                tables_data = await self.ocr_service.extract_tables_data(files, deadline, engine)
                 if not tables_data or not isinstance(tables_data, dict) or "tables" not in tables_data:
                     raise ValueError("Invalid or empty tables data received")
+                missing_pages = tables_data.get("metadata", {}).get("missing_pages", [])
                 logging.info(f"Tables extracted successfully")
+            except HTTPException:
+                raise
             except Exception as e:
                 logging.error(f"Error during table extraction: {str(e)}")
                 raise HTTPException(
@@ -53,6 +111,9 @@ class StructureDataService:
             
             try:
                 structured_data = await self.clean_table_data_json(tables_data)
+                if not structured_data and missing_pages:
+                    # Nessuna pagina completata entro la scadenza: risultato vuoto ma segnalato
+                    return [], missing_pages
                 if not structured_data:
                     raise ValueError("No data after cleaning and structuring")
                 logging.info(f"Data structured successfully")
@@ -68,7 +129,9 @@ class StructureDataService:
                 if not final_data:
                     raise ValueError("No data after final transformation")
                 logging.info(f"Data transformed successfully")
-                return final_data
+                return final_data, missing_pages
+            except HTTPException:
+                raise
             except Exception as e:
                 logging.error(f"Error during final data transformation: {str(e)}")
                 raise HTTPException(
@@ -85,7 +148,255 @@ class StructureDataService:
                 detail=f"Unexpected error during processing: {str(e)}"
             )
 
+    async def extract_medical_batch(
+        self, reports: List[Tuple[str, List[SpooledUpload]]], engine: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Process many independent reports, each a caller-supplied id with its files, for
+        throughput rather than latency: pages of different reports share vision calls and
+        the rows the normalizer cannot resolve go to the LLM in blocks of
+        BATCH_STRUCTURE_ROWS rows, as soon as their pages are extracted. Model calls run
+        with batch priority.
+
+        Results are split back per report, in input order: {"id", "status": "ok",
+        "medical_fields", "failed_pages"} or {"id", "status": "error", "error",
+        "failed_pages"}. A failing report does not affect the others. Reports already in
+        the cache are not processed again; complete results are cached per report.
+        """
+        results: Dict[str, Dict[str, Any]] = {}
+        pending: List[Tuple[str, List[SpooledUpload], str]] = []
+        for report_id, files in reports:
+            cache_key = self._cache_key(files, engine, packed=True)
+            cached = await result_cache.get(cache_key)
+            if cached is not None:
+                BATCH_REPORTS.labels("cached").inc()
+                results[report_id] = {"id": report_id, "status": "ok", "medical_fields": cached, "failed_pages": []}
+            else:
+                pending.append((report_id, files, cache_key))
+        logging.info(f"Batch of {len(reports)} reports: {len(reports) - len(pending)} served from cache")
+
+        if pending:
+            # Le chiamate del batch cedono il passo alle richieste interattive e non ne occupano la coda
+            with batch_priority():
+                processed = await self._process_batch([(report_id, files) for report_id, files, _ in pending], engine)
+            for report_id, _, cache_key in pending:
+                result = processed[report_id]
+                BATCH_REPORTS.labels(result["status"]).inc()
+                if result["status"] == "ok" and not result["failed_pages"]:
+                    await result_cache.set(cache_key, result["medical_fields"])
+                results[report_id] = result
+        return [results[report_id] for report_id, _ in reports]
+
+    async def _process_batch(
+        self, reports: List[Tuple[str, List[SpooledUpload]]], engine: Optional[str] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        files = [file for _, report_files in reports for file in report_files]
+        file_reports = [report_id for report_id, report_files in reports for _ in report_files]
+        states = {
+            report_id: {"pages": {}, "extra": [], "errors": [], "page_errors": [], "failed_pages": []}
+            for report_id, _ in reports
+        }
+        # Righe che il normalizzatore non risolve, in attesa del modello: (referto, pagina, indice, riga)
+        pending_rows: List[Tuple[str, int, int, Dict[str, Any]]] = []
+        tasks: List[asyncio.Task] = []
+
+        def flush() -> None:
+            if pending_rows:
+                tasks.append(asyncio.create_task(self._structure_batch_rows(list(pending_rows), states)))
+                pending_rows.clear()
+
+        try:
+            async for position, page in self.ocr_service.iter_report_pages(files, file_reports, engine):
+                state = states[page["report"]]
+                if page["source"] == FAILED_SOURCE:
+                    state["errors"].append(f"Error reading {page['file']}: {page['error']}")
+                    continue
+                if "error" in page:
+                    state["failed_pages"].append({"file": page["file"], "page": page["page"]})
+                    state["page_errors"].append(f"Error during table extraction: {page['error']}")
+                    continue
+                rows = await self.clean_table_data_json({"tables": page["tables"]})
+                if settings.NORMALIZER_ENABLED:
+                    with stage_timer("normalize"):
+                        fields, unresolved = self.normalizer.normalize(rows)
+                else:
+                    fields, unresolved = [None] * len(rows), list(range(len(rows)))
+                state["pages"][position] = fields
+                for index in unresolved:
+                    pending_rows.append((page["report"], position, index, rows[index]))
+                    if len(pending_rows) >= settings.BATCH_STRUCTURE_ROWS:
+                        flush()
+            flush()
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return {report_id: self._batch_report(report_id, states[report_id]) for report_id, _ in reports}
+
+    async def _structure_batch_rows(
+        self, rows: List[Tuple[str, int, int, Dict[str, Any]]], states: Dict[str, Dict[str, Any]]
+    ) -> None:
+        """
+        Structure a block of rows from several reports with one LLM call and put each field
+        back in its report. If the call fails, or returns a different number of fields
+        than rows (so they cannot be attributed), the block is retried one report at a time.
+        """
+        try:
+            fields = await self._transform_with_llm([row for *_, row in rows])
+        except Exception as e:
+            fields, error = None, e
+        if fields is not None and len(fields) == len(rows):
+            for (report_id, position, index, _), field in zip(rows, fields):
+                states[report_id]["pages"][position][index] = field
+            return
+
+        report_ids = list(dict.fromkeys(report_id for report_id, *_ in rows))
+        if len(report_ids) > 1:
+            logging.warning(f"Batch structuring of {len(rows)} rows from {len(report_ids)} reports "
+                            f"{'failed' if fields is None else 'returned mismatched fields'}, retrying per report")
+            await asyncio.gather(*(
+                self._structure_batch_rows([row for row in rows if row[0] == report_id], states)
+                for report_id in report_ids
+            ))
+            return
+        state = states[report_ids[0]]
+        if fields is None:
+            logging.error(f"Error structuring rows of report {report_ids[0]}: {str(error)}")
+            state["errors"].append(f"Error during final data transformation: {str(error)}")
+        else:
+            # Come in transform_medical_data: campi non attribuibili alle righe, in coda
+            state["extra"].extend(fields)
+
+    def _batch_report(self, report_id: str, state: Dict[str, Any]) -> Dict[str, Any]:
+        if not state["errors"]:
+            fields = [
+                field
+                for _, page_fields in sorted(state["pages"].items())
+                for field in page_fields
+                if field is not None
+            ]
+            fields = self._annotate_loinc(fields + state["extra"])
+            if fields:
+                return {"id": report_id, "status": "ok", "medical_fields": fields,
+                        "failed_pages": state["failed_pages"]}
+            state["errors"] = state["page_errors"][:1] or ["No data after cleaning and structuring"]
+        return {"id": report_id, "status": "error", "error": "; ".join(dict.fromkeys(state["errors"])),
+                "failed_pages": state["failed_pages"]}
+
+    async def stream_medical_data(
+        self,
+        files: List[SpooledUpload],
+        deadline: Optional[float] = None,
+        engine: Optional[str] = None,
+        rows: bool = False,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream version of process_medical_files: every page is structured as soon as its
+        tables are extracted and emitted as {"type": "page", ..., "medical_fields": [...]},
+        followed by a final {"type": "summary"} record. Pages not extracted by `deadline`
+        are emitted with source "missing" and listed in the summary.
+
+        With `rows`, every row the vision model finishes writing is structured right away
+        by the rule-based normalizer and emitted as a provisional {"type": "row", "file",
+        "page", "table", "medical_fields": [...]} record (rows needing the LLM wait for the
+        page); the page record remains the authoritative result.
+        """
+        started = time.perf_counter()
+        records: asyncio.Queue = asyncio.Queue()
+        tasks: List[asyncio.Task] = []
+
+        async def structure(page: Dict[str, Any]) -> None:
+            record = {"type": "page", **{k: v for k, v in page.items() if k != "tables"}}
+            try:
+                rows = await self.clean_table_data_json({"tables": page["tables"]})
+                record["medical_fields"] = await self.transform_medical_data(rows) if rows else []
+            except Exception as e:
+                logging.error(f"Error structuring page {page['page']} of {page['file']}: {str(e)}")
+                record["medical_fields"] = []
+                record["error"] = str(e)
+            await records.put(record)
+
+        def on_row(page: Dict[str, Any], table: int, headers: List[str], row: List[str]) -> None:
+            field = self._structure_row(headers, row)
+            if field is not None:
+                records.put_nowait({
+                    "type": "row", "file": page["file"], "page": page["page"], "table": table,
+                    "medical_fields": [field],
+                })
+
+        async def produce() -> None:
+            try:
+                async for page in self.ocr_service.iter_page_tables(
+                    files, deadline, engine, on_row if rows and settings.NORMALIZER_ENABLED else None
+                ):
+                    tasks.append(asyncio.create_task(structure(page)))
+                await asyncio.gather(*tasks)
+            finally:
+                await records.put(None)
+
+        producer = asyncio.create_task(produce())
+        pages = fields = 0
+        failed_pages = []
+        missing_pages = []
+        try:
+            while (record := await records.get()) is not None:
+                if record["type"] == "row":
+                    yield record
+                    continue
+                pages += 1
+                fields += len(record["medical_fields"])
+                if record["source"] == MISSING_SOURCE:
+                    missing_pages.append({"file": record["file"], "page": record["page"]})
+                elif "error" in record:
+                    failed_pages.append({"file": record["file"], "page": record["page"]})
+                yield record
+            await producer
+        finally:
+            for task in [producer, *tasks]:
+                task.cancel()
+
+        yield {
+            "type": "summary",
+            "pages": pages,
+            "medical_fields": fields,
+            "failed_pages": failed_pages,
+            "missing_pages": missing_pages,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000),
+        }
+
     async def transform_medical_data(self, data: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Normalizza le righe con il parser a regole; solo le righe che non riesce a
+        interpretare con certezza vengono inviate al modello. I codici LOINC vengono
+        poi assegnati dall'indice locale.
+        """
+        if not settings.NORMALIZER_ENABLED:
+            return self._annotate_loinc(await self._transform_with_llm(data))
+
+        with stage_timer("normalize"):
+            fields, unresolved = self.normalizer.normalize(data)
+        logging.info(f"Rows normalized locally: {len(data) - len(unresolved)}, sent to LLM: {len(unresolved)}")
+        if unresolved:
+            llm_fields = await self._transform_with_llm([data[index] for index in unresolved])
+            if len(llm_fields) == len(unresolved):
+                for index, field in zip(unresolved, llm_fields):
+                    fields[index] = field
+            else:
+                fields.extend(llm_fields)
+        return self._annotate_loinc([field for field in fields if field is not None])
+
+    def _annotate_loinc(self, fields: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        if not settings.LOINC_ENABLED:
+            return fields
+        with stage_timer("loinc"):
+            return loinc_index.annotate(fields)
+
+    def _structure_row(self, headers: List[str], row: List[str]) -> Optional[Dict[str, str]]:
+        """Campo di una singola riga se il normalizzatore la interpreta con certezza."""
+        fields, _ = self.normalizer.normalize([self._row_dict(self._header_keys(headers), row)])
+        return self._annotate_loinc(fields)[0] if fields[0] is not None else None
+
+    async def _transform_with_llm(self, data: List[Dict[str, str]]) -> List[Dict[str, str]]:
         prompt = ChatPromptTemplate.from_messages([
             ("system", """You are a Healthcare specialist capable of extracting information from Italian "Referti di laboratorio".
                 Answer solely on the "Referti di laboratorio" provided and do not give any information that does not appear on the "Referti di laboratorio".
@@ -129,14 +440,35 @@ class StructureDataService:
             ("human", "Please analyze and structure these medical test results according to the specified format: {input_data}")
         ])
 
-        chain = prompt | self.chat_llm.with_structured_output(MedicalDataResponse)
-        
-        result = await chain.ainvoke({
-            "input_data": json.dumps(data, ensure_ascii=False)
-        })
+        chat_llm = llm_registry.chat(settings.STRUCTURE_MODEL, temperature=0)
+        chain = prompt | chat_llm.with_structured_output(MedicalDataResponse)
+        input_data = json.dumps(data, ensure_ascii=False)
+        # La risposta ripete i campi in forma strutturata: circa il doppio dei dati in ingresso
+        tokens = text_tokens(prompt.format(input_data=input_data)) + 2 * text_tokens(input_data)
+
+        async def invoke():
+            async with in_flight("structure_call"):
+                return await chain.ainvoke({"input_data": input_data})
+
+        try:
+            result = await llm_scheduler.call("structure_call", tokens, invoke)
+        except Exception:
+            LLM_CALLS.labels("structure_call", "error").inc()
+            raise
+        LLM_CALLS.labels("structure_call", "ok").inc()
         
         return [field.model_dump() for field in result.medical_fields]
 
+    async def structure_tables(self, tables_data: Dict[str, Any]) -> List[Dict[str, str]]:
+        """
+        Campi clinici da tabelle già estratte ({"tables": [...]}): righe normalizzate
+        come in extract_medical_data, con i codici LOINC dell'indice locale.
+        """
+        rows = await self.clean_table_data_json(tables_data)
+        if not rows:
+            return []
+        return await self.transform_medical_data(rows)
+
     async def clean_table_data_json(self, tables_data: Dict[str, Any]) -> List[Dict[str, Any]]:
         result = []
         
@@ -144,22 +476,34 @@ class StructureDataService:
             headers = table.get("headers", [])
             data = table.get("data", [])
             
-            formatted_headers = []
-            for header in headers:
-                words = header.lower().split()
-                formatted_header = words[0]
-                for word in words[1:]:
-                    formatted_header += word.capitalize()
-                formatted_headers.append(formatted_header)
+            formatted_headers = self._header_keys(headers)
             
             for row in data:
-                row_dict = {}
-                for header, value in zip(formatted_headers, row):
-                    row_dict[header] = value
-                result.append(row_dict)
+                result.append(self._row_dict(formatted_headers, row))
         
         return result
 
+    @staticmethod
+    def _row_dict(keys: List[str], row: List[Any]) -> Dict[str, Any]:
+        """
+        Riga come dizionario intestazione → cella. Le celle oltre le intestazioni restano
+        sotto chiavi posizionali ("col_5"): scartarle nasconderebbe righe non allineate.
+        """
+        keys = keys + [f"col_{position}" for position in range(len(keys) + 1, len(row) + 1)]
+        return dict(zip(keys, row))
+
+    @staticmethod
+    def _header_keys(headers: List[str]) -> List[str]:
+        """Intestazioni in camelCase ("Unità di misura" → "unitàDiMisura")."""
+        formatted_headers = []
+        for position, header in enumerate(headers, start=1):
+            words = str(header).lower().split() or [f"col_{position}"]
+            formatted_header = words[0]
+            for word in words[1:]:
+                formatted_header += word.capitalize()
+            formatted_headers.append(formatted_header)
+        return formatted_headers
+
     def _extract_json(self, text: str) -> str:
         """Estrae il JSON valido dalla risposta del modello."""
         import re
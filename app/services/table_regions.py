@@ -0,0 +1,153 @@
+"""
+Individuazione locale delle regioni tabellari in una pagina renderizzata.
+
+Due segnali, entrambi con OpenCV: le griglie di linee orizzontali e verticali
+(tabelle bordate) e i blocchi di righe di testo divise in più colonne da corridoi
+di spazio bianco (tabelle senza bordi, le più comuni nei referti). Al modello
+vengono inviati solo i ritagli di queste regioni; intestazioni, anagrafica e firme
+restano fuori. Gira nei processi del CPU executor.
+"""
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:  # pragma: no cover - OpenCV è opzionale
+    cv2 = None
+    np = None
+
+Box = Tuple[int, int, int, int]
+
+# Righe di testo a più colonne consecutive perché un blocco sia una tabella
+MIN_TABLE_ROWS = 3
+# Un corridoio tra due colonne è largo almeno questa frazione dell'altezza di riga
+COLUMN_GAP_RATIO = 1.2
+# Spazio verticale massimo tra righe della stessa tabella, in altezze di riga
+MAX_ROW_GAP_RATIO = 2.5
+# Dimensioni minime di una griglia di linee rispetto alla pagina
+MIN_RULED_WIDTH = 0.3
+MIN_RULED_HEIGHT = 0.03
+# Margine (px) attorno a ogni ritaglio
+REGION_PADDING = 10
+
+
+def detect_table_regions(image: Image.Image) -> Optional[List[Box]]:
+    """
+    Riquadri (x0, y0, x1, y1) delle tabelle nella pagina, ordinati dall'alto.
+    Lista vuota se la pagina non contiene tabelle, None se OpenCV non è disponibile.
+    """
+    if cv2 is None:
+        return None
+    gray = np.asarray(image if image.mode == "L" else image.convert("L"))
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    if cv2.countNonZero(ink) == 0:
+        return []
+
+    height, width = ink.shape
+    boxes = _merge(_ruled_regions(ink) + _aligned_text_regions(ink))
+    return sorted(
+        (
+            max(0, x0 - REGION_PADDING),
+            max(0, y0 - REGION_PADDING),
+            min(width, x1 + REGION_PADDING),
+            min(height, y1 + REGION_PADDING),
+        )
+        for x0, y0, x1, y1 in boxes
+    )
+
+
+def _ruled_regions(ink) -> List[Box]:
+    """Griglie di linee: aperture morfologiche con kernel lunghi e sottili."""
+    height, width = ink.shape
+    horizontal = cv2.morphologyEx(
+        ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (max(10, width // 25), 1))
+    )
+    vertical = cv2.morphologyEx(
+        ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(10, height // 50)))
+    )
+    grid = cv2.dilate(cv2.bitwise_or(horizontal, vertical), np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(grid, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w >= MIN_RULED_WIDTH * width and h >= MIN_RULED_HEIGHT * height:
+            boxes.append((x, y, x + w, y + h))
+    return boxes
+
+
+def _aligned_text_regions(ink) -> List[Box]:
+    """Blocchi di almeno MIN_TABLE_ROWS righe di testo separate in due o più colonne."""
+    lines = _text_lines(ink)
+    if not lines:
+        return []
+    line_height = float(np.median([y1 - y0 for y0, y1 in lines]))
+
+    boxes: List[Box] = []
+    run: List[Tuple[int, int, List[Tuple[int, int]]]] = []
+    pending: List[Tuple[int, int, List[Tuple[int, int]]]] = []
+
+    def close() -> None:
+        if len(run) >= MIN_TABLE_ROWS:
+            boxes.append((
+                min(segments[0][0] for _, _, segments in run),
+                run[0][0],
+                max(segments[-1][1] for _, _, segments in run),
+                run[-1][1],
+            ))
+
+    for y0, y1 in lines:
+        segments = _segments(ink[y0:y1], COLUMN_GAP_RATIO * line_height)
+        previous = (pending or run)[-1][1] if run else None
+        if previous is not None and y0 - previous > MAX_ROW_GAP_RATIO * line_height:
+            close()
+            run, pending = [], []
+        if len(segments) >= 2:
+            run.extend(pending)
+            pending = []
+            run.append((y0, y1, segments))
+        elif run:
+            # Righe a una colonna (sezioni, nomi su due righe) restano nella tabella
+            # solo se seguite da altre righe a più colonne
+            pending.append((y0, y1, segments))
+    close()
+    return boxes
+
+
+def _text_lines(ink) -> List[Tuple[int, int]]:
+    """Fasce orizzontali con inchiostro; le linee di pochi pixel (righe di tabella) sono ignorate."""
+    has_ink = np.concatenate([[False], ink.any(axis=1), [False]])
+    edges = np.flatnonzero(has_ink[1:] != has_ink[:-1])
+    return [(int(y0), int(y1)) for y0, y1 in zip(edges[::2], edges[1::2]) if y1 - y0 >= 4]
+
+
+def _segments(band, min_gap: float) -> List[Tuple[int, int]]:
+    """Estensioni x del testo in una riga, separate dove lo spazio bianco supera `min_gap`."""
+    has_ink = np.concatenate([[False], band.any(axis=0), [False]])
+    edges = np.flatnonzero(has_ink[1:] != has_ink[:-1])
+    segments: List[Tuple[int, int]] = []
+    for x0, x1 in zip(edges[::2], edges[1::2]):
+        if segments and x0 - segments[-1][1] < min_gap:
+            segments[-1] = (segments[-1][0], int(x1))
+        else:
+            segments.append((int(x0), int(x1)))
+    return segments
+
+
+def _merge(boxes: List[Box]) -> List[Box]:
+    """Unisce i riquadri che si sovrappongono (griglia e testo della stessa tabella)."""
+    merged: List[Box] = []
+    for box in sorted(boxes, key=lambda b: (b[1], b[0])):
+        for index, other in enumerate(merged):
+            if box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]:
+                merged[index] = (
+                    min(box[0], other[0]), min(box[1], other[1]),
+                    max(box[2], other[2]), max(box[3], other[3]),
+                )
+                break
+        else:
+            merged.append(box)
+    if len(merged) < len(boxes) and len(merged) > 1:
+        return _merge(merged)
+    return merged
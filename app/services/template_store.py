@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import delete, select
+
+from app.core.config import settings
+from app.db.models import LayoutTemplate
+from app.db.session import SessionLocal
+from app.services import layout_templates
+
+
+class TemplateStore:
+    """
+    Template di layout appresi, persistiti nella tabella `layout_templates`.
+
+    Il database li condivide tra i worker uvicorn; ogni processo ne tiene una copia in
+    memoria ricaricata al più ogni LAYOUT_TEMPLATE_REFRESH_SECONDS. Un template si usa
+    solo dopo LAYOUT_TEMPLATE_MIN_SAMPLES campioni con colonne compatibili: un campione
+    incompatibile (il laboratorio ha cambiato impaginazione) lo riporta a un campione.
+    """
+
+    def __init__(self):
+        # id -> {"layout", "samples"}
+        self._templates: Dict[str, Dict[str, Any]] = {}
+        self._loaded_at: Optional[float] = None
+
+    def active(self) -> List[Dict[str, Any]]:
+        """Layout con abbastanza campioni per essere applicati."""
+        return [
+            record["layout"] for record in self._templates.values()
+            if record["samples"] >= settings.LAYOUT_TEMPLATE_MIN_SAMPLES
+        ]
+
+    def summary(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "id": template_id,
+                "headers": [table["headers"] for table in record["layout"]["tables"]],
+                "samples": record["samples"],
+                "active": record["samples"] >= settings.LAYOUT_TEMPLATE_MIN_SAMPLES,
+            }
+            for template_id, record in self._templates.items()
+        ]
+
+    async def refresh(self, force: bool = False) -> None:
+        if not force and self._loaded_at is not None and (
+            time.monotonic() - self._loaded_at < settings.LAYOUT_TEMPLATE_REFRESH_SECONDS
+        ):
+            return
+        self._loaded_at = time.monotonic()
+        try:
+            self._templates = await asyncio.to_thread(self._load)
+        except Exception as e:
+            logging.warning(f"Caricamento dei template di layout fallito: {str(e)}")
+
+    async def add(self, layout: Dict[str, Any]) -> Dict[str, Any]:
+        """Registra un campione appreso; restituisce {"layout", "samples"} aggiornato."""
+        record = await asyncio.to_thread(self._merge, layout)
+        self._templates[layout["id"]] = record
+        return record
+
+    async def remove(self, template_id: str) -> bool:
+        removed = await asyncio.to_thread(self._delete, template_id)
+        self._templates.pop(template_id, None)
+        return removed
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        with SessionLocal() as session:
+            return {
+                row.id: {"layout": row.layout, "samples": row.samples}
+                for row in session.execute(select(LayoutTemplate)).scalars()
+            }
+
+    def _merge(self, layout: Dict[str, Any]) -> Dict[str, Any]:
+        with SessionLocal.begin() as session:
+            row = session.get(LayoutTemplate, layout["id"])
+            if row is None:
+                row = LayoutTemplate(id=layout["id"], layout=layout, samples=1)
+                session.add(row)
+            elif layout_templates.compatible(row.layout, layout):
+                row.layout = layout_templates.merge(row.layout, layout)
+                row.samples += 1
+            else:
+                logging.info(f"Template di layout {layout['id']}: colonne cambiate, apprendimento ripartito")
+                row.layout = layout
+                row.samples = 1
+            return {"layout": row.layout, "samples": row.samples}
+
+    def _delete(self, template_id: str) -> bool:
+        with SessionLocal.begin() as session:
+            return session.execute(
+                delete(LayoutTemplate).where(LayoutTemplate.id == template_id)
+            ).rowcount > 0
+
+
+template_store = TemplateStore()
@@ -0,0 +1,175 @@
+"""
+Estrazione delle tabelle dal text layer dei PDF nativi (esportati da LIS/gestionali).
+
+Le parole con le loro coordinate vengono raggruppate in righe (per y) e in segmenti
+(parole vicine sulla stessa riga); le colonne sono individuate raggruppando le
+estensioni x dei segmenti e separandole sui corridoi verticali di spazio bianco.
+Le funzioni girano nei processi del CPU executor.
+"""
+import math
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.services import layout_templates
+from app.services.render_worker import Source, open_pdf
+
+# Quota massima di caratteri illeggibili (font senza mappa Unicode, glifi di controllo)
+MAX_GARBAGE_RATIO = 0.1
+# Righe minime perché un blocco allineato in colonne sia considerato una tabella
+MIN_TABLE_ROWS = 3
+# Quota di righe che deve occupare una x perché appartenga a una colonna
+COLUMN_SUPPORT = 0.1
+# Corridoio minimo (pt) tra due colonne
+MIN_GUTTER = 4.0
+
+Word = Tuple[float, float, float, float, str]
+
+
+def extract_text_tables(
+    source: Source, min_chars: int, templates: Optional[List[Dict[str, Any]]] = None
+) -> List[Optional[List[Dict[str, Any]]]]:
+    """
+    Per ogni pagina restituisce le tabelle estratte dal text layer, oppure None se
+    la pagina non ha un text layer utilizzabile (scansione) e va inviata al modello vision.
+    Le pagine di un layout noto (`templates`) sono lette con le colonne del template.
+    """
+    results = []
+    with open_pdf(source) as doc:
+        for page_number, page in enumerate(doc, start=1):
+            words = [w[:5] for w in page.get_text("words")]
+            if not has_usable_text_layer(words, min_chars):
+                results.append(None)
+                continue
+            match = layout_templates.match_page(words, templates) if templates else None
+            tables = match[1] if match else tables_from_words(words, page.rect.width)
+            results.append([{"page": page_number, **table} for table in tables])
+    return results
+
+
+def has_usable_text_layer(words: List[Word], min_chars: int) -> bool:
+    text = "".join(w[4] for w in words)
+    if len(text) < min_chars:
+        return False
+    garbage = sum(1 for ch in text if ch == "�" or not ch.isprintable())
+    return garbage / len(text) <= MAX_GARBAGE_RATIO
+
+
+def tables_from_words(
+    words: List[Word], page_width: float, columns: Optional[List[Tuple[float, float]]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Tabelle ricostruite dalle parole di una pagina. Le colonne, se non indicate (es. dalle
+    linee verticali di una griglia), si ricavano dai corridoi di spazio bianco.
+    """
+    if columns is None:
+        lines = [_segments(line) for line in _group_lines(words)]
+        columns = _column_bounds(lines, page_width)
+    else:
+        # Con le colonne già note ogni parola va nella sua cella, anche se vicina alla successiva
+        lines = _group_lines(words)
+    if len(columns) < 2:
+        return []
+
+    tables = []
+    run: List[List[str]] = []
+    pending: List[List[str]] = []
+    for segments in lines:
+        cells = _assign_cells(segments, columns)
+        filled = sum(1 for cell in cells if cell)
+        if filled >= 2:
+            run.extend(pending)
+            pending = []
+            run.append(cells)
+        elif run and filled == 1:
+            # Righe con una sola cella (sezioni, nomi su due righe) restano nella
+            # tabella solo se seguite da altre righe tabellari
+            pending.append(cells)
+        else:
+            _close_run(run, tables)
+            run, pending = [], []
+    _close_run(run, tables)
+    return tables
+
+
+def header_placeholder(position: int) -> str:
+    """
+    Intestazione di una colonna senza etichetta (1 = prima colonna): intestazioni e
+    righe devono restare della stessa lunghezza, o i valori scivolano di colonna.
+    """
+    return f"col_{position}"
+
+
+def is_header_placeholder(header: str) -> bool:
+    return re.fullmatch(r"col_\d+", header) is not None
+
+
+def _close_run(run: List[List[str]], tables: List[Dict[str, Any]]) -> None:
+    if len(run) >= MIN_TABLE_ROWS:
+        headers = [cell or header_placeholder(position) for position, cell in enumerate(run[0], start=1)]
+        tables.append({"headers": headers, "data": run[1:]})
+
+
+def _group_lines(words: List[Word]) -> List[List[Word]]:
+    """Raggruppa le parole in righe visive confrontando il centro verticale."""
+    lines: List[List[Word]] = []
+    current_y = None
+    for word in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        y = (word[1] + word[3]) / 2
+        height = word[3] - word[1]
+        if current_y is not None and abs(y - current_y) <= height / 2:
+            lines[-1].append(word)
+        else:
+            lines.append([word])
+            current_y = y
+    return [sorted(line, key=lambda w: w[0]) for line in lines]
+
+
+def _segments(line: List[Word]) -> List[Word]:
+    """Unisce le parole separate da uno spazio normale; un salto più ampio apre un nuovo segmento."""
+    segments: List[Word] = []
+    for x0, y0, x1, y1, text in line:
+        if segments and x0 - segments[-1][2] <= (y1 - y0):
+            sx0, sy0, _, sy1, stext = segments[-1]
+            segments[-1] = (sx0, min(sy0, y0), x1, max(sy1, y1), f"{stext} {text}")
+        else:
+            segments.append((x0, y0, x1, y1, text))
+    return segments
+
+
+def _column_bounds(lines: List[List[Word]], page_width: float) -> List[Tuple[float, float]]:
+    rows = [segments for segments in lines if len(segments) >= 2]
+    if len(rows) < MIN_TABLE_ROWS:
+        return []
+
+    width = int(math.ceil(page_width)) + 1
+    coverage = [0] * width
+    for segments in rows:
+        for x0, _, x1, _, _ in segments:
+            for x in range(max(0, int(x0)), min(width, int(math.ceil(x1)))):
+                coverage[x] += 1
+
+    threshold = max(1, COLUMN_SUPPORT * len(rows))
+    columns: List[Tuple[float, float]] = []
+    start = None
+    for x, count in enumerate(coverage + [0]):
+        if count >= threshold and start is None:
+            start = x
+        elif count < threshold and start is not None:
+            if columns and start - columns[-1][1] < MIN_GUTTER:
+                columns[-1] = (columns[-1][0], x)
+            else:
+                columns.append((start, x))
+            start = None
+    return columns
+
+
+def _assign_cells(segments: List[Word], columns: List[Tuple[float, float]]) -> List[str]:
+    cells = [""] * len(columns)
+    for x0, _, x1, _, text in segments:
+        index = max(
+            range(len(columns)),
+            key=lambda i: (min(x1, columns[i][1]) - max(x0, columns[i][0]),
+                           -abs((x0 + x1) / 2 - (columns[i][0] + columns[i][1]) / 2)),
+        )
+        cells[index] = f"{cells[index]} {text}".strip()
+    return cells
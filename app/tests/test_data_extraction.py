@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.endpoints import data_extraction
+from app.services import structure_data_service
+from app.services.ingestion import SpooledUpload
+from app.services.loinc_index import LoincIndex, build_index
+
+
+@pytest.fixture(scope="module")
+def client():
+    app = FastAPI()
+    app.include_router(data_extraction.router)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("path", [
+    "/extract-tables",
+    "/extract-medical-data",
+    "/extract-medical-data/batch",
+    "/extract-tables/stream",
+    "/extract-medical-data/stream",
+    "/jobs",
+])
+def test_every_upload_endpoint_rejects_unsupported_files(client, path):
+    response = client.post(
+        path,
+        files=[("files", ("referto.pdf", b"%PDF-1.4\n", "application/pdf")), ("files", ("note.txt", b"x", "text/plain"))],
+        data={"ids": ["a", "b"]},
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "All files must be PDF or images (.pdf, .png, .jpg, .jpeg, .tiff, .bmp)"
+
+
+
+def test_structure_clinical_data_returns_annotated_fields(client, tmp_path, monkeypatch):
+    table = tmp_path / "Loinc.csv"
+    table.write_text(
+        "LOINC_NUM,COMPONENT,PROPERTY,TIME_ASPCT,SYSTEM,SCALE_TYP,CLASSTYPE,STATUS\n"
+        "2345-7,Glucose,MCnc,Pt,Ser/Plas,Qn,1,ACTIVE\n",
+        encoding="utf-8",
+    )
+    monkeypatch.setattr(structure_data_service, "loinc_index", LoincIndex(build_index({"table": str(table)})))
+    response = client.post("/structure-clinical-data", json={"tables": [{
+        "page": 1,
+        "headers": ["Descrizione Esame", "Esiti", "Unità di misura", "Valori normali"],
+        "data": [["GLUCOSIO", "95", "mg/dL", "70 - 110"]],
+    }]})
+    assert response.status_code == 200
+    assert response.json() == [{
+        "field_name": "GLUCOSIO",
+        "field_value": "95",
+        "field_unit_of_measure": "mg/dL",
+        "reference_range_low": "70",
+        "reference_range_high": "110",
+        "LOINC_value": "2345-7",
+        "belonging_panel_LOINC_value": "N/A",
+    }]
+
+
+def test_stream_releases_uploads_when_the_client_leaves_before_the_first_chunk(tmp_path):
+    spooled = tmp_path / "referto.pdf"
+    spooled.write_bytes(b"%PDF-1.4\n")
+    upload = SpooledUpload("referto.pdf")
+    upload.path = str(spooled)
+
+    async def records():
+        await asyncio.Event().wait()
+        yield {"type": "summary"}
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        # Il server cede il controllo a ogni invio: la disconnessione arriva prima del corpo
+        await asyncio.sleep(0)
+
+    response = data_extraction._stream_response(records(), [upload], "ndjson")
+    asyncio.run(response({"type": "http"}, receive, send))
+    assert not spooled.exists()
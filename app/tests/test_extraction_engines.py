@@ -0,0 +1,88 @@
+import asyncio
+import inspect
+
+import pytest
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+
+from app.core.config import settings
+from app.services.extraction_engines import ExtractionEngine, LLMEngine, TemplateEngine, TesseractEngine
+from app.services.llm_registry import llm_registry
+from app.services.template_store import template_store
+
+
+def test_engines_must_implement_extract():
+    class IncompleteEngine(ExtractionEngine):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        ExtractionEngine()
+    with pytest.raises(TypeError):
+        IncompleteEngine()
+
+
+def test_builtin_engines_are_concrete():
+    engines = [LLMEngine(), TesseractEngine.from_settings(), TemplateEngine.from_settings()]
+    assert [engine.name for engine in engines] == ["llm", "tesseract", "template"]
+
+
+@pytest.mark.parametrize("engine", [LLMEngine, TesseractEngine, TemplateEngine])
+def test_engines_accept_the_interface_arguments(engine):
+    # PDFService chiama extract(group) e, per i motori che leggono le righe man mano, extract(group, on_row)
+    expected = list(inspect.signature(ExtractionEngine.extract).parameters)
+    assert list(inspect.signature(engine.extract).parameters) == expected == ["self", "group", "on_row"]
+
+
+def test_template_engine_leaves_unknown_layouts_to_other_engines(monkeypatch):
+    engine = TemplateEngine.from_settings()
+    monkeypatch.setattr(template_store, "active", lambda: [])
+
+    async def refresh():
+        pass
+
+    monkeypatch.setattr(template_store, "refresh", refresh)
+    assert asyncio.run(engine.extract([{"page": 1}, {"page": 2}], on_row=lambda *args: None)) == [None, None]
+
+
+class ScriptedModel:
+    """Modello vision finto: risponde con le risposte date, in ordine, e il loro finish_reason."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    async def astream(self, messages, config=None):
+        content, finish_reason = self.replies[self.calls]
+        self.calls += 1
+        for handler in (config or {}).get("callbacks", []):
+            handler.on_llm_new_token(
+                content,
+                chunk=ChatGenerationChunk(message=AIMessageChunk(content=content), generation_info={"finish_reason": finish_reason}),
+            )
+        yield AIMessageChunk(content=content)
+
+
+PAGE = {"data_url": "data:image/png;base64,AAAA", "detail": "high", "width": 1000, "height": 1400}
+
+
+def _extract(monkeypatch, replies):
+    model = ScriptedModel(replies)
+    monkeypatch.setattr(llm_registry, "chat", lambda *args, **kwargs: model)
+    monkeypatch.setattr(settings, "LLM_MAX_CONTINUATIONS", 2)
+    return model, asyncio.run(LLMEngine()._parse_tables_from_images([PAGE]))
+
+
+def test_plain_text_reply_is_not_continued(monkeypatch):
+    model, result = _extract(monkeypatch, [("I am sorry, there are no tables in this image.", "stop")])
+    assert model.calls == 1
+    assert result == {"tables": [], "truncated": False}
+
+
+def test_reply_cut_by_the_output_limit_is_continued(monkeypatch):
+    model, result = _extract(monkeypatch, [
+        ('{"tables": [{"page": 1, "headers": ["Esame", "Esito"], "data": [["GLUCOSIO", "95"], ["CREAT', "length"),
+        ('{"tables": [{"page": 1, "headers": ["Esame", "Esito"], "data": [["CREATININA", "0.9"]]}]}', "stop"),
+    ])
+    assert model.calls == 2
+    assert result["tables"][0]["data"] == [["GLUCOSIO", "95"], ["CREATININA", "0.9"]]
+    assert not result["truncated"]
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import os
+from io import BytesIO
+from typing import List
+
+import pytest
+from fastapi import APIRouter, FastAPI, File, Form, UploadFile
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from app.services.ingestion import IngestionRoute, SpoolFile, ingested_uploads
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "INGEST_SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "INGEST_MEMORY_THRESHOLD", 1024)
+    monkeypatch.setattr(settings, "INGEST_MAX_FILE_BYTES", 64 * 1024)
+    monkeypatch.setattr(settings, "INGEST_MAX_REQUEST_BYTES", 96 * 1024)
+    return tmp_path
+
+
+@pytest.fixture
+def client(spool_dir):
+    router = APIRouter(route_class=IngestionRoute)
+
+    @router.post("/ingest")
+    async def ingest(files: List[UploadFile] = File(...)):
+        spooled = [isinstance(file.file, SpoolFile) for file in files]
+        async with ingested_uploads(files) as uploads:
+            return [
+                {
+                    "spooled": was_spooled,
+                    "on_disk": upload.path is not None,
+                    "in_spool_dir": upload.path is not None and os.path.dirname(upload.path) == str(spool_dir),
+                    "sha256": upload.sha256,
+                    "size": upload.size,
+                    "content": hashlib.sha256(await upload.read()).hexdigest(),
+                }
+                for was_spooled, upload in zip(spooled, uploads)
+            ]
+
+    app = FastAPI()
+    app.include_router(router)
+    return TestClient(app)
+
+
+def _files(*sizes):
+    return [("files", (f"referto{index}.pdf", os.urandom(size), "application/pdf")) for index, size in enumerate(sizes)]
+
+
+def test_uploads_are_adopted_from_the_parser_spool(client, spool_dir):
+    files = _files(200, 10 * 1024)
+    response = client.post("/ingest", files=files)
+    assert response.status_code == 200
+    small, large = response.json()
+    assert small["spooled"] and large["spooled"]
+    assert not small["on_disk"]
+    assert large["on_disk"] and large["in_spool_dir"]
+    for entry, (_, (_, content, _)) in zip((small, large), files):
+        assert entry["size"] == len(content)
+        assert entry["sha256"] == entry["content"] == hashlib.sha256(content).hexdigest()
+    # Gli spool su disco sono rimossi alla chiusura degli upload
+    assert os.listdir(spool_dir) == []
+
+
+@pytest.mark.parametrize("sizes, detail", [
+    ((65 * 1024,), "File referto0.pdf exceeds"),
+    ((50 * 1024, 50 * 1024), "Request exceeds"),
+])
+def test_limits_reject_the_request_and_remove_spools(client, spool_dir, sizes, detail):
+    response = client.post("/ingest", files=_files(*sizes))
+    assert response.status_code == 413
+    assert response.json()["detail"].startswith(detail)
+    assert os.listdir(spool_dir) == []
+
+
+def test_plain_upload_files_are_copied(spool_dir):
+    content = os.urandom(4096)
+
+    async def scenario():
+        async with ingested_uploads([UploadFile(BytesIO(content), filename="scan.png")]) as uploads:
+            assert uploads[0].path is not None
+            assert uploads[0].sha256 == hashlib.sha256(content).hexdigest()
+            assert await uploads[0].read() == content
+
+    asyncio.run(scenario())
+    assert os.listdir(spool_dir) == []
+
+
+@pytest.mark.parametrize("content_type, body", [
+    ("multipart/form-data", b"--x\r\n"),
+    ("multipart/form-data; boundary=x", b"--x\r\nContent-Disposition: form-data\r\n\r\nabc\r\n--x--\r\n"),
+])
+def test_malformed_multipart_bodies_are_rejected(client, spool_dir, content_type, body):
+    response = client.post("/ingest", content=body, headers={"Content-Type": content_type})
+    assert response.status_code == 400
+    assert os.listdir(spool_dir) == []
+
+
+def test_unfinished_file_part_is_released(client, spool_dir):
+    body = b"--x\r\nContent-Disposition: form-data; name=\"files\"; filename=\"a.pdf\"\r\n\r\n" + os.urandom(4096)
+    response = client.post("/ingest", content=body, headers={"Content-Type": "multipart/form-data; boundary=x"})
+    # Il form non contiene file: FastAPI risponde che il campo manca
+    assert response.status_code == 422
+    assert os.listdir(spool_dir) == []
+
+
+def test_text_fields_are_parsed_alongside_files(spool_dir):
+    router = APIRouter(route_class=IngestionRoute)
+
+    @router.post("/fields")
+    async def fields(files: List[UploadFile] = File(...), ids: List[str] = Form(...)):
+        return {"ids": ids, "files": [file.filename for file in files], "sizes": [file.size for file in files]}
+
+    app = FastAPI()
+    app.include_router(router)
+    response = TestClient(app).post("/fields", files=_files(10, 2000), data={"ids": ["A-1", "B-è"]})
+    assert response.status_code == 200
+    assert response.json() == {"ids": ["A-1", "B-è"], "files": ["referto0.pdf", "referto1.pdf"], "sizes": [10, 2000]}
@@ -0,0 +1,132 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import sessionmaker
+
+from app.core.config import settings
+from app.db.models import Base, ExtractionJob, utcnow
+from app.services import job_service as job_module
+from app.services.job_service import JobService
+
+
+class BlockingPDFService:
+    """Estrazione che resta in corso finché non viene interrotta."""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.cancelled = False
+
+    async def extract_tables_data(self, uploads):
+        self.started.set()
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+@pytest.fixture
+def session_factory(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine, expire_on_commit=False)
+    monkeypatch.setattr(job_module, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def job_files(tmp_path):
+    job_dir = tmp_path / "job"
+    job_dir.mkdir()
+    path = job_dir / "000_referto.pdf"
+    path.write_bytes(b"%PDF-1.4\n")
+    return [{"filename": "referto.pdf", "path": str(path)}]
+
+
+def _job(factory, job_id="job-1"):
+    with factory() as session:
+        return session.get(ExtractionJob, job_id)
+
+
+def _expire_lease(factory, job_id="job-1"):
+    with factory.begin() as session:
+        session.execute(
+            update(ExtractionJob).where(ExtractionJob.id == job_id)
+            .values(lease_expires_at=utcnow() - timedelta(seconds=1))
+        )
+
+
+def test_stale_attempt_cannot_overwrite_the_new_one(session_factory, job_files):
+    service = JobService(None, None)
+    service._insert_job("job-1", "tables", job_files)
+    stale = service._claim_next()
+    _expire_lease(session_factory)
+    current = service._claim_next()
+    assert (stale["attempts"], current["attempts"]) == (1, 2)
+
+    assert service._renew_lease(current)
+    assert not service._renew_lease(stale)
+    assert service._complete(current, {"tables": []})
+    assert not service._complete(stale, {"tables": ["stale"]})
+    service._fail(stale, "errore del tentativo scaduto", retry=True)
+
+    job = _job(session_factory)
+    assert job.status == "completed" and job.error is None
+    assert job.extraction.extracted_data == {"tables": []}
+
+
+def test_stale_failure_does_not_requeue_a_running_job(session_factory, job_files):
+    service = JobService(None, None)
+    service._insert_job("job-1", "tables", job_files)
+    stale = service._claim_next()
+    _expire_lease(session_factory)
+    service._claim_next()
+    service._fail(stale, "timeout", retry=True)
+    job = _job(session_factory)
+    assert job.status == "running" and job.attempts == 2 and job.error is None
+
+
+def test_shutdown_requeues_the_running_job(session_factory, job_files):
+    async def scenario():
+        pdf_service = BlockingPDFService()
+        service = JobService(pdf_service, None, workers=1)
+        service._insert_job("job-1", "tables", job_files)
+        await service.start()
+        await asyncio.wait_for(pdf_service.started.wait(), 5)
+        await service.stop()
+        return pdf_service
+
+    pdf_service = asyncio.run(scenario())
+    job = _job(session_factory)
+    assert pdf_service.cancelled
+    assert job.status == "queued" and job.attempts == 0 and job.lease_expires_at is None
+
+
+def test_lost_lease_stops_the_attempt(session_factory, job_files, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_LEASE_SECONDS", 0.15)
+
+    async def scenario():
+        pdf_service = BlockingPDFService()
+        service = JobService(pdf_service, None, workers=1)
+        service._insert_job("job-1", "tables", job_files)
+        monkeypatch.setattr(settings, "JOB_POLL_INTERVAL", 60)
+        await service.start()
+        await asyncio.wait_for(pdf_service.started.wait(), 5)
+        # Un altro worker ha ripreso il job dopo la scadenza del lease
+        with session_factory.begin() as session:
+            session.execute(update(ExtractionJob).where(ExtractionJob.id == "job-1").values(attempts=2))
+        for _ in range(100):
+            if pdf_service.cancelled:
+                break
+            await asyncio.sleep(0.02)
+        worker_alive = not service._tasks[0].done()
+        await service.stop()
+        return pdf_service, worker_alive
+
+    pdf_service, worker_alive = asyncio.run(scenario())
+    assert pdf_service.cancelled and worker_alive
+    job = _job(session_factory)
+    assert job.status == "running" and job.attempts == 2
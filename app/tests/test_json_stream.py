@@ -0,0 +1,90 @@
+import json
+import random
+
+import pytest
+
+from app.services.json_stream import TablesStreamParser, append_continuation
+
+RESPONSE = {
+    "tables": [
+        {
+            "page": 1,
+            "headers": ["Esame", "Esito", "Unità", "Valori"],
+            "data": [
+                ["GLUCOSIO", 95, "mg/dL", "70 - 110"],
+                ["CREATININA", 0.9, "mg/dL", "0,5 - 1,2"],
+                ["PCR", 1500.25, None, True],
+                ["HBsAg", "Negativo", "", False],
+            ],
+        },
+        {"page": 2, "headers": ["Esame", "Esito"], "data": [["TSH", 2.1e-1]]},
+    ]
+}
+
+
+def _parse(text: str, chunks: int = 1, seed: int = 0):
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(text)), max(0, min(chunks - 1, len(text) - 1))))
+    parser = TablesStreamParser()
+    rows = []
+    for start, end in zip([0] + cuts, cuts + [len(text)]):
+        rows += parser.feed(text[start:end])
+    rows += parser.finish()
+    return parser, rows
+
+
+def test_rows_are_emitted_as_they_close():
+    text = json.dumps(RESPONSE)
+    parser = TablesStreamParser()
+    first_row_end = text.index('"70 - 110"]') + len('"70 - 110"]')
+    assert parser.feed(text[:first_row_end - 1]) == []
+    assert parser.feed(text[first_row_end - 1:first_row_end]) == [(0, ["GLUCOSIO", 95, "mg/dL", "70 - 110"])]
+
+
+@pytest.mark.parametrize("chunks", [1, 7, 200])
+def test_complete_response(chunks):
+    parser, rows = _parse("```json\n" + json.dumps(RESPONSE, ensure_ascii=False) + "\n```", chunks)
+    assert parser.complete and parser.error is None
+    assert parser.tables == RESPONSE["tables"]
+    assert [row for _, row in rows] == [row for table in RESPONSE["tables"] for row in table["data"]]
+
+
+def test_any_truncation_is_reported_as_truncated_not_malformed():
+    text = json.dumps(RESPONSE, ensure_ascii=False)
+    expected_rows = [row for table in RESPONSE["tables"] for row in table["data"]]
+    for cut in range(len(text)):
+        for seed in range(3):
+            parser, rows = _parse(text[:cut], chunks=1 + seed * 5, seed=cut)
+            assert parser.error is None, (cut, text[:cut][-20:], parser.error)
+            assert not parser.complete
+            assert [row for _, row in rows] == expected_rows[:len(rows)]
+
+
+@pytest.mark.parametrize("tail", ['"page": nu', '"page": 1500.', '"page": tr', '"page": -', '"page": 1e'])
+def test_cut_inside_a_scalar(tail):
+    parser, _ = _parse('{"tables": [{"headers": ["A", "B"], "data": [["x", 1]], ' + tail)
+    assert parser.error is None and not parser.complete
+    assert parser.tables == [{"headers": ["A", "B"], "data": [["x", 1]]}]
+
+
+def test_trailing_number_is_not_taken_as_complete():
+    parser, _ = _parse('{"tables": [{"page": 12')
+    assert "page" not in parser.tables[0]
+
+
+@pytest.mark.parametrize("text", ['{"tables": [{"data": [["x", 1]]}] x', '{"tables": [{"data": [["x" 1]]}]}', '{"tables": [nope]}'])
+def test_malformed_json_sets_error(text):
+    parser, _ = _parse(text)
+    assert parser.error is not None and not parser.complete
+
+
+def test_continuation_drops_repeated_rows():
+    headers = ["Esame", "Esito"]
+    done = [{"page": 1, "headers": headers, "data": [["A", 1], ["B", 2]]}]
+    more = [
+        {"page": 1, "headers": headers, "data": [["B", 2], ["C", 3]]},
+        {"page": 2, "headers": headers, "data": [["D", 4]]},
+    ]
+    merged = append_continuation(done, more)
+    assert merged[0]["data"] == [["A", 1], ["B", 2], ["C", 3]]
+    assert merged[1]["data"] == [["D", 4]]
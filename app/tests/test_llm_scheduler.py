@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+from fastapi import HTTPException
+
+from app.services.llm_scheduler import LLMScheduler, TokenBucket, batch_priority, image_tokens
+
+
+def test_bucket_refills_over_a_minute():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    assert bucket.wait_time(60, now) == 0
+    bucket.take(60, now)
+    assert bucket.wait_time(1, now) == pytest.approx(1.0)
+    assert bucket.wait_time(1, now + 0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(1, now + 1) == pytest.approx(0.0)
+    # La ricarica non supera la capacità
+    assert bucket.wait_time(60, now + 600) == 0 and bucket.level == 60
+
+
+def test_bucket_caps_requests_larger_than_its_capacity():
+    bucket = TokenBucket(100)
+    now = bucket.updated
+    # Una chiamata più grande del budget al minuto aspetta il bucket pieno, non per sempre
+    assert bucket.wait_time(500, now) == 0
+    bucket.take(500, now)
+    assert bucket.level == 0
+    assert bucket.wait_time(500, now) == pytest.approx(60.0)
+
+
+def test_zero_capacity_means_no_limit():
+    bucket = TokenBucket(0)
+    bucket.take(10 ** 6, bucket.updated)
+    assert bucket.wait_time(10 ** 6, bucket.updated) == 0
+
+
+def test_image_tokens_follow_the_tiling_formula():
+    assert image_tokens(512, 512) == 85 + 170
+    assert image_tokens(1024, 2048) == 85 + 170 * 6
+    assert image_tokens(4000, 4000, detail="low") == 85
+
+
+def test_token_budget_delays_the_next_call():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=4, tpm=600_000)
+
+        async def call():
+            return "ok"
+
+        await scheduler.call("tables", 600_000, call)
+        started = time.monotonic()
+        # 1000 token si ricaricano in 0.1 s con 600k token al minuto
+        await scheduler.call("tables", 1000, call)
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.08
+
+
+def test_interactive_calls_go_before_batch_calls():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1)
+        release = asyncio.Event()
+        order = []
+
+        async def blocker():
+            await release.wait()
+
+        def record(name):
+            async def call():
+                order.append(name)
+            return call
+
+        first = asyncio.create_task(scheduler.call("tables", 1, blocker))
+        await asyncio.sleep(0)
+        with batch_priority():
+            batch = asyncio.create_task(scheduler.call("tables", 1, record("batch")))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(scheduler.call("tables", 1, record("interactive")))
+        await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == {"interactive": 1, "batch": 1}
+        release.set()
+        await asyncio.gather(first, batch, interactive)
+        return order, scheduler.stats()["active"]
+
+    order, active = asyncio.run(scenario())
+    assert order == ["interactive", "batch"] and active == 0
+
+
+def test_interactive_queue_over_the_limit_is_shed():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+
+        async def blocker():
+            await release.wait()
+
+        tasks = [asyncio.create_task(scheduler.call("tables", 1, blocker)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as shed:
+            await scheduler.call("tables", 1, blocker)
+        release.set()
+        await asyncio.gather(*tasks)
+        return shed.value, scheduler.counters["shed"]
+
+    error, shed = asyncio.run(scenario())
+    assert error.status_code == 503 and "Retry-After" in error.headers and shed == 1
+
+
+def test_rate_limited_calls_are_retried():
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(429, request=request, headers={"retry-after-ms": "10"})
+
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, base_delay=0.01)
+        attempts = []
+
+        async def call():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise openai.RateLimitError("rate limited", response=response, body=None)
+            return "ok"
+
+        return await scheduler.call("tables", 1, call), attempts, scheduler.counters
+
+    result, attempts, counters = asyncio.run(scenario())
+    assert result == "ok" and len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.01
+    assert counters["retries"] == 1 and counters["rate_limited"] == 1
@@ -0,0 +1,115 @@
+import csv
+import json
+
+import pytest
+
+from app.core.config import settings
+from app.services.loinc_index import NOT_FOUND, LoincIndex, build_index
+
+# LOINC_NUM, COMPONENT, PROPERTY, SYSTEM
+CODES = [
+    ("17861-6", "Calcium", "MCnc", "Ser/Plas"),
+    ("1994-3", "Calcium.ionized", "SCnc", "Ser/Plas"),
+    ("2093-3", "Cholesterol", "MCnc", "Ser/Plas"),
+    ("2085-9", "Cholesterol.in HDL", "MCnc", "Ser/Plas"),
+    ("43396-1", "Cholesterol.non HDL", "MCnc", "Ser/Plas"),
+    ("1975-2", "Bilirubin", "MCnc", "Ser/Plas"),
+    ("1971-1", "Bilirubin.non-glucuronidated", "MCnc", "Ser/Plas"),
+    ("2339-0", "Glucose", "MCnc", "Bld"),
+    ("2345-7", "Glucose", "MCnc", "Ser/Plas"),
+    ("2951-2", "Sodium", "SCnc", "Ser/Plas"),
+    ("2498-4", "Iron", "MCnc", "Ser/Plas"),
+    ("751-8", "Neutrophils", "NCnc", "Bld"),
+    ("770-8", "Neutrophils/100 leukocytes", "NFr", "Bld"),
+]
+
+
+def _write_table(path):
+    with open(path, "w", newline="", encoding="utf-8") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["LOINC_NUM", "COMPONENT", "PROPERTY", "TIME_ASPCT", "SYSTEM", "SCALE_TYP", "CLASSTYPE", "STATUS"])
+        for code, component, prop, system in CODES:
+            writer.writerow([code, component, prop, "Pt", system, "Qn", "1", "ACTIVE"])
+    return path
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    path = _write_table(tmp_path_factory.mktemp("loinc") / "Loinc.csv")
+    return LoincIndex(build_index({"table": str(path)}))
+
+
+@pytest.fixture
+def index_path(tmp_path, monkeypatch):
+    """LOINC_INDEX_PATH in tmp_path, compilato dalla sola tabella di test."""
+    path = tmp_path / "loinc-index.json"
+    monkeypatch.setattr(settings, "LOINC_TABLE_PATH", str(_write_table(tmp_path / "Loinc.csv")))
+    monkeypatch.setattr(settings, "LOINC_INDEX_PATH", str(path))
+    for name in ("LOINC_LINGUISTIC_VARIANT_PATH", "LOINC_PANELS_PATH", "LOINC_SYNONYMS_PATH"):
+        monkeypatch.setattr(settings, name, "")
+    return path
+
+
+@pytest.mark.parametrize("name, unit, code", [
+    ("CALCIO", "mg/dL", "17861-6"),
+    ("CALCIO IONIZZATO", "mmol/L", "1994-3"),
+    ("COLESTEROLO TOTALE", "mg/dL", "2093-3"),
+    ("COLESTEROLO HDL", "mg/dL", "2085-9"),
+    ("COLESTEROLO NON HDL", "mg/dL", "43396-1"),
+    ("BILIRUBINA TOTALE", "mg/dL", "1975-2"),
+    ("BILIRUBINA INDIRETTA", "mg/dL", "1971-1"),
+    ("GLICEMIA", "mg/dL", "2345-7"),
+    ("FERRO SIERICO", "mcg/dL", "2498-4"),
+    ("NEUTROFILI", "%", "770-8"),
+    ("NEUTROFILI", "10^3/mm^3", "751-8"),
+])
+def test_lookup(index, name, unit, code):
+    assert index.lookup(name, unit) == code
+
+
+def test_ocr_misread_names_match_by_trigrams(index):
+    assert index.lookup("GLICEMlA", "mg/dL") == "2345-7"
+
+
+def test_qualified_name_does_not_fall_back_to_the_generic_analyte(index):
+    # Solo il sodio sierico nell'indice: il sodio urinario è un altro esame
+    assert index.lookup("SODIO URINARIO", "mmol/L") is None
+    assert index.lookup("BILIRUBINA CONIUGATA", "mg/dL") is None
+
+
+def test_unit_conflicting_with_every_candidate_has_no_code(index):
+    # Calcio totale è solo in massa/volume: mmol/L non può esserne il codice
+    assert index.lookup("CALCIO", "mmol/L") is None
+    assert index.lookup("CALCIO", "") == "17861-6"
+
+
+def test_annotate_marks_unknown_names(index):
+    fields = index.annotate([
+        {"field_name": "CALCIO IONIZZATO", "field_unit_of_measure": "mmol/L"},
+        {"field_name": "ESAME SCONOSCIUTO", "field_unit_of_measure": ""},
+    ])
+    assert fields[0]["LOINC_value"] == "1994-3"
+    assert fields[1]["LOINC_value"] == NOT_FOUND
+    assert fields[1]["belonging_panel_LOINC_value"] == NOT_FOUND
+
+
+
+def test_compiled_index_is_saved_as_json_and_reloaded(index_path):
+    compiled = LoincIndex()
+    compiled.load()
+    assert json.loads(index_path.read_text(encoding="utf-8"))["signature"] == compiled.signature.split(":")[0]
+
+    reloaded = LoincIndex()
+    reloaded.load()
+    assert reloaded.signature == compiled.signature
+    assert reloaded.lookup("GLICEMlA", "mg/dL") == compiled.lookup("GLICEMlA", "mg/dL") == "2345-7"
+    assert reloaded.lookup("CALCIO IONIZZATO", "mmol/L") == "1994-3"
+
+
+def test_unreadable_index_file_is_rebuilt(index_path):
+    # Ad es. un indice salvato con pickle da una versione precedente
+    index_path.write_bytes(b"\x80\x05\x95not json")
+    index = LoincIndex()
+    index.load()
+    assert index.lookup("GLICEMIA", "mg/dL") == "2345-7"
+    assert len(json.loads(index_path.read_text(encoding="utf-8"))["codes"]) == len(CODES)
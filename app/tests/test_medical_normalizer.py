@@ -0,0 +1,75 @@
+import pytest
+
+from app.services.medical_normalizer import MedicalRowNormalizer
+from app.services.structure_data_service import StructureDataService
+
+HEADERS = ["descrizioneEsame", "esiti", "unitaDiMisura", "valoriNormali"]
+
+
+@pytest.fixture
+def normalizer():
+    return MedicalRowNormalizer()
+
+
+def _row(*cells):
+    return dict(zip(HEADERS, cells))
+
+
+@pytest.mark.parametrize("cells, expected", [
+    (("FOLATI", "3,15", "ng/mL", "3,1 - 20,5"), ("3.15", "ng/mL", "3.1", "20.5")),
+    (("VES", "12 *", "mm/h", "< 20"), ("12", "mm/h", "", "20")),
+    (("HDL", "52", "mg/dL", "> 40"), ("52", "mg/dL", "40", "")),
+    (("PCR", "< 0,5", "mg/L", "0 - 5"), ("<0.5", "mg/L", "0", "5")),
+    (("GLUCOSIO", "95 mg/dL", "", "70 - 110"), ("95", "mg/dL", "70", "110")),
+])
+def test_numeric_rows(normalizer, cells, expected):
+    status, field = normalizer.normalize_row(_row(*cells))
+    assert status == "ok"
+    assert (field["field_value"], field["field_unit_of_measure"],
+            field["reference_range_low"], field["reference_range_high"]) == expected
+    assert field["field_name"] == cells[0]
+
+
+@pytest.mark.parametrize("value", ["Negativo", "ASSENTE", "tracce", "Debolmente positivo", "non rilevabile"])
+def test_qualitative_results_are_copied(normalizer, value):
+    status, field = normalizer.normalize_row(_row("HBsAg", value, "", ""))
+    assert status == "ok"
+    assert field["field_value"] == value
+
+
+@pytest.mark.parametrize("value", ["mg/dL", "vedi nota", "U/L"])
+def test_free_text_values_go_to_the_model(normalizer, value):
+    assert normalizer.normalize_row(_row("GLUCOSIO", value, "", "70 - 110")) == ("unresolved", None)
+
+
+def test_shifted_columns_go_to_the_model(normalizer):
+    # Intestazione vuota scartata: valori spostati a sinistra di una colonna
+    row = dict(zip(["esame", "unita", "valori"], ["GLUCOSIO", "95", "mg/dL", "70 - 110"]))
+    assert normalizer.normalize_row(row) == ("unresolved", None)
+
+
+def test_cells_beyond_the_headers_go_to_the_model(normalizer):
+    row = StructureDataService._row_dict(["esame", "esito", "unita"], ["GLUCOSIO", "95", "mg/dL", "70 - 110"])
+    assert row["col_4"] == "70 - 110"
+    assert normalizer.normalize_row(row) == ("unresolved", None)
+
+
+@pytest.mark.parametrize("cells", [
+    ("PIASTRINE", "252.000", "/mmc", "150.000 - 450.000"),
+    ("TESTOSTERONE", "5,2", "ng/mL", "M: 2,8 - 8,0 F: 0,1 - 0,7"),
+])
+def test_ambiguous_rows_go_to_the_model(normalizer, cells):
+    assert normalizer.normalize_row(_row(*cells)) == ("unresolved", None)
+
+
+def test_section_titles_are_skipped(normalizer):
+    assert normalizer.normalize_row(_row("EMOCROMO", "", "", "")) == ("skip", None)
+
+
+def test_unknown_columns_go_to_the_model(normalizer):
+    fields, unresolved = normalizer.normalize([
+        _row("SODIO", "140", "mmol/L", "135 - 145"),
+        {"descrizioneEsame": "POTASSIO", "esiti": "4,2", "metodo": "ISE"},
+    ])
+    assert fields[0]["field_value"] == "140"
+    assert fields[1] is None and unresolved == [1]
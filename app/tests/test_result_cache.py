@@ -0,0 +1,94 @@
+import asyncio
+import sqlite3
+import time
+
+from app.services.cache_service import ResultCache
+
+
+def _cache(tmp_path, **kwargs):
+    return ResultCache(str(tmp_path / "cache.db"), **kwargs)
+
+
+def test_key_depends_on_files_and_params_not_on_their_order():
+    key = ResultCache.make_key("tables", ["a", "b"], model="gpt-4o", dpi=200)
+    assert key == ResultCache.make_key("tables", ["a", "b"], dpi=200, model="gpt-4o")
+    assert key != ResultCache.make_key("tables", ["b", "a"], model="gpt-4o", dpi=200)
+    assert key != ResultCache.make_key("tables", ["a", "b"], model="gpt-4o-mini", dpi=200)
+    assert key != ResultCache.make_key("medical", ["a", "b"], model="gpt-4o", dpi=200)
+
+
+def test_values_are_independent_copies(tmp_path):
+    cache = _cache(tmp_path)
+
+    async def scenario():
+        value = {"tables": [{"data": [["GLUCOSIO", 95]]}]}
+        await cache.set("k", value)
+        value["tables"].clear()
+        first = await cache.get("k")
+        first["tables"].clear()
+        return await cache.get("k")
+
+    assert asyncio.run(scenario()) == {"tables": [{"data": [["GLUCOSIO", 95]]}]}
+    assert cache.stats()["hits"] == {"memory": 2, "disk": 0}
+
+
+def test_disk_tier_is_shared_between_instances(tmp_path):
+    async def scenario():
+        await _cache(tmp_path).set("k", [1, 2, 3])
+        other = _cache(tmp_path)
+        return other, await other.get("k"), await other.get("k"), await other.get("missing")
+
+    other, from_disk, from_memory, missing = asyncio.run(scenario())
+    assert from_disk == from_memory == [1, 2, 3] and missing is None
+    assert other.stats()["hits"] == {"memory": 1, "disk": 1}
+    assert other.stats()["misses"] == 1
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = _cache(tmp_path, ttl_seconds=-1)
+
+    async def scenario():
+        await cache.set("k", "valore")
+        return await cache.get("k")
+
+    assert asyncio.run(scenario()) is None
+    assert cache.stats()["memory_entries"] == 0
+
+
+def test_memory_tier_evicts_least_recently_used(tmp_path):
+    cache = _cache(tmp_path, memory_entries=2)
+
+    async def scenario():
+        for key in ("a", "b"):
+            await cache.set(key, key)
+        await cache.get("a")
+        await cache.set("c", "c")
+
+    asyncio.run(scenario())
+    assert list(cache._memory) == ["a", "c"]
+
+
+def test_disk_tier_stays_within_max_bytes(tmp_path):
+    cache = _cache(tmp_path, max_disk_bytes=250)
+
+    async def scenario():
+        for key in ("a", "b", "c"):
+            await cache.set(key, "x" * 98)
+            time.sleep(0.01)
+
+    asyncio.run(scenario())
+    with sqlite3.connect(cache.path) as conn:
+        keys = [row[0] for row in conn.execute("SELECT key FROM results ORDER BY accessed_at")]
+    # Ogni valore occupa 100 byte: resta spazio solo per le due voci più recenti
+    assert keys == ["b", "c"]
+
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = _cache(tmp_path, enabled=False)
+
+    async def scenario():
+        await cache.set("k", 1)
+        return await cache.get("k")
+
+    assert asyncio.run(scenario()) is None
+    assert not (tmp_path / "cache.db").exists()
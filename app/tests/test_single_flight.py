@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from app.services.cache_service import SingleFlight
+
+
+class Computation:
+    """Calcolo che resta in corso finché il test non lo sblocca."""
+
+    def __init__(self, result=None, error=None):
+        self.calls = 0
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        self.result = result
+        self.error = error
+
+    async def __call__(self):
+        self.calls += 1
+        self.started.set()
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_identical_requests_share_one_computation():
+    async def scenario():
+        flights = SingleFlight()
+        compute = Computation(result={"tables": [["GLUCOSIO", 95]]})
+        tasks = [asyncio.create_task(flights.run("k", compute)) for _ in range(3)]
+        await compute.started.wait()
+        await _settle()
+        compute.release.set()
+        results = await asyncio.gather(*tasks)
+        return flights, compute, results
+
+    flights, compute, results = asyncio.run(scenario())
+    assert compute.calls == 1
+    assert results == [{"tables": [["GLUCOSIO", 95]]}] * 3
+    # Chi si aggancia riceve una copia: modificarla non altera le altre risposte
+    assert results[0] is not results[1] and results[1] is not results[2]
+    assert flights.stats() == {"enabled": True, "in_flight": 0, "leaders": 1, "followers": 2}
+
+
+def test_followers_receive_the_leader_error():
+    async def scenario():
+        flights = SingleFlight()
+        compute = Computation(error=ValueError("risposta non valida"))
+        tasks = [asyncio.create_task(flights.run("k", compute)) for _ in range(2)]
+        await compute.started.wait()
+        await _settle()
+        compute.release.set()
+        return compute, await asyncio.gather(*tasks, return_exceptions=True)
+
+    compute, results = asyncio.run(scenario())
+    assert compute.calls == 1
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_follower_takes_over_when_the_leader_is_cancelled():
+    async def scenario():
+        flights = SingleFlight()
+        compute = Computation(result="ok")
+        leader = asyncio.create_task(flights.run("k", compute))
+        await compute.started.wait()
+        follower = asyncio.create_task(flights.run("k", compute))
+        await _settle()
+        leader.cancel()
+        await _settle()
+        compute.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return flights, compute, await follower
+
+    flights, compute, result = asyncio.run(scenario())
+    assert result == "ok" and compute.calls == 2
+    assert flights.leaders == 2 and flights.stats()["in_flight"] == 0
+
+
+def test_cancelled_follower_does_not_stop_the_leader():
+    async def scenario():
+        flights = SingleFlight()
+        compute = Computation(result="ok")
+        leader = asyncio.create_task(flights.run("k", compute))
+        await compute.started.wait()
+        follower = asyncio.create_task(flights.run("k", compute))
+        await _settle()
+        follower.cancel()
+        await _settle()
+        compute.release.set()
+        return follower, await leader
+
+    follower, result = asyncio.run(scenario())
+    assert follower.cancelled() and result == "ok"
+
+
+def test_disabled_runs_every_request():
+    async def scenario():
+        flights = SingleFlight(enabled=False)
+        compute = Computation(result="ok")
+        compute.release.set()
+        return compute, await asyncio.gather(flights.run("k", compute), flights.run("k", compute))
+
+    compute, results = asyncio.run(scenario())
+    assert compute.calls == 2 and results == ["ok", "ok"]
@@ -0,0 +1,87 @@
+import fitz
+
+from app.benchmarks.fixtures import COLUMN_X, REPORT_HEADERS, report_page_rows
+from app.services import text_layer
+from app.services.extraction_engines import normalize_tables_response
+from app.services.structure_data_service import StructureDataService
+
+ROWS = [
+    ["GLUCOSIO", "95", "mg/dL", "70 - 110"],
+    ["CREATININA", "0,9", "mg/dL", "0,5 - 1,2"],
+    ["SODIO", "140", "mmol/L", "135 - 145"],
+    ["POTASSIO", "4,2", "mmol/L", "3,5 - 5,1"],
+]
+
+
+def _pdf(headers, rows) -> bytes:
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_text((50, 60), "LABORATORIO ANALISI CLINICHE", fontsize=12)
+    y = 110
+    for x, header in zip(COLUMN_X, headers):
+        if header:
+            page.insert_text((x, y), header, fontsize=9)
+    for row in rows:
+        y += 16
+        for x, cell in zip(COLUMN_X, row):
+            page.insert_text((x, y), cell, fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _tables(headers, rows):
+    pages = text_layer.extract_text_tables(_pdf(headers, rows), min_chars=20)
+    assert len(pages) == 1 and pages[0] is not None
+    return pages[0]
+
+
+def test_columns_follow_the_report_grid():
+    tables = _tables(REPORT_HEADERS, ROWS)
+    assert len(tables) == 1
+    assert tables[0]["page"] == 1
+    assert tables[0]["headers"] == REPORT_HEADERS
+    assert tables[0]["data"] == ROWS
+
+
+def test_multi_word_cells_stay_in_one_column():
+    rows = report_page_rows(1, 8)
+    tables = _tables(REPORT_HEADERS, rows)
+    assert tables[0]["data"] == rows
+
+
+def test_unlabeled_column_gets_positional_header():
+    tables = _tables(["Esame", "", "Unita", "Valori"], ROWS)
+    assert tables[0]["headers"] == ["Esame", "col_2", "Unita", "Valori"]
+    assert all(len(row) == 4 for row in tables[0]["data"])
+
+
+def test_unlabeled_column_keeps_values_aligned_after_normalization():
+    table = normalize_tables_response({"tables": _tables(["Esame", "", "Unita", "Valori"], ROWS)})["tables"][0]
+    glucosio = dict(zip(table["headers"], table["data"][0]))
+    assert glucosio == {"Esame": "GLUCOSIO", "col_2": "95", "Unita": "mg/dL", "Valori": "70 - 110"}
+
+
+def test_normalization_keeps_empty_model_headers_in_place():
+    result = normalize_tables_response({"tables": [{"headers": ["Esame", "", None, "Valori"], "data": [ROWS[0]]}]})
+    assert result["tables"][0]["headers"] == ["Esame", "col_2", "col_3", "Valori"]
+
+
+def test_header_keys_accept_empty_headers():
+    assert StructureDataService._header_keys(["Unità di misura", "", "col_3"]) == ["unitàDiMisura", "col_2", "col_3"]
+
+
+def test_page_without_text_layer_is_left_to_the_model():
+    doc = fitz.open()
+    doc.new_page()
+    data = doc.tobytes()
+    doc.close()
+    assert text_layer.extract_text_tables(data, min_chars=20) == [None]
+
+
+def test_too_few_aligned_rows_is_not_a_table():
+    words = [
+        (50, 100, 90, 110, "Esame"), (260, 100, 290, 110, "Esito"),
+        (50, 120, 90, 130, "SODIO"), (260, 120, 280, 130, "140"),
+    ]
+    assert text_layer.tables_from_words(words, 595) == []